@@ -0,0 +1,202 @@
+"""Nagios checks for the flannel data path.
+
+Run by NRPE through the check_flannel wrapper installed by the charm:
+
+    check_flannel fdb --device flannel.1 --snapshot FILE [--direct-routing]
+    check_flannel lease --snapshot FILE [--warn SECS --crit SECS]
+    check_flannel mtu --device flannel.1 --iface ens3 --overhead 50
+
+The checks are read-only. NRPE cannot read the etcd credentials, so the etcd
+leases come from the snapshot saved by charms.flannel.metrics rather than
+from etcd itself. Each check needs at most three `ip -j` or `bridge -j`
+calls and stays well under 100ms.
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+from charms.flannel.leases import DEFAULT_RENEW_MARGIN, stale_ttl
+from charms.flannel.metrics import LEASE_SNAPSHOT_INTERVAL, command_json
+from charms.flannel.routes import interface_mtu
+
+
+OK, WARNING, CRITICAL, UNKNOWN = range(4)
+STATUS_NAMES = ("OK", "WARNING", "CRITICAL", "UNKNOWN")
+
+# The metrics timer refreshes the snapshot every LEASE_SNAPSHOT_INTERVAL;
+# allow a couple of missed or failed refreshes before giving up on it.
+SNAPSHOT_MAX_AGE = 3 * LEASE_SNAPSHOT_INTERVAL
+
+
+def lease_thresholds(renew_margin=DEFAULT_RENEW_MARGIN):
+    """Return the warning and critical TTLs of the lease check, in secs.
+
+    flanneld renews its lease once renew_margin minutes are left, so a
+    healthy lease never gets much below that. Warn once the lease would
+    count as stale, and go critical with a quarter of the margin left.
+    """
+    return stale_ttl(renew_margin), renew_margin * 60 // 4
+
+
+LEASE_WARN_SECS, LEASE_CRIT_SECS = lease_thresholds()
+
+
+class CheckError(Exception):
+    """The check could not gather what it needs, reported as UNKNOWN."""
+
+
+def load_snapshot(path, now=None):
+    """Return the lease snapshot at path.
+
+    Raises: CheckError if it is missing, unreadable or too old to trust
+    """
+    now = time.time() if now is None else now
+    try:
+        with open(path) as f:
+            snapshot = json.load(f)
+    except FileNotFoundError:
+        raise CheckError("no lease snapshot at {}".format(path))
+    except (OSError, ValueError) as e:
+        raise CheckError("unable to read {}: {}".format(path, e))
+    age = now - snapshot.get("timestamp", 0)
+    if age > SNAPSHOT_MAX_AGE:
+        raise CheckError("lease snapshot is {:.0f}s old".format(age))
+    return snapshot
+
+
+def check_fdb(device, snapshot=None, run_json=command_json, direct_routing=False):
+    """Check the VXLAN forwarding state of device.
+
+    Every remote subnet routed over the device needs a neighbour entry for
+    its gateway and an FDB entry for that neighbour's VTEP MAC. With a lease
+    snapshot, every remote lease must also have an FDB entry pointing at its
+    public IP, and FDB entries without a lease are reported as stale. With
+    DirectRouting, flanneld routes peers on the same L2 over the underlay
+    without FDB entries, so only leases routed over the device are compared.
+    Returns: A (status, message) tuple
+    """
+    routes = run_json(["ip", "-j", "route", "show", "dev", device])
+    neigh = run_json(["ip", "-j", "neigh", "show", "dev", device])
+    fdb = run_json(["bridge", "-j", "fdb", "show", "dev", device])
+    if routes is None or neigh is None or fdb is None:
+        raise CheckError("unable to read the state of {}".format(device))
+    neigh_macs = {n["dst"]: n.get("lladdr") for n in neigh if "dst" in n}
+    fdb_dsts = {f["mac"]: f.get("dst") for f in fdb if f.get("dst")}
+
+    missing = []
+    routed = set()
+    for route in routes:
+        routed.add(route.get("dst", "").replace("/", "-"))
+        gateway = route.get("gateway")
+        if not gateway:
+            continue
+        mac = neigh_macs.get(gateway)
+        if not mac:
+            missing.append("neighbour {}".format(gateway))
+        elif mac not in fdb_dsts:
+            missing.append("fdb {}".format(mac))
+
+    stale = []
+    if snapshot is not None:
+        leases = {
+            lease["vtep_mac"]: lease.get("public_ip")
+            for subnet, lease in snapshot["leases"].items()
+            if subnet != snapshot.get("subnet")
+            and lease.get("vtep_mac")
+            and (subnet in routed or not direct_routing)
+        }
+        for mac, public_ip in sorted(leases.items()):
+            if fdb_dsts.get(mac) != public_ip:
+                missing.append("fdb {} -> {}".format(mac, public_ip))
+        stale = sorted(set(fdb_dsts) - set(leases))
+
+    peers = len(fdb_dsts)
+    if missing:
+        return CRITICAL, "{} missing: {}".format(device, ", ".join(missing))
+    if stale:
+        return WARNING, "{} stale fdb entries: {}".format(device, ", ".join(stale))
+    return OK, "{} has {} peers".format(device, peers)
+
+
+def check_lease(snapshot, warn=LEASE_WARN_SECS, crit=LEASE_CRIT_SECS, now=None):
+    """Check how long this node's subnet lease has left.
+
+    The TTL in the snapshot is counted down by the snapshot's age.
+    Returns: A (status, message) tuple
+    """
+    now = time.time() if now is None else now
+    if not snapshot.get("subnet"):
+        return CRITICAL, "no subnet lease held in etcd"
+    if snapshot.get("ttl") is None:
+        return OK, "lease for {} does not expire".format(snapshot["subnet"])
+    ttl = snapshot["ttl"] - (now - snapshot["timestamp"])
+    message = "lease for {} expires in {:.0f}s".format(snapshot["subnet"], ttl)
+    if ttl <= crit:
+        return CRITICAL, message
+    if ttl <= warn:
+        return WARNING, message
+    return OK, message
+
+
+def check_mtu(device, iface, overhead, root="/"):
+    """Check the overlay device MTU leaves room for the encapsulation.
+
+    A device MTU above the underlay MTU less the overhead drops or fragments
+    full sized packets, one below it wastes bandwidth.
+    Returns: A (status, message) tuple
+    """
+    device_mtu = interface_mtu(device, root)
+    underlay_mtu = interface_mtu(iface, root)
+    if device_mtu is None or underlay_mtu is None:
+        raise CheckError("unable to read the MTU of {} or {}".format(device, iface))
+    expected = underlay_mtu - overhead
+    message = "{} MTU {}, {} MTU {}".format(device, device_mtu, iface, underlay_mtu)
+    if device_mtu > expected:
+        return CRITICAL, "{} exceeds {}".format(message, expected)
+    if device_mtu < expected:
+        return WARNING, "{} is below {}".format(message, expected)
+    return OK, message
+
+
+def main(argv=None, run_json=command_json):
+    parser = argparse.ArgumentParser(description="Check the flannel data path.")
+    checks = parser.add_subparsers(dest="check")
+    checks.required = True
+    fdb = checks.add_parser("fdb")
+    fdb.add_argument("--device", required=True)
+    fdb.add_argument("--snapshot")
+    fdb.add_argument("--direct-routing", action="store_true")
+    lease = checks.add_parser("lease")
+    lease.add_argument("--snapshot", required=True)
+    lease.add_argument("--warn", type=int, default=LEASE_WARN_SECS)
+    lease.add_argument("--crit", type=int, default=LEASE_CRIT_SECS)
+    mtu = checks.add_parser("mtu")
+    mtu.add_argument("--device", required=True)
+    mtu.add_argument("--iface", required=True)
+    mtu.add_argument("--overhead", type=int, required=True)
+    args = parser.parse_args(argv)
+
+    try:
+        if args.check == "fdb":
+            snapshot = None
+            if args.snapshot and os.path.exists(args.snapshot):
+                snapshot = load_snapshot(args.snapshot)
+            status, message = check_fdb(
+                args.device, snapshot, run_json, args.direct_routing
+            )
+        elif args.check == "lease":
+            status, message = check_lease(
+                load_snapshot(args.snapshot), args.warn, args.crit
+            )
+        else:
+            status, message = check_mtu(args.device, args.iface, args.overhead)
+    except CheckError as e:
+        status, message = UNKNOWN, str(e)
+    print("FLANNEL {} {}: {}".format(args.check.upper(), STATUS_NAMES[status], message))
+    return status
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,92 @@
+"""The CNI network config list for the flannel network."""
+import json
+import re
+import shlex
+
+from charms.flannel.resources import write_if_changed
+
+
+NETWORK_NAME = "CDK-flannel-network"
+CNI_VERSION = "0.3.1"
+# The tuning plugin only sets sysctls namespaced to the pod's network.
+SYSCTL_NAME = re.compile(r"^net\.[A-Za-z0-9_.\-/]+$")
+
+
+class CNIConfigError(Exception):
+    pass
+
+
+def parse_sysctls(value):
+    """Parse space separated name=value pairs into the tuning plugin sysctls.
+
+    Raises: CNIConfigError if a pair is malformed or outside net.*
+    """
+    sysctls = {}
+    for item in value.split():
+        name, sep, setting = item.partition("=")
+        if not sep or not setting:
+            raise CNIConfigError(
+                "cni-sysctls entry {!r} is not name=value".format(item)
+            )
+        if not SYSCTL_NAME.match(name):
+            raise CNIConfigError(
+                "cni-sysctls {} is not a network namespaced sysctl".format(name)
+            )
+        sysctls[name] = setting
+    return sysctls
+
+
+def parse_conditions(value):
+    """Split portmap iptables match conditions, e.g. "-s 10.0.0.0/8".
+
+    Raises: CNIConfigError if the conditions cannot be split
+    """
+    try:
+        conditions = shlex.split(value)
+    except ValueError as e:
+        raise CNIConfigError("invalid portmap-conditions: {}".format(e)) from e
+    if conditions and not conditions[0].startswith("-"):
+        raise CNIConfigError(
+            "portmap-conditions must start with an iptables option, got {!r}".format(
+                conditions[0]
+            )
+        )
+    return conditions
+
+
+def conflist(mtu=0, hairpin=True, bandwidth=False, sysctls=None, conditions=None):
+    """Returns the CNI network config list for flannel.
+
+    Args:
+        mtu: MTU of pod interfaces, 0 to let the flannel plugin choose
+        hairpin: Whether pods can reach themselves through a service
+        bandwidth: Whether to add the bandwidth plugin, which shapes pod
+            traffic by their kubernetes.io/ingress-bandwidth and
+            egress-bandwidth annotations
+        sysctls: Sysctls the tuning plugin sets in each pod
+        conditions: iptables conditions limiting the portmap DNAT rules
+    """
+    delegate = {"hairpinMode": hairpin, "isDefaultGateway": True}
+    if mtu:
+        delegate["mtu"] = mtu
+    plugins = [{"type": "flannel", "delegate": delegate}]
+    if sysctls:
+        plugins.append({"type": "tuning", "sysctl": sysctls})
+    portmap = {"type": "portmap", "capabilities": {"portMappings": True}, "snat": True}
+    if conditions:
+        portmap["conditionsV4"] = conditions
+    plugins.append(portmap)
+    if bandwidth:
+        plugins.append({"type": "bandwidth", "capabilities": {"bandwidth": True}})
+    return {"name": NETWORK_NAME, "cniVersion": CNI_VERSION, "plugins": plugins}
+
+
+def write_conflist(path, conf):
+    """Write conf to path unless the file already holds it.
+
+    The file is replaced atomically, so the container runtime never reads a
+    partially written config.
+    Returns: Whether the file was written
+    """
+    content = json.dumps(conf, indent=2, sort_keys=True) + "\n"
+    return write_if_changed(path, content.encode("utf-8"))
@@ -1,11 +1,51 @@
-from time import sleep
+import random
+import time
+from functools import wraps
 
 
-def retry(times, delay_secs):
+def backoff_delay(attempt, delay_secs, backoff=1, max_delay_secs=None, jitter=False):
+    """Return the delay before the retry following a failed attempt.
+    Args:
+        attempt: Number of failed attempts before this one, from 0
+        delay_secs, backoff, max_delay_secs, jitter: As for retry
+    """
+    delay = delay_secs * backoff**attempt
+    if max_delay_secs is not None:
+        delay = min(delay, max_delay_secs)
+    if jitter:
+        delay = random.uniform(0, delay)
+    return delay
+
+
+def retry(
+    times,
+    delay_secs,
+    backoff=1,
+    max_delay_secs=None,
+    jitter=False,
+    deadline_secs=None,
+    exceptions=(),
+    on_retry=None,
+    clock=time.monotonic,
+    sleep=time.sleep,
+):
     """Decorator for retrying a method call.
     Args:
         times: How many times should we retry before giving up
-        delay_secs: Delay in secs
+        delay_secs: Delay in secs before the first retry
+        backoff: Factor the delay is multiplied by after each retry
+        max_delay_secs: Upper bound for a single delay
+        jitter: Sleep a random time between 0 and the delay ("full jitter")
+            so units failing together do not retry in lockstep
+        deadline_secs: Give up once this much time has passed since the
+            first call, instead of sleeping past it
+        exceptions: Exception classes that count as a failed attempt. They
+            are re-raised once retries are exhausted. Other exceptions
+            propagate immediately.
+        on_retry: Called as on_retry(attempt, delay, outcome) before each
+            sleep, where outcome is the falsy result or the exception
+        clock: Monotonic time source, injectable for tests
+        sleep: Sleep function, injectable for tests
     Returns: A callable that would return the last call outcome
     """
 
@@ -16,15 +56,33 @@ def retry(times, delay_secs):
         Returns: A callable that would return the last call outcome
         """
 
+        @wraps(func)
         def _wrapped(*args, **kwargs):
-            res = func(*args, **kwargs)
+            start = clock()
             attempt = 0
-            while not res and attempt < times:
-                sleep(delay_secs)
-                res = func(*args, **kwargs)
-                if res:
+            while True:
+                error = None
+                try:
+                    res = func(*args, **kwargs)
+                except exceptions as e:
+                    error = e
+                    res = None
+                if error is None and res:
+                    return res
+                if attempt >= times:
                     break
+                delay = backoff_delay(
+                    attempt, delay_secs, backoff, max_delay_secs, jitter
+                )
+                if deadline_secs is not None:
+                    if clock() - start + delay > deadline_secs:
+                        break
+                if on_retry:
+                    on_retry(attempt + 1, delay, error or res)
+                sleep(delay)
                 attempt += 1
+            if error is not None:
+                raise error
             return res
 
         return _wrapped
@@ -0,0 +1,79 @@
+"""flanneld runtime options and systemd resource controls."""
+import re
+
+
+# flanneld leases a subnet for 24 hours.
+LEASE_MINUTES = 24 * 60
+MIN_NICE, MAX_NICE = -20, 19
+MIN_CPU_WEIGHT, MAX_CPU_WEIGHT = 1, 10000
+CPU_LIST = re.compile(r"^\d+(-\d+)?([ ,]\d+(-\d+)?)*$")
+
+
+class ServiceConfigError(Exception):
+    pass
+
+
+def _check_range(option, value, low, high):
+    if not low <= value <= high:
+        raise ServiceConfigError(
+            "{} must be between {} and {}, got {}".format(option, low, high, value)
+        )
+
+
+def flanneld_args(
+    renew_margin=60, iptables_resync=5, iptables_forward_rules=True, healthz_port=0
+):
+    """Returns the tuning flags for the flanneld command line.
+
+    Args:
+        renew_margin: Minutes before its lease expires that flanneld renews it
+        iptables_resync: Seconds between checks of flanneld's iptables rules
+        iptables_forward_rules: Whether flanneld adds FORWARD ACCEPT rules
+        healthz_port: Port of flanneld's /healthz endpoint, 0 to disable it
+    Raises: ServiceConfigError if an option is out of range
+    """
+    _check_range("subnet-lease-renew-margin", renew_margin, 1, LEASE_MINUTES - 1)
+    _check_range("iptables-resync", iptables_resync, 1, 3600)
+    _check_range("healthz-port", healthz_port, 0, 65535)
+    args = [
+        "--subnet-lease-renew-margin={}".format(renew_margin),
+        "--iptables-resync={}".format(iptables_resync),
+        "--iptables-forward-rules={}".format(str(iptables_forward_rules).lower()),
+    ]
+    if healthz_port:
+        args.append("--healthz-port={}".format(healthz_port))
+    return args
+
+
+def resource_controls(gomaxprocs=0, cpu_affinity="", nice=0, cpu_weight=0):
+    """Returns the systemd [Service] settings limiting flanneld's CPU use.
+
+    Each setting is left out at its default of 0 or "", which keeps the
+    systemd and Go runtime defaults.
+    Args:
+        gomaxprocs: GOMAXPROCS for flanneld
+        cpu_affinity: CPUs flanneld may run on, e.g. "0-1" or "0 2"
+        nice: Scheduling priority, from -20 to 19
+        cpu_weight: Relative CPU share under contention, from 1 to 10000
+    Raises: ServiceConfigError if an option is invalid
+    """
+    controls = {}
+    if gomaxprocs:
+        _check_range("gomaxprocs", gomaxprocs, 1, 1024)
+        controls["gomaxprocs"] = gomaxprocs
+    cpu_affinity = cpu_affinity.strip()
+    if cpu_affinity:
+        if not CPU_LIST.match(cpu_affinity):
+            raise ServiceConfigError(
+                "cpu-affinity must be a list of CPUs or ranges, got {!r}".format(
+                    cpu_affinity
+                )
+            )
+        controls["cpu_affinity"] = cpu_affinity.replace(",", " ")
+    if nice:
+        _check_range("nice", nice, MIN_NICE, MAX_NICE)
+        controls["nice"] = nice
+    if cpu_weight:
+        _check_range("cpu-weight", cpu_weight, MIN_CPU_WEIGHT, MAX_CPU_WEIGHT)
+        controls["cpu_weight"] = cpu_weight
+    return controls
@@ -0,0 +1,279 @@
+import base64
+import http.client
+import json
+import ssl
+from urllib.parse import urlsplit
+
+
+DEFAULT_PORT = 2379
+
+
+class EtcdError(Exception):
+    pass
+
+
+def _encode(value):
+    """Base64 encode a key or value as expected by the etcd JSON gateway."""
+    if isinstance(value, str):
+        value = value.encode("utf-8")
+    return base64.b64encode(value).decode("ascii")
+
+
+def prefix_range_end(prefix):
+    """Return the range_end matching every key that starts with prefix.
+
+    Like etcd's clientv3.GetPrefixRangeEnd, trailing 0xff bytes cannot be
+    incremented and are dropped. A prefix of only 0xff bytes has no end,
+    which etcd spells as a single zero byte.
+    """
+    if isinstance(prefix, str):
+        prefix = prefix.encode("utf-8")
+    prefix = prefix.rstrip(b"\xff")
+    if not prefix:
+        return b"\0"
+    return prefix[:-1] + bytes([prefix[-1] + 1])
+
+
+def _decode(value):
+    """Decode a base64 key or value returned by the etcd JSON gateway."""
+    return base64.b64decode(value or "").decode("utf-8")
+
+
+class EtcdClient:
+    """Small etcd v3 client talking to the etcd HTTP/JSON gateway.
+
+    One connection is kept open and reused for every request, so all calls
+    made during a hook share a single TLS session. When an endpoint cannot be
+    reached the client fails over to the next one in the connection string.
+    """
+
+    def __init__(self, endpoints, cert=None, key=None, ca=None, timeout=10):
+        """
+        Args:
+            endpoints: Comma separated connection string or list of URLs
+            cert: Path to the client certificate
+            key: Path to the client key
+            ca: Path to the CA certificate
+            timeout: Socket timeout in secs
+        """
+        if isinstance(endpoints, str):
+            endpoints = endpoints.split(",")
+        self.endpoints = [e.strip() for e in endpoints if e.strip()]
+        if not self.endpoints:
+            raise EtcdError("No etcd endpoints provided")
+        self.cert = cert
+        self.key = key
+        self.ca = ca
+        self.timeout = timeout
+        self._ssl_context = None
+        self._conn = None
+        self._index = 0
+
+    @property
+    def endpoint(self):
+        """The endpoint currently in use."""
+        return self.endpoints[self._index]
+
+    def _context(self):
+        if self._ssl_context is None:
+            context = ssl.create_default_context(cafile=self.ca)
+            if self.cert:
+                context.load_cert_chain(self.cert, self.key)
+            self._ssl_context = context
+        return self._ssl_context
+
+    def _connect(self, endpoint):
+        url = urlsplit(endpoint)
+        port = url.port or DEFAULT_PORT
+        if url.scheme == "https":
+            return http.client.HTTPSConnection(
+                url.hostname, port, timeout=self.timeout, context=self._context()
+            )
+        return http.client.HTTPConnection(url.hostname, port, timeout=self.timeout)
+
+    def copy(self):
+        """Return a client for the same endpoints with its own connection."""
+        return EtcdClient(self.endpoints, self.cert, self.key, self.ca, self.timeout)
+
+    def close(self):
+        """Close the open connection, if any."""
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+    def _post(self, path, body):
+        """Send a single request on the current connection.
+
+        A kept-alive connection may have been closed by the server since the
+        last request, so a failure on a reused connection is retried once on
+        a fresh connection before the endpoint is considered down.
+        """
+        reused = self._conn is not None
+        while True:
+            if self._conn is None:
+                self._conn = self._connect(self.endpoint)
+            try:
+                self._conn.request(
+                    "POST", path, body, {"Content-Type": "application/json"}
+                )
+                response = self._conn.getresponse()
+                return response.status, response.read()
+            except (OSError, http.client.HTTPException):
+                self.close()
+                if not reused:
+                    raise
+                reused = False
+
+    def request(self, path, payload):
+        """POST a JSON payload to the gateway, failing over between endpoints.
+
+        Args:
+            path: Gateway path, e.g. /v3/kv/put
+            payload: JSON serialisable request body
+        Returns: The decoded JSON response
+        """
+        body = json.dumps(payload)
+        errors = []
+        for _ in range(len(self.endpoints)):
+            try:
+                status, data = self._post(path, body)
+            except (OSError, http.client.HTTPException) as e:
+                errors.append("{}: {}".format(self.endpoint, e))
+                self._index = (self._index + 1) % len(self.endpoints)
+                continue
+            if status != 200:
+                raise EtcdError(
+                    "{} {} returned {}: {}".format(
+                        self.endpoint, path, status, data.decode("utf-8", "replace")
+                    )
+                )
+            try:
+                return json.loads(data or b"{}")
+            except ValueError as e:
+                raise EtcdError(
+                    "{} {} returned invalid JSON: {}".format(self.endpoint, path, e)
+                ) from e
+        raise EtcdError("No etcd endpoint reachable: " + "; ".join(errors))
+
+    def put(self, key, value):
+        """Store value under key."""
+        payload = {"key": _encode(key), "value": _encode(value)}
+        return self.request("/v3/kv/put", payload)
+
+    def put_if_revision(self, key, value, mod_revision):
+        """Store value under key only if the key is still at mod_revision.
+
+        A mod_revision of 0 matches a key that does not exist yet.
+
+        Returns: True if the write was applied
+        """
+        key = _encode(key)
+        payload = {
+            "compare": [
+                {
+                    "key": key,
+                    "target": "MOD",
+                    "result": "EQUAL",
+                    "mod_revision": str(mod_revision),
+                }
+            ],
+            "success": [{"request_put": {"key": key, "value": _encode(value)}}],
+        }
+        return bool(self.request("/v3/kv/txn", payload).get("succeeded"))
+
+    def get(self, key):
+        """Fetch a single key.
+
+        Returns: A dict with key, value and mod_revision, or None if the key
+        does not exist
+        """
+        kvs = self.range(key)["kvs"]
+        return kvs[0] if kvs else None
+
+    def count(self, prefix):
+        """Return the number of keys starting with prefix."""
+        payload = {
+            "key": _encode(prefix),
+            "range_end": _encode(prefix_range_end(prefix)),
+            "count_only": True,
+        }
+        return int(self.request("/v3/kv/range", payload).get("count", 0))
+
+    def range(self, key, range_end=None, limit=0, revision=0):
+        """Fetch the keys in [key, range_end).
+
+        Args:
+            key: First key, or the only key without range_end
+            range_end: End of the range, exclusive
+            limit: Return at most this many keys, 0 for no limit
+            revision: Read the keys as of this revision, 0 for the latest
+        Returns: The gateway response with kvs decoded
+        """
+        payload = {"key": _encode(key)}
+        if range_end is not None:
+            payload["range_end"] = _encode(range_end)
+        if limit:
+            payload["limit"] = limit
+        if revision:
+            payload["revision"] = str(revision)
+        response = self.request("/v3/kv/range", payload)
+        response["kvs"] = [
+            {
+                "key": _decode(kv.get("key")),
+                "value": _decode(kv.get("value")),
+                "mod_revision": int(kv.get("mod_revision", 0)),
+                "lease": kv.get("lease"),
+            }
+            for kv in response.get("kvs", [])
+        ]
+        return response
+
+    def iter_prefix(self, prefix, page_size=500):
+        """Yield the keys starting with prefix, page_size keys per request.
+
+        Every page is read at the revision of the first, so the keys form a
+        consistent snapshot however many pages there are.
+        """
+        key, range_end, revision = prefix, prefix_range_end(prefix), 0
+        while True:
+            response = self.range(key, range_end, page_size, revision)
+            yield from response["kvs"]
+            if not response.get("more") or not response["kvs"]:
+                return
+            revision = int(response["header"]["revision"])
+            key = response["kvs"][-1]["key"] + "\0"
+
+    def delete_if_revisions(self, keys):
+        """Delete keys in one transaction, if none changed since read.
+
+        Args:
+            keys: A list of (key, mod_revision) tuples
+        Returns: True if the keys were deleted, False if any had changed
+        """
+        compare = [
+            {
+                "key": _encode(key),
+                "target": "MOD",
+                "result": "EQUAL",
+                "mod_revision": str(mod_revision),
+            }
+            for key, mod_revision in keys
+        ]
+        success = [{"request_delete_range": {"key": c["key"]}} for c in compare]
+        payload = {"compare": compare, "success": success}
+        return bool(self.request("/v3/kv/txn", payload).get("succeeded"))
+
+
+_clients = {}
+
+
+def get_client(endpoints, cert=None, key=None, ca=None, timeout=10):
+    """Return a shared client for the given connection details.
+
+    Clients are pooled for the lifetime of the hook process so retries and
+    subsequent handlers reuse the already established connection.
+    """
+    cache_key = (endpoints, cert, key, ca, timeout)
+    if cache_key not in _clients:
+        _clients[cache_key] = EtcdClient(endpoints, cert, key, ca, timeout)
+    return _clients[cache_key]
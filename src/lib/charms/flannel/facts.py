@@ -0,0 +1,26 @@
+import json
+
+
+FACT_PREFIX = "flannel.fact."
+
+
+def cached_fact(kv, name, key, compute):
+    """Return a fact about the machine, computing it only when it is stale.
+
+    The fact is stored in kv along with the key it was computed for, and is
+    recomputed when called with a different key.
+    Args:
+        kv: The unitdata store
+        name: Name of the fact
+        key: JSON serialisable invalidation key, None for facts that never
+            change
+        compute: Called without arguments to compute the fact
+    Returns: The fact
+    """
+    key = json.dumps(key, sort_keys=True)
+    stored = kv.get(FACT_PREFIX + name)
+    if stored is not None and stored["key"] == key:
+        return stored["value"]
+    value = compute()
+    kv.set(FACT_PREFIX + name, {"key": key, "value": value})
+    return value
@@ -0,0 +1,185 @@
+"""Inspection and reclaiming of the subnet leases flanneld keeps in etcd."""
+import ipaddress
+import json
+import threading
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+from charms.flannel.etcd import EtcdClient
+
+
+SUBNET_LEASE_PREFIX = "/coreos.com/network/subnets/"
+# unitdata key of the etcd connection the charm configured flanneld with.
+ETCD_SETTINGS_KEY = "flannel.etcd"
+PAGE_SIZE = 500
+# Keys deleted per transaction. Each key adds a compare and a delete, which
+# keeps a batch below etcd's default --max-txn-ops of 128.
+DELETE_BATCH = 50
+# flanneld renews its lease when subnet-lease-renew-margin minutes are left,
+# an hour by default, so the lease of a live node never drops much below
+# that. A sixth of the margin is allowed for a slow renewal.
+DEFAULT_RENEW_MARGIN = 60
+# etcd has no batch form of timetolive, so each lease costs a request. They
+# are spread over this many connections rather than made one at a time.
+TTL_WORKERS = 8
+
+Lease = namedtuple("Lease", "subnet public_ip vtep_mac ttl key mod_revision")
+
+
+class LeaseError(Exception):
+    pass
+
+
+def subnet_lease_key(subnet):
+    """Return the etcd key of the lease for a subnet such as 10.1.5.1/24."""
+    network = ipaddress.ip_interface(str(subnet)).network
+    return "{}{}-{}".format(
+        SUBNET_LEASE_PREFIX, network.network_address, network.prefixlen
+    )
+
+
+def lease_subnet(key):
+    """Return the subnet part of a lease key, e.g. 10.1.5.0-24."""
+    return key.rsplit("/", 1)[-1]
+
+
+def lease_ttl(client, kv):
+    """Return the remaining TTL of the etcd lease attached to kv, or None."""
+    if not kv.get("lease"):
+        return None
+    response = client.request("/v3/lease/timetolive", {"ID": kv["lease"]})
+    ttl = int(response.get("TTL", -1))
+    return ttl if ttl >= 0 else None
+
+
+def lease_ttls(client, lease_ids, workers=TTL_WORKERS):
+    """Return a dict of etcd lease ID to remaining TTL, or None if expired.
+
+    The lookups run concurrently, each worker thread on its own copy of
+    client so that the connections are not shared.
+    """
+    lease_ids = sorted(set(lease_ids))
+    if workers <= 1 or len(lease_ids) <= 1:
+        return {i: lease_ttl(client, {"lease": i}) for i in lease_ids}
+    local = threading.local()
+    clients = []
+
+    def lookup(lease_id):
+        if not hasattr(local, "client"):
+            local.client = client.copy()
+            clients.append(local.client)
+        return lease_ttl(local.client, {"lease": lease_id})
+
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            return dict(zip(lease_ids, pool.map(lookup, lease_ids)))
+    finally:
+        for worker_client in clients:
+            worker_client.close()
+
+
+def stale_ttl(renew_margin=DEFAULT_RENEW_MARGIN):
+    """Return the TTL in secs below which flanneld would have renewed a lease.
+
+    Args:
+        renew_margin: flanneld's subnet-lease-renew-margin, in minutes
+    """
+    return renew_margin * 60 * 5 // 6
+
+
+def stale_threshold(settings, max_ttl=0):
+    """Return the max-ttl for reclaiming leases with the stored settings.
+
+    Args:
+        settings: The ETCD_SETTINGS_KEY settings
+        max_ttl: An explicit threshold in secs, 0 to derive it
+    Raises: LeaseError if max_ttl would catch the lease of a live node
+    """
+    renew_margin = settings.get("renew_margin") or DEFAULT_RENEW_MARGIN
+    if not max_ttl:
+        return stale_ttl(renew_margin)
+    if max_ttl >= renew_margin * 60:
+        raise LeaseError(
+            "max-ttl must be below the {} secs subnet-lease-renew-margin, "
+            "or live leases would be reclaimed".format(renew_margin * 60)
+        )
+    return max_ttl
+
+
+def etcd_client(kv):
+    """Return a client for the etcd flanneld uses, or None without etcd."""
+    settings = kv.get(ETCD_SETTINGS_KEY)
+    if not settings:
+        return None
+    return EtcdClient(
+        settings["connection_string"], settings["cert"], settings["key"], settings["ca"]
+    )
+
+
+def list_leases(client, page_size=PAGE_SIZE):
+    """Yield a Lease for every subnet lease in etcd.
+
+    Args:
+        client: A charms.flannel.etcd.EtcdClient
+        page_size: Number of keys read per request
+    """
+    kvs = list(client.iter_prefix(SUBNET_LEASE_PREFIX, page_size))
+    ttls = lease_ttls(client, [kv["lease"] for kv in kvs if kv.get("lease")])
+    for kv in kvs:
+        try:
+            value = json.loads(kv["value"])
+        except ValueError:
+            value = {}
+        yield Lease(
+            subnet=lease_subnet(kv["key"]),
+            public_ip=value.get("PublicIP"),
+            vtep_mac=(value.get("BackendData") or {}).get("VtepMAC"),
+            ttl=ttls.get(kv.get("lease")),
+            key=kv["key"],
+            mod_revision=kv["mod_revision"],
+        )
+
+
+def stale_leases(leases, max_ttl=stale_ttl(), keep=()):
+    """Return the leases a live flanneld would already have renewed.
+
+    Args:
+        leases: Leases from list_leases
+        max_ttl: Leases with fewer secs than this left are stale
+        keep: Subnets never to consider stale, such as this node's
+    """
+    return [
+        lease
+        for lease in leases
+        if lease.ttl is not None and lease.ttl < max_ttl and lease.subnet not in keep
+    ]
+
+
+def reclaim_leases(client, leases, batch_size=DELETE_BATCH):
+    """Delete leases from etcd in batched transactions.
+
+    A lease renewed since it was read is left alone. Its batch is then
+    retried one lease at a time so the others are still deleted.
+    Returns: The leases that were deleted
+    """
+    reclaimed = []
+    for start in range(0, len(leases), batch_size):
+        end = start + batch_size
+        batch = leases[start:end]
+        if client.delete_if_revisions([(x.key, x.mod_revision) for x in batch]):
+            reclaimed.extend(batch)
+            continue
+        for lease in batch:
+            if client.delete_if_revisions([(lease.key, lease.mod_revision)]):
+                reclaimed.append(lease)
+    return reclaimed
+
+
+def format_leases(leases):
+    """Render leases as one line each, for action output."""
+    return "\n".join(
+        "{} {} {} ttl={}".format(
+            lease.subnet, lease.public_ip, lease.vtep_mac or "-", lease.ttl
+        )
+        for lease in leases
+    )
@@ -0,0 +1,311 @@
+"""Prometheus textfile collector for flannel.
+
+Runs from a systemd timer installed by the charm and only needs the standard
+library and charms.flannel, so it can run outside the charm's venv:
+
+    PYTHONPATH=$CHARM_DIR/lib python3 -m charms.flannel.metrics --output FILE
+
+The same timer saves a snapshot of the etcd subnet leases for the NRPE
+checks, which run unprivileged and cannot read the etcd credentials.
+"""
+import argparse
+import json
+import os
+import tempfile
+import time
+from subprocess import CalledProcessError, check_output
+
+from charms.flannel.etcd import EtcdClient, EtcdError
+from charms.flannel.leases import SUBNET_LEASE_PREFIX, lease_subnet, lease_ttl
+from charms.flannel.leases import subnet_lease_key
+from charms.flannel.subnet_env import SUBNET_ENV_PATH, read_subnet_env
+
+
+STATE_DIR = "/var/lib/charm-flannel"
+HANDLER_TIMINGS_PATH = os.path.join(STATE_DIR, "handler-timings.json")
+LEASE_SNAPSHOT_PATH = os.path.join(STATE_DIR, "leases.json")
+# This node's lease TTL, for the exporter when there is no lease snapshot.
+LEASE_TTL_PATH = os.path.join(STATE_DIR, "lease-ttl.json")
+# Reading every lease is costly on large clusters, so refresh them slowly.
+# The TTL of this node's lease is looked up no more often either.
+LEASE_SNAPSHOT_INTERVAL = 300
+
+# Devices created by flanneld for its backends and by the CNI bridge.
+DEVICE_PREFIXES = ("flannel.", "flannel-wg", "cni0")
+STATISTICS = (
+    "rx_bytes",
+    "tx_bytes",
+    "rx_packets",
+    "tx_packets",
+    "rx_dropped",
+    "tx_dropped",
+)
+
+
+def _read(path):
+    with open(path) as f:
+        return f.read().strip()
+
+
+def overlay_devices(root="/"):
+    """Return the names of the flannel owned network devices."""
+    try:
+        names = os.listdir(os.path.join(root, "sys/class/net"))
+    except FileNotFoundError:
+        return []
+    return sorted(n for n in names if n.startswith(DEVICE_PREFIXES))
+
+
+def device_metrics(root="/"):
+    """Yield (name, labels, value) for the counters of each overlay device."""
+    for device in overlay_devices(root):
+        stats = os.path.join(root, "sys/class/net", device, "statistics")
+        for stat in STATISTICS:
+            try:
+                value = int(_read(os.path.join(stats, stat)))
+            except (OSError, ValueError):
+                continue
+            yield "flannel_device_{}_total".format(stat), {"device": device}, value
+
+
+def _own_subnet(root):
+    """Return the subnet flanneld leased for this node, or None."""
+    env = read_subnet_env(os.path.join(root, SUBNET_ENV_PATH.lstrip("/")))
+    return env.subnet if env else None
+
+
+def _recent_ttl(path, subnet, now):
+    """Return the TTL of subnet's lease from a recent record at path, or None.
+
+    The record is a lease snapshot, or one written by lease_metrics, and its
+    TTL is counted down by the record's age.
+    """
+    try:
+        with open(path) as f:
+            record = json.load(f)
+    except (OSError, ValueError):
+        return None
+    age = now - record.get("timestamp", 0)
+    if record.get("subnet") != subnet or record.get("ttl") is None:
+        return None
+    if not 0 <= age < LEASE_SNAPSHOT_INTERVAL:
+        return None
+    return max(round(record["ttl"] - age), 0)
+
+
+def lease_metrics(root="/", client=None, now=None, snapshot_path=None, ttl_path=None):
+    """Yield metrics describing this node's subnet lease.
+
+    The lease age is taken from when flanneld last wrote subnet.env. The time
+    to expiry needs the etcd lease and is only reported when a client is
+    given. It is taken from a recent lease snapshot or ttl_path when there is
+    one, so that etcd is asked at most every LEASE_SNAPSHOT_INTERVAL secs.
+    Args:
+        snapshot_path: Lease snapshot written by write_lease_snapshot
+        ttl_path: Where to keep the TTL looked up from etcd
+    """
+    now = time.time() if now is None else now
+    path = os.path.join(root, SUBNET_ENV_PATH.lstrip("/"))
+    try:
+        mtime = os.stat(path).st_mtime
+    except FileNotFoundError:
+        yield "flannel_subnet_lease_present", {}, 0
+        return
+    yield "flannel_subnet_lease_present", {}, 1
+    yield "flannel_subnet_lease_age_seconds", {}, round(now - mtime, 3)
+    subnet = _own_subnet(root)
+    if client is None or not subnet:
+        return
+    key = subnet_lease_key(subnet)
+    for path in (snapshot_path, ttl_path):
+        ttl = _recent_ttl(path, lease_subnet(key), now) if path else None
+        if ttl is not None:
+            yield "flannel_subnet_lease_expiry_seconds", {}, ttl
+            return
+    kv = client.get(key)
+    ttl = lease_ttl(client, kv) if kv else None
+    if ttl_path:
+        record = {"timestamp": now, "subnet": lease_subnet(key), "ttl": ttl}
+        write_textfile(ttl_path, json.dumps(record, sort_keys=True))
+    if ttl is not None:
+        yield "flannel_subnet_lease_expiry_seconds", {}, ttl
+
+
+def write_lease_snapshot(client, root="/", path=LEASE_SNAPSHOT_PATH, now=None):
+    """Save the subnet leases held in etcd and the TTL of this node's lease.
+
+    The snapshot is refreshed at most every LEASE_SNAPSHOT_INTERVAL secs.
+    """
+    now = time.time() if now is None else now
+    try:
+        if now - os.stat(path).st_mtime < LEASE_SNAPSHOT_INTERVAL:
+            return
+    except FileNotFoundError:
+        pass
+    own = _own_subnet(root)
+    own_key = subnet_lease_key(own) if own else None
+    snapshot = {"timestamp": now, "subnet": None, "ttl": None, "leases": {}}
+    for kv in client.iter_prefix(SUBNET_LEASE_PREFIX):
+        subnet = lease_subnet(kv["key"])
+        try:
+            value = json.loads(kv["value"])
+        except ValueError:
+            value = {}
+        snapshot["leases"][subnet] = {
+            "public_ip": value.get("PublicIP"),
+            "vtep_mac": (value.get("BackendData") or {}).get("VtepMAC"),
+        }
+        if kv["key"] == own_key:
+            snapshot["subnet"] = subnet
+            snapshot["ttl"] = lease_ttl(client, kv)
+    write_textfile(path, json.dumps(snapshot, sort_keys=True))
+
+
+def command_json(cmd):
+    """Run cmd and return its JSON output, or None if it fails."""
+    try:
+        return json.loads(check_output(cmd) or b"[]")
+    except (OSError, CalledProcessError, ValueError):
+        return None
+
+
+def neighbour_metrics(root="/", run_json=command_json):
+    """Yield the number of FDB and neighbour entries on each VXLAN device."""
+    for device in overlay_devices(root):
+        if not device.startswith("flannel."):
+            continue
+        labels = {"device": device}
+        fdb = run_json(["bridge", "-j", "fdb", "show", "dev", device])
+        if fdb is not None:
+            yield "flannel_fdb_entries", labels, len(fdb)
+        neigh = run_json(["ip", "-j", "neigh", "show", "dev", device])
+        if neigh is not None:
+            yield "flannel_neighbour_entries", labels, len(neigh)
+
+
+def handler_metrics(path=HANDLER_TIMINGS_PATH):
+    """Yield the timings recorded for the charm's reactive handlers."""
+    try:
+        with open(path) as f:
+            timings = json.load(f)
+    except (FileNotFoundError, ValueError):
+        return
+    prefix = "flannel_charm_handler_"
+    for handler, timing in sorted(timings.items()):
+        labels = {"handler": handler}
+        yield prefix + "duration_seconds", labels, timing["duration"]
+        yield prefix + "runs_total", labels, timing["runs"]
+        yield prefix + "last_run_timestamp_seconds", labels, timing["timestamp"]
+
+
+def format_metrics(metrics):
+    """Render (name, labels, value) tuples in the Prometheus text format."""
+    lines = []
+    for name, labels, value in metrics:
+        if labels:
+            label_text = ",".join(
+                '{}="{}"'.format(k, v) for k, v in sorted(labels.items())
+            )
+            name = "{}{{{}}}".format(name, label_text)
+        lines.append("{} {}".format(name, value))
+    return "\n".join(lines) + "\n"
+
+
+def write_textfile(path, text):
+    """Atomically replace path so the collector never reads a partial file."""
+    directory = os.path.dirname(path)
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=directory, prefix=".flannel-", suffix=".tmp")
+    with os.fdopen(fd, "w") as f:
+        f.write(text)
+    os.chmod(tmp, 0o644)
+    os.replace(tmp, path)
+
+
+def record_handler_time(handler, duration, path=HANDLER_TIMINGS_PATH):
+    """Store the duration of a reactive handler run for the exporter."""
+    try:
+        with open(path) as f:
+            timings = json.load(f)
+    except (FileNotFoundError, ValueError):
+        timings = {}
+    timing = timings.setdefault(handler, {"runs": 0})
+    timing["duration"] = round(duration, 6)
+    timing["runs"] += 1
+    timing["timestamp"] = round(time.time(), 3)
+    write_textfile(path, json.dumps(timings, sort_keys=True))
+
+
+def time_handlers(handler_class, module, path=HANDLER_TIMINGS_PATH, log=None):
+    """Record how long each reactive handler defined in module takes.
+
+    Wraps Handler.invoke of charms.reactive, since decorating the handlers
+    themselves would change how charms.reactive identifies them.
+    """
+    invoke = handler_class.invoke
+
+    def timed_invoke(self):
+        action = getattr(self, "_action", None)
+        if getattr(action, "__module__", None) != module:
+            return invoke(self)
+        start = time.monotonic()
+        try:
+            return invoke(self)
+        finally:
+            try:
+                record_handler_time(action.__name__, time.monotonic() - start, path)
+            except OSError as e:
+                if log:
+                    log("Unable to record handler timing: {}".format(e))
+
+    handler_class.invoke = timed_invoke
+
+
+def collect(
+    root="/",
+    client=None,
+    timings_path=HANDLER_TIMINGS_PATH,
+    snapshot_path=None,
+    ttl_path=LEASE_TTL_PATH,
+):
+    """Return all flannel metrics as a list of (name, labels, value)."""
+    metrics = list(device_metrics(root))
+    metrics.extend(neighbour_metrics(root))
+    lease = []
+    try:
+        lease.extend(lease_metrics(root, client, None, snapshot_path, ttl_path))
+    except EtcdError:
+        # Still report what is known locally when etcd is unreachable.
+        lease.append(("flannel_subnet_lease_lookup_failed", {}, 1))
+    metrics.extend(lease)
+    metrics.extend(handler_metrics(timings_path))
+    return metrics
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Write flannel metrics.")
+    parser.add_argument("--output", help="Prometheus textfile to write")
+    parser.add_argument("--lease-snapshot", help="lease snapshot for the checks")
+    parser.add_argument("--etcd-endpoints")
+    parser.add_argument("--etcd-cert")
+    parser.add_argument("--etcd-key")
+    parser.add_argument("--etcd-ca")
+    args = parser.parse_args(argv)
+    client = None
+    if args.etcd_endpoints:
+        client = EtcdClient(
+            args.etcd_endpoints, args.etcd_cert, args.etcd_key, args.etcd_ca
+        )
+    if client and args.lease_snapshot:
+        try:
+            write_lease_snapshot(client, path=args.lease_snapshot)
+        except EtcdError as e:
+            # Leave the old snapshot; the checks report it as stale.
+            print("Unable to read flannel leases: {}".format(e))
+    if args.output:
+        metrics = collect(client=client, snapshot_path=args.lease_snapshot)
+        write_textfile(args.output, format_metrics(metrics))
+
+
+if __name__ == "__main__":
+    main()
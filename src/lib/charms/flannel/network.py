@@ -0,0 +1,295 @@
+import ipaddress
+from collections import namedtuple
+
+
+MIN_MTU = 1280
+
+# flannel's default size of the subnet leased to each node.
+DEFAULT_SUBNET_LEN = {4: 24, 6: 64}
+
+BACKENDS = ("vxlan", "host-gw", "wireguard")
+
+# Bytes added to every packet by each backend's encapsulation, keyed by the
+# IP version of the underlay. VXLAN adds the outer IP header plus 8 bytes UDP,
+# 8 bytes VXLAN and 14 bytes inner Ethernet header. WireGuard adds the outer
+# IP header, 8 bytes UDP and 32 bytes of WireGuard framing. host-gw routes
+# pod traffic natively.
+OVERHEAD = {
+    "vxlan": {4: 50, 6: 70},
+    "host-gw": {4: 0, 6: 0},
+    "wireguard": {4: 60, 6: 80},
+}
+
+
+class NetworkConfigError(Exception):
+    pass
+
+
+class InvalidMTU(NetworkConfigError):
+    pass
+
+
+class InvalidBackend(NetworkConfigError):
+    pass
+
+
+class InvalidCIDR(NetworkConfigError):
+    pass
+
+
+class SubnetPoolExhausted(NetworkConfigError):
+    pass
+
+
+SubnetPlan = namedtuple(
+    "SubnetPlan", "network subnet_len subnet_min subnet_max max_nodes pods_per_node"
+)
+
+
+def node_subnet_len(network, subnet_len=0):
+    """Return the prefix length of the node subnets of network.
+
+    Like flanneld, a network too small for the default length is split in
+    two. As the subnet-len option defaults to 24, that length counts as the
+    default as well.
+    Args:
+        network: An ip_network
+        subnet_len: Prefix length asked for, 0 for the default
+    """
+    default = DEFAULT_SUBNET_LEN[network.version]
+    if subnet_len and subnet_len != default:
+        return subnet_len
+    return default if network.prefixlen < default else network.prefixlen + 1
+
+
+def parse_cidrs(value, subnet_len=0):
+    """Parse the cidr config option.
+
+    The option holds one IPv4 network, one IPv6 network, or both separated by
+    a comma for a dual-stack cluster.
+    Args:
+        value: The comma separated cidr string
+        subnet_len: Size of the IPv4 node subnets, 0 for flannel's default
+    Returns: A tuple (ipv4, ipv6) of ip_network objects, either may be None
+    Raises: InvalidCIDR if the value is malformed, overlapping, or too small
+        to hold a node subnet
+    """
+    networks = {4: None, 6: None}
+    for item in (value or "").split(","):
+        item = item.strip()
+        if not item:
+            continue
+        try:
+            network = ipaddress.ip_network(item)
+        except ValueError as e:
+            raise InvalidCIDR("invalid cidr {!r}: {}".format(item, e)) from e
+        existing = networks[network.version]
+        if existing is not None:
+            if network.overlaps(existing):
+                raise InvalidCIDR("{} overlaps {}".format(network, existing))
+            raise InvalidCIDR(
+                "cidr may contain only one IPv{} network".format(network.version)
+            )
+        length = node_subnet_len(network, subnet_len if network.version == 4 else 0)
+        if network.prefixlen >= length:
+            raise InvalidCIDR(
+                "{} is too small for /{} node subnets".format(network, length)
+            )
+        networks[network.version] = network
+    if networks[4] is None and networks[6] is None:
+        raise InvalidCIDR("cidr must contain at least one network")
+    return networks[4], networks[6]
+
+
+def _subnet_address(value, network, size, option):
+    """Parse a subnet-min/subnet-max address and check it starts a subnet."""
+    try:
+        address = ipaddress.ip_address(value)
+    except ValueError as e:
+        raise InvalidCIDR("invalid {} {!r}".format(option, value)) from e
+    if address not in network:
+        raise InvalidCIDR("{} {} is outside {}".format(option, address, network))
+    if (int(address) - int(network.network_address)) % size:
+        raise InvalidCIDR("{} {} is not a subnet boundary".format(option, address))
+    return address
+
+
+def plan_subnets(network, subnet_len=0, subnet_min="", subnet_max=""):
+    """Work out how a network is split into node subnets.
+
+    Mirrors flanneld's defaults: the first subnet of the network is never
+    leased and the last one is.
+    Args:
+        network: The cluster network, as a string or ip_network
+        subnet_len: Prefix length of each node subnet, 0 for the default
+        subnet_min: First subnet that may be leased, "" for the default
+        subnet_max: Last subnet that may be leased, "" for the default
+    Returns: A SubnetPlan with the node and per-node pod capacity
+    Raises: InvalidCIDR if the options do not fit the network
+    """
+    network = ipaddress.ip_network(network)
+    subnet_len = node_subnet_len(network, subnet_len)
+    # Leave room for at least one pod next to the network, broadcast and
+    # gateway addresses.
+    longest = network.max_prefixlen - 2
+    if not network.prefixlen < subnet_len <= longest:
+        raise InvalidCIDR(
+            "subnet-len must be between {} and {} for {}".format(
+                network.prefixlen + 1, longest, network
+            )
+        )
+    size = 2 ** (network.max_prefixlen - subnet_len)
+    first = network.network_address + size
+    last = network.broadcast_address - size + 1
+    if subnet_min:
+        first = _subnet_address(subnet_min, network, size, "subnet-min")
+    if subnet_max:
+        last = _subnet_address(subnet_max, network, size, "subnet-max")
+    if first > last:
+        raise InvalidCIDR("subnet-min {} is after subnet-max {}".format(first, last))
+    max_nodes = (int(last) - int(first)) // size + 1
+    # The network, broadcast and cni0 gateway addresses are not usable by pods.
+    pods_per_node = size - 3
+    return SubnetPlan(network, subnet_len, first, last, max_nodes, pods_per_node)
+
+
+def network_config(cidr, backend, subnet_len=0, subnet_min="", subnet_max=""):
+    """Build the flannel network config.
+    Args:
+        cidr: The cidr config option, see parse_cidrs
+        backend: The Backend section, see backend_config
+        subnet_len: IPv4 node subnet length, see plan_subnets
+        subnet_min: First IPv4 subnet to lease, see plan_subnets
+        subnet_max: Last IPv4 subnet to lease, see plan_subnets
+    Returns: The network config dict
+    """
+    ipv4, ipv6 = parse_cidrs(cidr, subnet_len)
+    config = {"Backend": backend}
+    if ipv4:
+        plan = plan_subnets(ipv4, subnet_len, subnet_min, subnet_max)
+        config["Network"] = str(ipv4)
+        config["SubnetLen"] = plan.subnet_len
+        if subnet_min:
+            config["SubnetMin"] = str(plan.subnet_min)
+        if subnet_max:
+            config["SubnetMax"] = str(plan.subnet_max)
+    else:
+        config["EnableIPv4"] = False
+    if ipv6:
+        config["EnableIPv6"] = True
+        config["IPv6Network"] = str(ipv6)
+        config["IPv6SubnetLen"] = node_subnet_len(ipv6)
+    return config
+
+
+def check_lease_capacity(plan, leases):
+    """Refuse a subnet plan that cannot hold the leases already handed out.
+    Args:
+        plan: The SubnetPlan about to be applied
+        leases: Number of subnet leases currently held
+    Raises: SubnetPoolExhausted if the plan has fewer subnets than leases
+    """
+    if leases > plan.max_nodes:
+        raise SubnetPoolExhausted(
+            "{} node subnets in use but only {} available; increase cidr or"
+            " reduce subnet-len".format(leases, plan.max_nodes)
+        )
+
+
+def normalize_cidr(cidr):
+    """Return the cidr option with the IPv4 network first."""
+    return ",".join(str(n) for n in parse_cidrs(cidr) if n)
+
+
+def overlay_mtu(underlay_mtu, ipv6=False, backend="vxlan"):
+    """Return the largest pod MTU that fits in the underlay once encapsulated.
+    Args:
+        underlay_mtu: MTU of the interface flannel is bound to
+        ipv6: Whether the underlay carries the tunnel over IPv6
+        backend: The flannel backend type
+    Returns: The MTU to use inside the overlay
+    """
+    return underlay_mtu - OVERHEAD[backend][6 if ipv6 else 4]
+
+
+def pod_mtu(underlay_mtu, override=0, ipv6=False, backend="vxlan"):
+    """Return the MTU pods should use, honouring an operator override.
+    Args:
+        underlay_mtu: MTU of the underlay interface, or None if unknown
+        override: MTU requested through config, 0 for automatic
+        ipv6: Whether the underlay carries the tunnel over IPv6
+        backend: The flannel backend type
+    Returns: The pod MTU, or None if it cannot be determined
+    Raises: InvalidMTU if the override cannot work on this underlay
+    """
+    if override:
+        if override < MIN_MTU:
+            raise InvalidMTU("mtu must be at least {}".format(MIN_MTU))
+        if underlay_mtu:
+            largest = overlay_mtu(underlay_mtu, ipv6, backend)
+            if override > largest:
+                raise InvalidMTU(
+                    "mtu {} exceeds the largest MTU the {} overlay can carry,"
+                    " {}".format(override, backend, largest)
+                )
+        return override
+    if not underlay_mtu:
+        return None
+    return overlay_mtu(underlay_mtu, ipv6, backend)
+
+
+def backend_config(
+    backend="vxlan",
+    vni=0,
+    port=0,
+    direct_routing=False,
+    gbp=False,
+    learning=False,
+    keepalive=0,
+):
+    """Build the Backend section of the flannel network config.
+    Args:
+        backend: One of BACKENDS
+        vni: VXLAN network id, 0 for flannel's default
+        port: UDP port of the vxlan or wireguard tunnel, 0 for the default
+        direct_routing: Route directly between hosts on the same subnet
+            instead of encapsulating (vxlan)
+        gbp: Enable VXLAN Group Based Policy (vxlan)
+        learning: Enable VXLAN source address learning (vxlan)
+        keepalive: WireGuard PersistentKeepaliveInterval in secs, 0 disables
+    Returns: A dict for the Backend key
+    Raises: InvalidBackend if the backend or its options are not valid
+    """
+    if backend not in BACKENDS:
+        raise InvalidBackend(
+            "backend must be one of {}, not {!r}".format(", ".join(BACKENDS), backend)
+        )
+    config = {"Type": backend}
+    if backend == "vxlan":
+        if vni:
+            config["VNI"] = vni
+        if port:
+            config["Port"] = port
+        if direct_routing:
+            config["DirectRouting"] = True
+        if gbp:
+            config["GBP"] = True
+        if learning:
+            config["Learning"] = True
+    elif backend == "wireguard":
+        if port:
+            config["ListenPort"] = port
+        if keepalive < 0:
+            raise InvalidBackend("wireguard-persistent-keepalive must be positive")
+        if keepalive:
+            config["PersistentKeepaliveInterval"] = keepalive
+    return config
+
+
+def backend_interfaces(backend="vxlan", vni=0):
+    """Return the network devices flanneld creates for a backend."""
+    if backend == "vxlan":
+        return ["flannel.{}".format(vni or 1)]
+    if backend == "wireguard":
+        return ["flannel-wg", "flannel-wg-v6"]
+    return []
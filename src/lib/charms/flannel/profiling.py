@@ -0,0 +1,47 @@
+"""Opt-in cProfile output for charm hook runs.
+
+Profiling is enabled by setting FLANNEL_PROFILE_DIR in the hook environment,
+for example:
+
+    juju exec --unit flannel/0 -- \\
+        FLANNEL_PROFILE_DIR=/var/log/flannel-profiles hooks/update-status
+
+Each hook run then writes <dir>/<hook>-<timestamp>.prof, which can be read
+with `python3 -m pstats` or snakeviz.
+"""
+import cProfile
+import os
+import time
+
+
+PROFILE_ENV = "FLANNEL_PROFILE_DIR"
+
+
+def profile_path(directory, hook):
+    stamp = time.strftime("%Y%m%dT%H%M%S")
+    return os.path.join(directory, "{}-{}-{}.prof".format(hook, stamp, os.getpid()))
+
+
+def profile_hook(hook, register_atexit, environ=os.environ):
+    """Profile the rest of the hook run if FLANNEL_PROFILE_DIR is set.
+
+    Args:
+        hook: Name of the running hook, used to name the output file
+        register_atexit: Registers a callback to run when the hook finishes,
+            such as charmhelpers.core.hookenv.atexit
+        environ: The environment to read FLANNEL_PROFILE_DIR from
+    Returns: The running cProfile.Profile, or None if profiling is disabled
+    """
+    directory = environ.get(PROFILE_ENV)
+    if not directory:
+        return None
+    profiler = cProfile.Profile()
+
+    def dump():
+        profiler.disable()
+        os.makedirs(directory, exist_ok=True)
+        profiler.dump_stats(profile_path(directory, hook))
+
+    register_atexit(dump)
+    profiler.enable()
+    return profiler
@@ -0,0 +1,278 @@
+import contextlib
+import errno
+import fcntl
+import hashlib
+import json
+import os
+import shutil
+import tarfile
+import tempfile
+
+
+CHUNK_SIZE = 1024 * 1024
+# Least recently used resources are evicted from the cache above this size.
+# Installed files are hard links, so eviction never removes them.
+CACHE_SIZE = 256 * 1024 * 1024
+CACHE_INDEX = "index.json"
+# ioctl cloning a file on copy-on-write filesystems such as btrfs and XFS.
+FICLONE = 0x40049409
+
+
+class ResourceError(Exception):
+    pass
+
+
+def sha256_file(path):
+    """Return the hex SHA-256 digest of a file, read in chunks."""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def load_manifest(path):
+    """Return the manifest of installed files, or an empty one."""
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return {"resource": None, "files": {}}
+
+
+def _stage(path, write, mode=0o644):
+    """Write a temporary file next to path and return its name.
+
+    Renaming the staged file over path replaces it atomically, so readers
+    never see a partially written file.
+    """
+    directory = os.path.dirname(path)
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=directory, prefix=".tmp-")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            write(f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.chmod(tmp, mode)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+    return tmp
+
+
+def _write_atomic(path, write, mode=0o644):
+    os.replace(_stage(path, write, mode), path)
+
+
+def write_if_changed(path, content, mode=0o644):
+    """Atomically replace path with content unless it already holds it.
+
+    Args:
+        content: The bytes to write
+    Returns: Whether the file was written
+    """
+    try:
+        if sha256_file(path) == hashlib.sha256(content).hexdigest():
+            return False
+    except FileNotFoundError:
+        pass
+    _write_atomic(path, lambda f: f.write(content), mode)
+    return True
+
+
+def _copy(source, f, digest):
+    for chunk in iter(lambda: source.read(CHUNK_SIZE), b""):
+        digest.update(chunk)
+        f.write(chunk)
+
+
+def _save_manifest(path, manifest):
+    data = json.dumps(manifest, indent=2, sort_keys=True).encode("utf-8")
+    _write_atomic(path, lambda f: f.write(data))
+
+
+def _installed_hash(manifest, dest):
+    """Return the hash of the file currently at dest."""
+    if not os.path.exists(dest):
+        return None
+    if dest in manifest["files"]:
+        return manifest["files"][dest]
+    return sha256_file(dest)
+
+
+@contextlib.contextmanager
+def _locked(cache_dir):
+    """Hold the cache lock, shared by the hooks of every unit on the host."""
+    os.makedirs(cache_dir, exist_ok=True)
+    with open(os.path.join(cache_dir, ".lock"), "a") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+def _load_index(entry):
+    try:
+        with open(os.path.join(entry, CACHE_INDEX)) as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return None
+
+
+def _cached_name(name):
+    return name.replace("/", "_")
+
+
+def _extract(archive, names, entry):
+    """Extract names from archive into the cache entry and return its index.
+
+    The members are unpacked into a staging directory that is renamed to
+    entry once complete, so the cache never holds a partial resource.
+    """
+    staging = tempfile.mkdtemp(dir=os.path.dirname(entry), prefix=".tmp-")
+    index = {}
+    try:
+        with tarfile.open(archive, "r|gz") as tar:
+            for member in tar:
+                name = os.path.normpath(member.name)
+                if name not in names or not member.isfile():
+                    continue
+                source = tar.extractfile(member)
+                digest = hashlib.sha256()
+                _write_atomic(
+                    os.path.join(staging, _cached_name(name)),
+                    lambda f: _copy(source, f, digest),
+                    0o755,
+                )
+                index[name] = digest.hexdigest()
+        missing = set(names) - set(index)
+        if missing:
+            raise ResourceError(
+                "{} is missing {}".format(archive, ", ".join(sorted(missing)))
+            )
+        data = json.dumps(index, indent=2, sort_keys=True).encode("utf-8")
+        _write_atomic(os.path.join(staging, CACHE_INDEX), lambda f: f.write(data))
+        shutil.rmtree(entry, ignore_errors=True)
+        os.rename(staging, entry)
+    except (tarfile.TarError, EOFError, OSError) as e:
+        raise ResourceError("Unable to unpack {}: {}".format(archive, e)) from e
+    finally:
+        shutil.rmtree(staging, ignore_errors=True)
+    return index
+
+
+def _entry_size(entry):
+    size = 0
+    for name in os.listdir(entry):
+        with contextlib.suppress(FileNotFoundError):
+            size += os.lstat(os.path.join(entry, name)).st_size
+    return size
+
+
+def evict(cache_dir, max_size=CACHE_SIZE, keep=()):
+    """Remove least recently used cache entries until under max_size.
+
+    Also removes staging directories left by interrupted extractions, so
+    the cache lock must be held.
+    Args:
+        keep: Entry names that are never evicted
+    Returns: The names of the evicted entries
+    """
+    entries = []
+    for name in os.listdir(cache_dir):
+        path = os.path.join(cache_dir, name)
+        if name.startswith(".tmp-"):
+            shutil.rmtree(path, ignore_errors=True)
+        elif os.path.isdir(path):
+            entries.append((os.stat(path).st_mtime, name, _entry_size(path)))
+    total = sum(size for _, _, size in entries)
+    evicted = []
+    for _, name, size in sorted(entries):
+        if total <= max_size:
+            break
+        if name in keep:
+            continue
+        shutil.rmtree(os.path.join(cache_dir, name), ignore_errors=True)
+        total -= size
+        evicted.append(name)
+    return evicted
+
+
+def _install_file(source, dest):
+    """Atomically put source at dest, sharing its data where possible.
+
+    A hard link costs no space or I/O. Across filesystems the data is cloned
+    with FICLONE where the filesystem supports it, and copied otherwise.
+    """
+    directory = os.path.dirname(dest)
+    os.makedirs(directory, exist_ok=True)
+    tmp = os.path.join(
+        directory, ".tmp-{}-{}".format(os.getpid(), os.path.basename(dest))
+    )
+    with contextlib.suppress(FileNotFoundError):
+        os.unlink(tmp)
+    try:
+        os.link(source, tmp)
+    except OSError as e:
+        if e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK):
+            raise
+        tmp = _stage(dest, lambda f: _clone(source, f), 0o755)
+    os.replace(tmp, dest)
+
+
+def _clone(source, f):
+    with open(source, "rb") as src:
+        try:
+            fcntl.ioctl(f.fileno(), FICLONE, src.fileno())
+        except OSError:
+            shutil.copyfileobj(src, f, CHUNK_SIZE)
+
+
+def install_resource(archive, members, manifest_path, cache_dir, cache_size=CACHE_SIZE):
+    """Install files from a tar.gz resource, replacing only what changed.
+
+    The archive is extracted once per host into cache_dir, under its
+    SHA-256, and shared by every unit installing the same resource. Each
+    wanted member is hard linked into place only if its hash differs from
+    the installed file. The cache is locked while in use, so concurrent
+    hooks of co-located units neither extract twice nor evict what another
+    is installing.
+    Args:
+        archive: Path to the resource tarball
+        members: Dict mapping member names in the archive to install paths
+        manifest_path: Where the hashes of the installed files are recorded
+        cache_dir: The host-wide cache of extracted resources
+        cache_size: Size in bytes the cache is evicted down to
+    Returns: The list of install paths that were replaced
+    Raises: ResourceError if the archive is unreadable or lacks a member
+    """
+    manifest = load_manifest(manifest_path)
+    resource_hash = sha256_file(archive)
+    if manifest["resource"] == resource_hash and all(
+        os.path.exists(dest) for dest in members.values()
+    ):
+        return []
+
+    changed = []
+    with _locked(cache_dir):
+        entry = os.path.join(cache_dir, resource_hash)
+        index = _load_index(entry)
+        if index is None or not set(members) <= set(index):
+            index = _extract(archive, set(members) | set(index or ()), entry)
+        # The entry's mtime orders eviction.
+        os.utime(entry)
+        try:
+            for name, dest in members.items():
+                digest = index[name]
+                if digest != _installed_hash(manifest, dest):
+                    _install_file(os.path.join(entry, _cached_name(name)), dest)
+                    changed.append(dest)
+                manifest["files"][dest] = digest
+        except OSError as e:
+            raise ResourceError("Unable to install {}: {}".format(archive, e)) from e
+        evict(cache_dir, cache_size, keep=(resource_hash,))
+    manifest["resource"] = resource_hash
+    _save_manifest(manifest_path, manifest)
+    return changed
@@ -0,0 +1,92 @@
+import ipaddress
+import os
+import socket
+import struct
+from collections import namedtuple
+from functools import lru_cache
+
+
+RTF_UP = 0x0001
+RTF_REJECT = 0x0200
+
+# Devices that belong to the overlay itself or to juju's fan networking and
+# must never be picked as the underlay interface.
+SKIP_PREFIXES = ("fan-", "flannel.", "flannel-")
+
+DefaultRoute = namedtuple("DefaultRoute", "interface gateway metric family mtu")
+
+
+def _read_lines(path):
+    try:
+        with open(path) as f:
+            return f.read().splitlines()
+    except FileNotFoundError:
+        return []
+
+
+def _skipped(interface):
+    return interface == "lo" or interface.startswith(SKIP_PREFIXES)
+
+
+def parse_ipv4_routes(lines):
+    """Yield (interface, gateway, metric) for each default route in
+    /proc/net/route."""
+    for line in lines[1:]:
+        fields = line.split()
+        if len(fields) < 8:
+            continue
+        iface, dest, gateway, mask = fields[0], fields[1], fields[2], fields[7]
+        flags, metric = int(fields[3], 16), int(fields[6])
+        if dest != "00000000" or mask != "00000000" or not flags & RTF_UP:
+            continue
+        gateway = socket.inet_ntoa(struct.pack("<L", int(gateway, 16)))
+        yield iface, gateway, metric
+
+
+def parse_ipv6_routes(lines):
+    """Yield (interface, gateway, metric) for each default route in
+    /proc/net/ipv6_route."""
+    for line in lines:
+        fields = line.split()
+        if len(fields) < 10:
+            continue
+        dest, prefix_len, next_hop = fields[0], fields[1], fields[4]
+        metric, flags, iface = int(fields[5], 16), int(fields[8], 16), fields[9]
+        if int(dest, 16) or int(prefix_len, 16):
+            continue
+        if not flags & RTF_UP or flags & RTF_REJECT:
+            continue
+        gateway = str(ipaddress.IPv6Address(bytes.fromhex(next_hop)))
+        yield iface, gateway, metric
+
+
+def interface_mtu(interface, root="/"):
+    """Return the MTU of interface, or None if it cannot be read."""
+    path = os.path.join(root, "sys/class/net", interface, "mtu")
+    try:
+        with open(path) as f:
+            return int(f.read().strip())
+    except (OSError, ValueError):
+        return None
+
+
+@lru_cache(maxsize=None)
+def default_route(root="/"):
+    """Find the lowest metric default route of the system.
+
+    IPv4 routes are preferred over IPv6 ones. The result is cached for the
+    lifetime of the process, which for a charm is a single hook invocation.
+
+    Returns: A DefaultRoute, or None if there is no usable default route
+    """
+    for family, path, parse in (
+        (socket.AF_INET, "proc/net/route", parse_ipv4_routes),
+        (socket.AF_INET6, "proc/net/ipv6_route", parse_ipv6_routes),
+    ):
+        lines = _read_lines(os.path.join(root, path))
+        candidates = [r for r in parse(lines) if not _skipped(r[0])]
+        if candidates:
+            iface, gateway, metric = min(candidates, key=lambda r: r[2])
+            mtu = interface_mtu(iface, root)
+            return DefaultRoute(iface, gateway, metric, family, mtu)
+    return None
@@ -0,0 +1,83 @@
+"""Parser for the subnet.env file flanneld writes once it holds a lease."""
+import ipaddress
+import os
+from collections import namedtuple
+
+from charms.flannel.facts import cached_fact
+
+
+SUBNET_ENV_PATH = "/run/flannel/subnet.env"
+SubnetEnv = namedtuple(
+    "SubnetEnv", "network subnet mtu ipmasq ipv6_network ipv6_subnet"
+)
+
+
+def parse_subnet_env(text):
+    """Return the variables of a subnet.env file as a dict of strings.
+
+    Values are split on the first "=" only, and surrounding quotes, blank
+    lines and comments are ignored.
+    """
+    values = {}
+    for line in text.splitlines():
+        line = line.strip()
+        if not line or line.startswith("#") or "=" not in line:
+            continue
+        name, value = line.split("=", 1)
+        values[name.strip()] = value.strip().strip("\"'")
+    return values
+
+
+def _convert(parse, value):
+    if not value:
+        return None
+    try:
+        return parse(value)
+    except ValueError:
+        return None
+
+
+def _network(value):
+    return ipaddress.ip_network(value, strict=False)
+
+
+def subnet_env(values):
+    """Build a SubnetEnv from parsed variables; malformed ones become None."""
+    return SubnetEnv(
+        network=_convert(_network, values.get("FLANNEL_NETWORK")),
+        subnet=_convert(ipaddress.ip_interface, values.get("FLANNEL_SUBNET")),
+        mtu=_convert(int, values.get("FLANNEL_MTU")),
+        ipmasq=values.get("FLANNEL_IPMASQ", "").lower() == "true",
+        ipv6_network=_convert(_network, values.get("FLANNEL_IPV6_NETWORK")),
+        ipv6_subnet=_convert(ipaddress.ip_interface, values.get("FLANNEL_IPV6_SUBNET")),
+    )
+
+
+def read_subnet_env(path, kv=None):
+    """Read the subnet.env file flanneld wrote.
+
+    Args:
+        path: Path to subnet.env
+        kv: A unitdata store. When given, the parsed file is kept there and
+            only read again when its inode, size or mtime changes, so most
+            hooks need a single stat.
+    Returns: A SubnetEnv, or None if flanneld has not written the file
+    """
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+
+    def load():
+        with open(path) as f:
+            return parse_subnet_env(f.read())
+
+    try:
+        if kv is None:
+            values = load()
+        else:
+            key = [stat.st_ino, stat.st_size, stat.st_mtime_ns]
+            values = cached_fact(kv, "subnet-env", key, load)
+    except FileNotFoundError:
+        return None
+    return subnet_env(values)
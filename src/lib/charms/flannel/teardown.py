@@ -0,0 +1,195 @@
+"""Removal of the host network state left by flanneld and the flannel CNI.
+
+Everything is discovered first and then removed in as few commands as
+possible: one `ip -batch` for links and routes, one iptables-restore per
+address family for the --ip-masq rules and one `nft -f` for flanneld's
+nftables tables. Running it again on a clean host changes nothing.
+"""
+import ipaddress
+import json
+import os
+import shlex
+import shutil
+import subprocess
+
+from charms.flannel.metrics import overlay_devices
+
+
+# Chains flanneld creates for --ip-masq, and the comment older releases put
+# on the rules they added to the built-in chains.
+CHAIN_PREFIX = "FLANNEL"
+RULE_COMMENT = "flanneld"
+NFT_TABLES = ("flannel-ipv4", "flannel-ipv6")
+IPTABLES = (
+    ("iptables-save", "iptables-restore"),
+    ("ip6tables-save", "ip6tables-restore"),
+)
+# IPAM leases of the CNI network in 10-flannel.conflist and the config the
+# flannel CNI plugin keeps for each container.
+CNI_STATE_DIRS = ("var/lib/cni/networks/CDK-flannel-network", "var/lib/cni/flannel")
+
+
+def run_command(cmd, input=None):
+    """Run cmd and return its output, or None if it is not installed.
+
+    Raises: CalledProcessError if the command fails
+    """
+    try:
+        result = subprocess.run(
+            cmd,
+            input=input,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            universal_newlines=True,
+            check=True,
+        )
+    except FileNotFoundError:
+        return None
+    return result.stdout
+
+
+def overlay_routes(networks, links, run=run_command):
+    """Return the routes into the flannel networks not on a removed link.
+
+    host-gw routes each remote subnet through the underlay interface, so
+    these survive the removal of flannel's own links.
+    """
+    families = {network.version for network in networks}
+    commands = []
+    if 4 in families:
+        commands.append(["ip", "-j", "route", "show"])
+    if 6 in families:
+        commands.append(["ip", "-6", "-j", "route", "show"])
+    found = []
+    for cmd in commands:
+        for route in json.loads(run(cmd) or "[]"):
+            if route.get("dev") in links or route.get("dst") in (None, "default"):
+                continue
+            try:
+                dst = ipaddress.ip_network(route["dst"], strict=False)
+            except ValueError:
+                continue
+            if any(dst.version == n.version and dst.subnet_of(n) for n in networks):
+                found.append(str(dst))
+    return found
+
+
+def _is_flannel_rule(line):
+    args = shlex.split(line)
+    for option, value in zip(args, args[1:]):
+        if option in ("-j", "-g") and value.startswith(CHAIN_PREFIX):
+            return True
+        if option == "--comment" and RULE_COMMENT in value:
+            return True
+    return False
+
+
+def iptables_cleanup(saved):
+    """Return an iptables-restore --noflush script removing flannel's rules.
+
+    Args:
+        saved: The output of iptables-save
+    Returns: The script, or "" if there is nothing to remove
+    """
+    script = []
+    table, chains, rules = None, [], []
+
+    def finish():
+        if chains or rules:
+            script.append("*" + table)
+            script.extend(rules)
+            script.extend("-F " + chain for chain in chains)
+            script.extend("-X " + chain for chain in chains)
+            script.append("COMMIT")
+
+    for line in saved.splitlines():
+        if line.startswith("*"):
+            table, chains, rules = line[1:].strip(), [], []
+        elif line.startswith("COMMIT") and table:
+            finish()
+            table = None
+        elif line.startswith(":"):
+            chain = line[1:].split()[0]
+            if chain.startswith(CHAIN_PREFIX):
+                chains.append(chain)
+        elif line.startswith("-A "):
+            chain = line.split()[1]
+            # Rules inside flannel's own chains go with the flush.
+            if not chain.startswith(CHAIN_PREFIX) and _is_flannel_rule(line):
+                rules.append("-D" + line[2:])
+    return "\n".join(script + [""]) if script else ""
+
+
+def nft_cleanup(tables):
+    """Return an `nft -f` script deleting flanneld's nftables tables.
+
+    Args:
+        tables: The output of `nft list tables`
+    Returns: The script, or "" if there is nothing to remove
+    """
+    script = []
+    for line in tables.splitlines():
+        words = line.split()
+        if len(words) == 3 and words[0] == "table" and words[2] in NFT_TABLES:
+            script.append("delete table {} {}".format(words[1], words[2]))
+    return "\n".join(script + [""]) if script else ""
+
+
+def teardown(networks=(), root="/", run=run_command):
+    """Remove flannel's links, routes, firewall rules and CNI state.
+
+    flanneld must already be stopped, or it recreates what is removed.
+    Args:
+        networks: The flannel networks, as ip_network objects, whose routes
+            through the underlay are removed
+        root: Root of the filesystem the links and CNI state are found in
+        run: Runs a command with optional input and returns its output, or
+            None if the command is not installed, see run_command
+    Returns: A tuple of lists (removed, errors) describing what was done
+    """
+    removed, errors = [], []
+
+    def attempt(description, cmd, script):
+        try:
+            run(cmd, input=script)
+            removed.append(description)
+        except subprocess.CalledProcessError as e:
+            errors.append("{}: {}".format(description, (e.stderr or str(e)).strip()))
+
+    links = overlay_devices(root)
+    routes = []
+    try:
+        routes = overlay_routes(networks, links, run)
+    except (subprocess.CalledProcessError, ValueError) as e:
+        errors.append("listing routes: {}".format(e))
+    batch = ["route del {}".format(route) for route in routes]
+    batch.extend("link delete {}".format(link) for link in links)
+    if batch:
+        # Deleting a link also removes the routes through it.
+        description = "links and routes: {}".format(", ".join(links + routes))
+        attempt(description, ["ip", "-force", "-batch", "-"], "\n".join(batch) + "\n")
+
+    for save, restore in IPTABLES:
+        try:
+            script = iptables_cleanup(run([save]) or "")
+        except subprocess.CalledProcessError as e:
+            errors.append("{}: {}".format(save, e))
+            continue
+        if script:
+            description = "{} rules".format(save.split("-")[0])
+            attempt(description, [restore, "--noflush"], script)
+
+    try:
+        script = nft_cleanup(run(["nft", "list", "tables"]) or "")
+    except subprocess.CalledProcessError as e:
+        errors.append("nft: {}".format(e))
+        script = ""
+    if script:
+        attempt("nftables tables", ["nft", "-f", "-"], script)
+
+    for state in CNI_STATE_DIRS:
+        path = os.path.join(root, state)
+        if os.path.isdir(path):
+            shutil.rmtree(path, ignore_errors=True)
+            removed.append(path)
+    return removed, errors
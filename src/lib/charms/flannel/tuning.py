@@ -0,0 +1,245 @@
+"""Kernel and NIC tuning profiles for the flannel overlay.
+
+A profile is a set of sysctls, written to a sysctl.d drop-in so they also
+apply at boot and set straight through /proc/sys, plus ethtool offloads for
+the VXLAN device. The value each setting had before the charm first changed
+it is saved, so that switching profile or removing the charm puts it back.
+"""
+import os
+import subprocess
+
+from charms.flannel.resources import write_if_changed
+from charms.flannel.teardown import run_command
+
+
+PROFILES = ("default", "throughput", "large-cluster")
+# Kernel defaults of net.ipv4.neigh.default.gc_thresh1, 2 and 3.
+NEIGH_DEFAULTS = (128, 512, 1024)
+CONNTRACK_MAX = 1048576
+# Reverse path filtering in loose mode, as strict mode drops traffic
+# decapsulated from the overlay when routes are asymmetric.
+LOOSE_RP_FILTER = {"net.ipv4.conf.all.rp_filter": "2"}
+BUFFERS = {
+    "net.core.rmem_max": "16777216",
+    "net.core.wmem_max": "16777216",
+    "net.core.netdev_max_backlog": "16384",
+    "net.ipv4.tcp_rmem": "4096 131072 16777216",
+    "net.ipv4.tcp_wmem": "4096 65536 16777216",
+}
+OFFLOADS = {
+    "default": {},
+    "throughput": {"gso": "on", "gro": "on"},
+    "large-cluster": {},
+}
+# ethtool -k names these features differently from what ethtool -K takes.
+FEATURE_NAMES = {
+    "gso": "generic-segmentation-offload",
+    "gro": "generic-receive-offload",
+}
+# Only present with nf_conntrack loaded; a leading "-" has systemd-sysctl
+# skip it quietly at boot when missing.
+OPTIONAL_SYSCTLS = ("net.netfilter.nf_conntrack_max",)
+NEIGH_SYSCTLS = tuple(
+    "net.{}.neigh.default.gc_thresh{}".format(family, i)
+    for family in ("ipv4", "ipv6")
+    for i in (1, 2, 3)
+)
+# Thresholds, limits and buffers a profile only ever raises, as the
+# principal charm or the operator may already have set them higher.
+MINIMUM_SYSCTLS = NEIGH_SYSCTLS + tuple(BUFFERS) + OPTIONAL_SYSCTLS
+
+
+class TuningConfigError(Exception):
+    pass
+
+
+def neigh_thresholds(nodes, pods_per_node=0):
+    """Return gc_thresh1, 2 and 3 for a flat overlay of nodes.
+
+    Each remote node takes a neighbour entry on the overlay device and one
+    on the underlay, and each local pod one on cni0. The kernel defaults
+    are kept as a floor.
+    """
+    entries = 2 * nodes + pods_per_node
+    thresholds = (entries, 2 * entries, 4 * entries)
+    return tuple(max(t, floor) for t, floor in zip(thresholds, NEIGH_DEFAULTS))
+
+
+def profile_sysctls(profile, nodes=0, pods_per_node=0):
+    """Return the sysctls of a tuning profile.
+
+    Args:
+        profile: One of PROFILES
+        nodes: Number of nodes the flannel network can hold
+        pods_per_node: Number of pods each node subnet can hold
+    Raises: TuningConfigError if profile is unknown
+    """
+    if profile not in PROFILES:
+        raise TuningConfigError(
+            "tuning-profile must be one of {}, not {!r}".format(
+                ", ".join(PROFILES), profile
+            )
+        )
+    if profile == "default":
+        return {}
+    sysctls = dict(LOOSE_RP_FILTER)
+    thresholds = neigh_thresholds(nodes, pods_per_node)
+    for name, threshold in zip(NEIGH_SYSCTLS, thresholds * 2):
+        sysctls[name] = str(threshold)
+    if profile == "throughput":
+        sysctls.update(BUFFERS)
+    else:
+        sysctls["net.netfilter.nf_conntrack_max"] = str(CONNTRACK_MAX)
+    return sysctls
+
+
+def profile_offloads(profile):
+    """Return the ethtool features a profile sets on the overlay device."""
+    return OFFLOADS[profile]
+
+
+def sysctl_conf(sysctls):
+    """Return the sysctl.d drop-in setting sysctls."""
+    lines = ["# Managed by the flannel charm, tuning-profile."]
+    for name, value in sorted(sysctls.items()):
+        prefix = "-" if name in OPTIONAL_SYSCTLS else ""
+        lines.append("{}{} = {}".format(prefix, name, value))
+    return "\n".join(lines) + "\n"
+
+
+def raise_sysctl(current, minimum):
+    """Return the larger of two sysctl values, field by field as for tcp_rmem."""
+    try:
+        fields = zip(map(int, current.split()), map(int, minimum.split()))
+        return " ".join(str(max(c, m)) for c, m in fields)
+    except ValueError:
+        return minimum
+
+
+def _proc_path(name, root):
+    return os.path.join(root, "proc/sys", *name.split("."))
+
+
+def read_sysctl(name, root="/"):
+    """Return the current value of a sysctl, or None if it does not exist."""
+    try:
+        with open(_proc_path(name, root)) as f:
+            return " ".join(f.read().split())
+    except OSError:
+        return None
+
+
+def write_sysctl(name, value, root="/"):
+    """Set a sysctl through /proc/sys, returning whether it worked."""
+    try:
+        with open(_proc_path(name, root), "w") as f:
+            f.write(value)
+    except OSError:
+        return False
+    return True
+
+
+def offload_state(device, run=run_command):
+    """Return the ethtool features of device as a dict of "on" or "off"."""
+    try:
+        output = run(["ethtool", "-k", device])
+    except subprocess.CalledProcessError:
+        return {}
+    features = {}
+    for line in (output or "").splitlines()[1:]:
+        name, sep, value = line.partition(":")
+        if sep and value.split():
+            features[name.strip()] = value.split()[0]
+    return features
+
+
+def _set_offloads(device, features, run, errors):
+    if not features:
+        return
+    cmd = ["ethtool", "-K", device]
+    for feature, value in sorted(features.items()):
+        cmd += [feature, value]
+    try:
+        if run(cmd) is None:
+            errors.append("ethtool is not installed")
+    except subprocess.CalledProcessError as e:
+        errors.append("{}: {}".format(" ".join(cmd), (e.stderr or str(e)).strip()))
+
+
+def apply_tuning(sysctls, offloads, saved, conf_path, root="/", run=run_command):
+    """Bring the host to a profile, restoring what the previous one changed.
+
+    Args:
+        sysctls: The sysctls of the profile
+        offloads: Dict of device to the ethtool features to set on it
+        saved: What apply_tuning returned last time, or None
+        conf_path: Path of the sysctl.d drop-in
+        root: Root of the filesystem holding /proc/sys
+        run: Command runner, see charms.flannel.teardown.run_command
+    Returns: A tuple (saved, errors), saved holding the original values of
+        everything now changed, to pass to the next call or revert_tuning
+
+    Sysctls in MINIMUM_SYSCTLS are only raised, never lowered, and only the
+    sysctls actually changed go in the drop-in.
+    """
+    saved = saved or {"sysctls": {}, "offloads": {}}
+    errors = []
+    original = saved["sysctls"]
+    for name in sorted(set(original) - set(sysctls)):
+        write_sysctl(name, original.pop(name), root)
+    changed = {}
+    for name, value in sorted(sysctls.items()):
+        before = original.get(name) or read_sysctl(name, root)
+        if before is None:
+            if name in OPTIONAL_SYSCTLS:
+                # Left to the drop-in, for when nf_conntrack gets loaded.
+                changed[name] = value
+            else:
+                errors.append("sysctl {} does not exist".format(name))
+            continue
+        if name in MINIMUM_SYSCTLS:
+            value = raise_sysctl(before, value)
+        value = " ".join(value.split())
+        if value == before:
+            # Already what the profile wants, or more.
+            if name in original:
+                write_sysctl(name, original.pop(name), root)
+            continue
+        original[name] = before
+        changed[name] = value
+        if read_sysctl(name, root) != value:
+            if not write_sysctl(name, value, root):
+                errors.append("unable to set {}".format(name))
+
+    restore = {}
+    for device, features in saved["offloads"].items():
+        wanted = offloads.get(device, {})
+        restore[device] = {f: v for f, v in features.items() if f not in wanted}
+        saved["offloads"][device] = {f: v for f, v in features.items() if f in wanted}
+    for device, features in restore.items():
+        _set_offloads(device, features, run, errors)
+    for device, features in offloads.items():
+        device_saved = saved["offloads"].setdefault(device, {})
+        missing = [f for f in features if f not in device_saved]
+        if missing:
+            state = offload_state(device, run)
+            for feature in missing:
+                value = state.get(FEATURE_NAMES.get(feature, feature))
+                if value is not None:
+                    device_saved[feature] = value
+        _set_offloads(device, features, run, errors)
+    saved["offloads"] = {d: f for d, f in saved["offloads"].items() if f}
+
+    if changed:
+        write_if_changed(conf_path, sysctl_conf(changed).encode("utf-8"))
+    elif os.path.exists(conf_path):
+        os.remove(conf_path)
+    return saved, errors
+
+
+def revert_tuning(saved, conf_path, root="/", run=run_command):
+    """Put back everything apply_tuning changed and remove the drop-in.
+
+    Returns: A list of errors
+    """
+    return apply_tuning({}, {}, saved, conf_path, root, run)[1]
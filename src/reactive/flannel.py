@@ -1,21 +1,48 @@
 import os
+import hashlib
 import json
-import shutil
+import socket
+import time
 from shlex import split
-from subprocess import check_output, check_call, CalledProcessError, STDOUT
-
-from charms.flannel.common import retry
+from subprocess import check_output, check_call, STDOUT
+
+from charms.flannel.checks import lease_thresholds
+from charms.flannel.cni import CNIConfigError, conflist, parse_conditions
+from charms.flannel.cni import parse_sysctls, write_conflist
+from charms.flannel.common import backoff_delay
+from charms.flannel.daemon import ServiceConfigError, flanneld_args
+from charms.flannel.daemon import resource_controls
+from charms.flannel.etcd import EtcdError, get_client
+from charms.flannel.facts import cached_fact
+from charms.flannel.leases import ETCD_SETTINGS_KEY, SUBNET_LEASE_PREFIX
+from charms.flannel.metrics import HANDLER_TIMINGS_PATH, LEASE_SNAPSHOT_PATH
+from charms.flannel.metrics import LEASE_TTL_PATH, STATE_DIR, time_handlers
+from charms.flannel.network import BACKENDS, InvalidBackend, NetworkConfigError
+from charms.flannel.network import OVERHEAD, backend_config, backend_interfaces
+from charms.flannel.network import pod_mtu
+from charms.flannel.network import check_lease_capacity, network_config
+from charms.flannel.network import normalize_cidr, parse_cidrs, plan_subnets
+from charms.flannel.profiling import profile_hook
+from charms.flannel.resources import ResourceError, install_resource, load_manifest
+from charms.flannel.resources import sha256_file
+from charms.flannel.routes import default_route, interface_mtu
+from charms.flannel.subnet_env import SUBNET_ENV_PATH, read_subnet_env
+from charms.flannel.teardown import teardown
+from charms.flannel.tuning import TuningConfigError, apply_tuning, profile_offloads
+from charms.flannel.tuning import profile_sysctls, revert_tuning
 
 from charms.reactive import set_state, remove_state, when, when_not, hook
-from charms.reactive import when_any
+from charms.reactive import when_any, is_state
+from charmhelpers.core import unitdata
 from charmhelpers.core.templating import render
 from charmhelpers.core.host import service_start, service_stop, service_restart
 from charmhelpers.core.host import service_running, service
-from charmhelpers.core.hookenv import log, resource_get
+from charmhelpers.core.hookenv import atexit, hook_name, log, resource_get
 from charmhelpers.core.hookenv import config, application_version_set
 from charmhelpers.core.hookenv import network_get
 from charmhelpers.contrib.charmsupport import nrpe
-from charms.reactive.helpers import data_changed
+from charms.reactive.bus import Handler
+from charms.reactive.helpers import any_file_changed, data_changed
 
 from charms.layer import status
 
@@ -24,6 +51,49 @@ ETCD_PATH = "/etc/ssl/flannel"
 ETCD_KEY_PATH = os.path.join(ETCD_PATH, "client-key.pem")
 ETCD_CERT_PATH = os.path.join(ETCD_PATH, "client-cert.pem")
 ETCD_CA_PATH = os.path.join(ETCD_PATH, "client-ca.pem")
+NETWORK_CONFIG_KEY = "/coreos.com/network/config"
+KUBE_NET_CONF_PATH = "/etc/kube-flannel/net-conf.json"
+CNI_CONFLIST_PATH = "/etc/cni/net.d/10-flannel.conflist"
+SYSCTL_CONF_PATH = "/etc/sysctl.d/60-flannel.conf"
+FLANNEL_SERVICE_PATH = "/lib/systemd/system/flannel.service"
+METRICS_SERVICE_PATH = "/lib/systemd/system/flannel-metrics.service"
+METRICS_TIMER_PATH = "/lib/systemd/system/flannel-metrics.timer"
+NAGIOS_PLUGIN_PATH = "/usr/local/lib/nagios/plugins/check_flannel"
+# Extracted flannel resources, shared by all the units on a host.
+RESOURCE_CACHE_DIR = "/var/cache/charm-flannel"
+SUBNET_MANAGERS = ("etcd", "kube")
+# etcd negotiation makes one attempt per hook, so a hook never holds the
+# machine's hook lock waiting for etcd. After a failure the next attempt is
+# deferred with backoff, kept in unitdata, up to the 5 minute update-status
+# interval so that update-status always re-checks a unit still waiting.
+NEGOTIATION_KEY = "flannel.etcd-negotiation"
+NEGOTIATION_DELAY = 10
+NEGOTIATION_MAX_DELAY = 300
+ETCD_TIMEOUT = 5
+# Node subnets leased, the pool capacity and when they were counted. Other
+# units take leases too, so the count is refreshed from etcd at most every
+# SUBNET_USAGE_INTERVAL, and the status warns once more than
+# SUBNET_USAGE_WARNING of the pool is leased.
+SUBNET_USAGE_KEY = "flannel.subnet-usage"
+SUBNET_USAGE_INTERVAL = 1800
+SUBNET_USAGE_WARNING = 0.9
+# Kubeconfig flanneld reads in kube mode, from the cni relation.
+KUBECONFIG_KEY = "flannel.kubeconfig"
+# Values the tuning profile replaced, restored when it changes or on removal.
+TUNING_KEY = "flannel.tuning"
+# Files installed from the flannel resource, by their name in the archive.
+FLANNEL_BINARIES = {
+    "flanneld": "/usr/local/bin/flanneld",
+    "etcdctl": "/usr/local/bin/etcdctl",
+    "cni-plugin/flannel": "/opt/cni/bin/flannel",
+}
+
+# Record the duration of each handler below for the metrics exporter, when
+# it is enabled. The stop hook removes the timings rather than recording.
+if config("metrics-textfile-path") and hook_name() != "stop":
+    time_handlers(Handler, __name__, log=log)
+# Write a cProfile of the hook when FLANNEL_PROFILE_DIR is set.
+profile_hook(hook_name(), atexit)
 
 
 @when_not("flannel.binaries.installed")
@@ -49,23 +119,19 @@ def install_flannel_binaries():
         status.blocked(message)
         return
     status.maintenance("Unpacking flannel resource.")
-    charm_dir = os.getenv("CHARM_DIR")
-    unpack_path = os.path.join(charm_dir, "files", "flannel")
-    os.makedirs(unpack_path, exist_ok=True)
-    cmd = ["tar", "xfz", archive, "-C", unpack_path]
-    log(cmd)
-    check_call(cmd)
-    apps = [
-        {"name": "flanneld", "path": "/usr/local/bin"},
-        {"name": "etcdctl", "path": "/usr/local/bin"},
-    ]
-    for app in apps:
-        unpacked = os.path.join(unpack_path, app["name"])
-        app_path = os.path.join(app["path"], app["name"])
-        install = ["install", "-v", "-D", unpacked, app_path]
-        check_call(install)
-    os.makedirs("/opt/cni/bin", exist_ok=True)
-    shutil.copy(unpack_path + "/cni-plugin/flannel", "/opt/cni/bin")
+    try:
+        changed = install_resource(
+            archive, FLANNEL_BINARIES, resource_manifest_path(), RESOURCE_CACHE_DIR
+        )
+    except ResourceError as e:
+        log(str(e))
+        status.blocked("Corrupt flannel resource.")
+        return
+    for path in changed:
+        log("Installed {}".format(path))
+    if FLANNEL_BINARIES["flanneld"] in changed:
+        remove_state("flannel.service.started")
+        remove_state("flannel.version.set")
     set_state("flannel.binaries.installed")
 
 
@@ -73,10 +139,88 @@ def install_flannel_binaries():
 @when_not("flannel.cni.configured")
 def configure_cni(cni):
     """Set up the flannel cni configuration file."""
-    render("10-flannel.conflist", "/etc/cni/net.d/10-flannel.conflist", {})
+    iface = config("iface") or get_bind_address_interface()
+    try:
+        mtu = get_pod_mtu(iface)
+        conf = conflist(
+            mtu=mtu,
+            hairpin=config("cni-hairpin-mode"),
+            bandwidth=config("cni-bandwidth"),
+            sysctls=parse_sysctls(config("cni-sysctls")),
+            conditions=parse_conditions(config("portmap-conditions")),
+        )
+    except (NetworkConfigError, CNIConfigError) as e:
+        status.blocked("Invalid config: {}".format(e))
+        return
+    unitdata.kv().set("flannel.mtu", mtu)
+    if write_conflist(CNI_CONFLIST_PATH, conf):
+        log("Updated {}".format(CNI_CONFLIST_PATH))
     set_state("flannel.cni.configured")
 
 
+@when_any(
+    "config.changed.iface",
+    "config.changed.mtu",
+    "config.changed.backend",
+    "config.changed.cni-hairpin-mode",
+    "config.changed.cni-bandwidth",
+    "config.changed.cni-sysctls",
+    "config.changed.portmap-conditions",
+)
+def reconfigure_cni():
+    """Re-render the cni configuration when the pod MTU may have changed."""
+    remove_state("flannel.cni.configured")
+    remove_state("flannel.cni.available")
+
+
+def get_pod_mtu(iface):
+    """Returns the MTU for pod interfaces on the flannel overlay.
+
+    The MTU of the underlay interface is reduced by the VXLAN overhead, unless
+    the mtu config option overrides it.
+    """
+    backend = config("backend")
+    if backend not in BACKENDS:
+        raise InvalidBackend("unknown backend {!r}".format(backend))
+    ipv6 = is_ipv6_underlay(iface)
+    mtu = pod_mtu(interface_mtu(iface), config("mtu"), ipv6, backend)
+    log("Using pod MTU {} for iface {}".format(mtu, iface))
+    return mtu
+
+
+def is_ipv6_underlay(iface):
+    """Returns whether the tunnel over iface is carried by IPv6."""
+    route = default_route()
+    return (
+        route is not None
+        and route.interface == iface
+        and route.family == socket.AF_INET6
+    )
+
+
+@when("config.changed.subnet-manager")
+def update_subnet_manager():
+    """Switch between the etcd and the kubernetes subnet manager."""
+    subnet_manager = config("subnet-manager")
+    if subnet_manager not in SUBNET_MANAGERS:
+        status.blocked(
+            "subnet-manager must be one of {}.".format(", ".join(SUBNET_MANAGERS))
+        )
+        return
+    if subnet_manager == "kube":
+        set_state("flannel.kube-subnet-mgr")
+        unitdata.kv().unset(ETCD_SETTINGS_KEY)
+    else:
+        remove_state("flannel.kube-subnet-mgr")
+    remove_state("flannel.service.installed")
+    remove_state("flannel.network.configured")
+
+
+def resource_manifest_path():
+    """Returns where the hashes of the installed binaries are recorded."""
+    return os.path.join(os.getenv("CHARM_DIR"), "files", "flannel", "manifest.json")
+
+
 @when("etcd.tls.available")
 @when_not("flannel.etcd.credentials.installed")
 def install_etcd_credentials(etcd):
@@ -87,19 +231,24 @@ def install_etcd_credentials(etcd):
 
 def default_route_interface():
     """Returns the network interface of the system's default route"""
-    default_interface = None
-    cmd = ["route"]
-    output = check_output(cmd).decode("utf8")
-    for line in output.split("\n"):
-        if "default" in line:
-            default_interface = line.split(" ")[-1]
-            return default_interface
+    route = default_route()
+    return route.interface if route else None
 
 
 def get_bind_address_interface():
     """Returns a non-fan bind-address interface for the cni endpoint.
     Falls back to default_route_interface() if bind-address is not available.
+
+    network-get is a hook tool, so the answer is cached until the default
+    route changes.
     """
+    route = default_route()
+    key = list(route[:4]) if route else None
+    kv = unitdata.kv()
+    return cached_fact(kv, "bind-interface", key, _bind_address_interface)
+
+
+def _bind_address_interface():
     try:
         data = network_get("cni")
     except NotImplementedError:
@@ -126,7 +275,7 @@ def get_bind_address_interface():
     "flannel.etcd.credentials.installed",
     "etcd.tls.available",
 )
-@when_not("flannel.service.installed")
+@when_not("flannel.service.installed", "flannel.kube-subnet-mgr")
 def install_flannel_service(etcd):
     """Install the flannel service."""
     status.maintenance("Installing flannel service.")
@@ -134,27 +283,165 @@ def install_flannel_service(etcd):
     # changes later
     data_changed("flannel_etcd_connections", etcd.get_connection_string())
     data_changed("flannel_etcd_client_cert", etcd.get_client_credentials())
-    iface = config("iface") or get_bind_address_interface()
-    context = {
-        "iface": iface,
+    # For the lease actions, which run outside the reactive framework.
+    etcd_settings = {
         "connection_string": etcd.get_connection_string(),
-        "cert_path": ETCD_PATH,
+        "cert": ETCD_CERT_PATH,
+        "key": ETCD_KEY_PATH,
+        "ca": ETCD_CA_PATH,
+        # Leases of live nodes never drop much below the renew margin.
+        "renew_margin": config("subnet-lease-renew-margin"),
     }
-    render("flannel.service", "/lib/systemd/system/flannel.service", context)
+    kv = unitdata.kv()
+    kv.set(ETCD_SETTINGS_KEY, etcd_settings)
+    kv.unset(KUBECONFIG_KEY)
+    render_flannel_service(
+        {
+            "connection_string": etcd.get_connection_string(),
+            "cert_path": ETCD_PATH,
+        }
+    )
+
+
+@when("flannel.binaries.installed", "flannel.kube-subnet-mgr", "cni.connected")
+@when_not("flannel.service.installed")
+def install_flannel_service_kube(cni):
+    """Install the flannel service using the kubernetes subnet manager."""
+    kubeconfig = get_kubeconfig_path(cni)
+    if not kubeconfig:
+        status.waiting("Waiting for kubeconfig from the cni relation.")
+        return
+    status.maintenance("Installing flannel service.")
+    unitdata.kv().set(KUBECONFIG_KEY, kubeconfig)
+    data_changed("flannel_kubeconfig", kubeconfig_fingerprint(kubeconfig))
+    render_flannel_service(
+        {
+            "kube_subnet_mgr": True,
+            "kubeconfig": kubeconfig,
+            "node_name": socket.gethostname().lower(),
+            "net_conf_path": KUBE_NET_CONF_PATH,
+        }
+    )
+
+
+def render_flannel_service(context):
+    """Render and enable the flannel and metrics systemd units."""
+    try:
+        context.update(get_service_options())
+    except ServiceConfigError as e:
+        status.blocked("Invalid config: {}".format(e))
+        return
+    context["iface"] = config("iface") or get_bind_address_interface()
+    render("flannel.service", FLANNEL_SERVICE_PATH, context)
+    metrics_output = config("metrics-textfile-path")
+    # With etcd the timer also snapshots the subnet leases for the NRPE checks.
+    # Every unit reads every lease for that, so only when NRPE is related.
+    lease_snapshot = None
+    if context.get("connection_string") and is_state(NRPE_EXTERNAL + ".available"):
+        lease_snapshot = LEASE_SNAPSHOT_PATH
+        set_state("flannel.lease-snapshot")
+    else:
+        remove_state("flannel.lease-snapshot")
+    collect_metrics = bool(metrics_output or lease_snapshot)
+    if collect_metrics:
+        metrics_context = dict(
+            context,
+            metrics_output=metrics_output,
+            lease_snapshot=lease_snapshot,
+            charm_lib=os.path.join(os.getenv("CHARM_DIR"), "lib"),
+        )
+        render("flannel-metrics.service", METRICS_SERVICE_PATH, metrics_context)
+        render("flannel-metrics.timer", METRICS_TIMER_PATH, metrics_context)
+    else:
+        remove_metrics_exporter()
+    units = [FLANNEL_SERVICE_PATH, METRICS_SERVICE_PATH, METRICS_TIMER_PATH]
+    if any_file_changed(units):
+        check_call(["systemctl", "daemon-reload"])
     service("enable", "flannel")
+    if collect_metrics:
+        service("enable", "flannel-metrics.timer")
+        service("start", "flannel-metrics.timer")
     set_state("flannel.service.installed")
+    # start_flannel_service decides whether this needs a restart
     remove_state("flannel.service.started")
 
 
-@when("config.changed.iface")
+def get_service_options():
+    """Returns the flanneld flags and resource controls set in config."""
+    options = resource_controls(
+        gomaxprocs=config("gomaxprocs"),
+        cpu_affinity=config("cpu-affinity"),
+        nice=config("nice"),
+        cpu_weight=config("cpu-weight"),
+    )
+    options["flanneld_args"] = flanneld_args(
+        renew_margin=config("subnet-lease-renew-margin"),
+        iptables_resync=config("iptables-resync"),
+        iptables_forward_rules=config("iptables-forward-rules"),
+        healthz_port=config("healthz-port"),
+    )
+    return options
+
+
+def get_kubeconfig_path(cni):
+    """Returns the kubeconfig path shared by the principal over the cni
+    relation, or None if it is not available yet."""
+    if not cni.config_available():
+        return None
+    return cni.get_config().get("kubeconfig_path")
+
+
+def kubeconfig_fingerprint(path):
+    """Returns the kubeconfig path with the hash of its contents."""
+    try:
+        return [path, sha256_file(path)]
+    except FileNotFoundError:
+        return [path, None]
+
+
+@when("cni.connected", "flannel.kube-subnet-mgr", "flannel.service.installed")
+def kubeconfig_changed(cni):
+    """Reinstall flanneld when the kubeconfig moves or its credentials change."""
+    kubeconfig = get_kubeconfig_path(cni)
+    if kubeconfig and data_changed(
+        "flannel_kubeconfig", kubeconfig_fingerprint(kubeconfig)
+    ):
+        remove_state("flannel.service.installed")
+
+
+def remove_metrics_exporter():
+    """Stop the metrics timer and remove its units."""
+    if not os.path.exists(METRICS_TIMER_PATH):
+        return
+    service("stop", "flannel-metrics.timer")
+    service("disable", "flannel-metrics.timer")
+    for path in (METRICS_SERVICE_PATH, METRICS_TIMER_PATH):
+        if os.path.exists(path):
+            os.remove(path)
+
+
+@when_any(
+    "config.changed.iface",
+    "config.changed.metrics-textfile-path",
+    "config.changed.subnet-lease-renew-margin",
+    "config.changed.iptables-resync",
+    "config.changed.iptables-forward-rules",
+    "config.changed.healthz-port",
+    "config.changed.gomaxprocs",
+    "config.changed.cpu-affinity",
+    "config.changed.nice",
+    "config.changed.cpu-weight",
+)
 def reconfigure_flannel_service():
     """Handle interface configuration change."""
     remove_state("flannel.service.installed")
 
 
 @when("etcd.available", "flannel.service.installed")
+@when_not("flannel.kube-subnet-mgr")
 def etcd_changed(etcd):
     if data_changed("flannel_etcd_connections", etcd.get_connection_string()):
+        unitdata.kv().unset(NEGOTIATION_KEY)
         remove_state("flannel.service.installed")
     if data_changed("flannel_etcd_client_cert", etcd.get_client_credentials()):
         etcd.save_client_credentials(ETCD_KEY_PATH, ETCD_CERT_PATH, ETCD_CA_PATH)
@@ -164,59 +451,220 @@ def etcd_changed(etcd):
 @when(
     "flannel.binaries.installed", "flannel.etcd.credentials.installed", "etcd.available"
 )
-@when_not("flannel.network.configured")
+@when_not("flannel.network.configured", "flannel.kube-subnet-mgr")
 def invoke_configure_network(etcd):
     """invoke network configuration and adjust states"""
+    kv = unitdata.kv()
+    deferral = kv.get(NEGOTIATION_KEY)
+    if deferral and time.time() < deferral["next_attempt"]:
+        status.waiting("Waiting on etcd.")
+        return
     status.maintenance("Negotiating flannel network subnet.")
-    if configure_network(etcd):
+    try:
+        configured = configure_network(etcd)
+    except NetworkConfigError as e:
+        kv.unset(NEGOTIATION_KEY)
+        status.blocked("Invalid config: {}".format(e))
+        return
+    if configured:
+        kv.unset(NEGOTIATION_KEY)
         set_state("flannel.network.configured")
         remove_state("flannel.service.started")
-    else:
-        status.waiting("Waiting on etcd.")
+        return
+    failures = deferral["failures"] + 1 if deferral else 1
+    delay = backoff_delay(
+        failures - 1,
+        NEGOTIATION_DELAY,
+        backoff=2,
+        max_delay_secs=NEGOTIATION_MAX_DELAY,
+        jitter=True,
+    )
+    kv.set(NEGOTIATION_KEY, {"failures": failures, "next_attempt": time.time() + delay})
+    log("etcd negotiation failed {} times, retrying in {:.0f}s".format(failures, delay))
+    status.waiting("Waiting on etcd.")
 
 
-@retry(times=3, delay_secs=20)
 def configure_network(etcd):
     """Store initial flannel data in etcd.
 
+    Makes a single attempt, see invoke_configure_network for the retries.
     Returns True if the operation completed successfully.
 
     """
-    flannel_config = {"Network": config("cidr"), "Backend": {"Type": "vxlan"}}
+    flannel_config = get_flannel_config()
+    data = json.dumps(flannel_config, sort_keys=True)
+    connection_string = etcd.get_connection_string()
 
-    vni = config("vni")
-    if vni:
-        flannel_config["Backend"]["VNI"] = vni
+    # Every unit of the application computes the same config, so once this
+    # unit has seen it stored there is no need to talk to etcd again.
+    if not data_changed("flannel_network_config", [connection_string, data]):
+        return True
 
-    port = config("port")
-    if port:
-        flannel_config["Backend"]["Port"] = port
+    client = get_client(
+        connection_string, ETCD_CERT_PATH, ETCD_KEY_PATH, ETCD_CA_PATH, ETCD_TIMEOUT
+    )
+    try:
+        check_subnet_capacity(client)
+        if write_network_config(client, flannel_config, data):
+            return True
+        log("Network config was changed concurrently.")
+    except EtcdError as e:
+        log(
+            "Unexpected error configuring network: {}. Assuming etcd not"
+            " ready.".format(e)
+        )
+    except NetworkConfigError:
+        data_changed("flannel_network_config", None)
+        raise
+    # Forget the cached config so the next attempt talks to etcd again.
+    data_changed("flannel_network_config", None)
+    return False
+
+
+def check_subnet_capacity(client):
+    """Refuse a subnet layout that cannot hold the subnets already leased."""
+    plan = get_subnet_plan()
+    if plan is None:
+        return
+    leases = record_subnet_usage(client, plan)
+    log(
+        "Flannel subnet pool: {} of {} node subnets leased, {} pods per node".format(
+            leases, plan.max_nodes, plan.pods_per_node
+        )
+    )
+    check_lease_capacity(plan, leases)
 
-    data = json.dumps(flannel_config)
 
-    cmd = "etcdctl "
-    cmd += "--endpoints '{0}' ".format(etcd.get_connection_string())
-    cmd += "--cert {0} ".format(ETCD_CERT_PATH)
-    cmd += "--key {0} ".format(ETCD_KEY_PATH)
-    cmd += "--cacert {0} ".format(ETCD_CA_PATH)
-    cmd += "put /coreos.com/network/config '{0}'".format(data)
-    env = dict(os.environ, ETCDCTL_API="3")
+def record_subnet_usage(client, plan):
+    """Count the subnet leases and save them with the capacity of plan."""
+    leases = client.count(SUBNET_LEASE_PREFIX)
+    unitdata.kv().set(SUBNET_USAGE_KEY, [leases, plan.max_nodes, time.time()])
+    return leases
+
+
+@when("flannel.network.configured", "etcd.available")
+@when_not("flannel.kube-subnet-mgr")
+def refresh_subnet_usage(etcd):
+    """Recount the subnet leases once the last count is SUBNET_USAGE_INTERVAL old."""
+    usage = unitdata.kv().get(SUBNET_USAGE_KEY)
+    if usage and len(usage) > 2 and time.time() < usage[2] + SUBNET_USAGE_INTERVAL:
+        return
+    try:
+        plan = get_subnet_plan()
+    except NetworkConfigError:
+        return
+    if plan is None:
+        return
+    client = get_client(
+        etcd.get_connection_string(),
+        ETCD_CERT_PATH,
+        ETCD_KEY_PATH,
+        ETCD_CA_PATH,
+        ETCD_TIMEOUT,
+    )
     try:
-        check_call(split(cmd), env=env)
+        record_subnet_usage(client, plan)
+    except EtcdError as e:
+        log("Unable to count flannel subnet leases: {}".format(e))
+
+
+def write_network_config(client, flannel_config, data):
+    """Write the network config unless etcd already holds it.
+
+    The write is a compare-and-swap on the key's mod revision, so when many
+    units converge at once only the first one changes the key and the others
+    find it already up to date.
+
+    Returns True if etcd holds the desired config.
+    """
+    current = client.get(NETWORK_CONFIG_KEY)
+    if current is not None:
+        try:
+            if json.loads(current["value"]) == flannel_config:
+                log("Flannel network config is already up to date")
+                return True
+        except ValueError:
+            log("Replacing invalid flannel network config in etcd")
+    revision = current["mod_revision"] if current else 0
+    if client.put_if_revision(NETWORK_CONFIG_KEY, data, revision):
         return True
+    # Lost the race; another unit may have written the same config.
+    current = client.get(NETWORK_CONFIG_KEY)
+    return current is not None and json.loads(current["value"]) == flannel_config
 
-    except CalledProcessError:
-        log(
-            "Unexpected error configuring network. Assuming etcd not"
-            " ready. Will retry in 20s"
-        )
-        return False
+
+@when("flannel.binaries.installed", "flannel.kube-subnet-mgr")
+@when_not("flannel.network.configured")
+def configure_network_kube():
+    """Write the network config read by flanneld's kubernetes subnet manager."""
+    status.maintenance("Configuring flannel network.")
+    try:
+        flannel_config = get_flannel_config()
+    except NetworkConfigError as e:
+        status.blocked("Invalid config: {}".format(e))
+        return
+    os.makedirs(os.path.dirname(KUBE_NET_CONF_PATH), exist_ok=True)
+    with open(KUBE_NET_CONF_PATH, "w") as f:
+        json.dump(flannel_config, f, sort_keys=True)
+    # Leases are only counted in etcd.
+    unitdata.kv().unset(SUBNET_USAGE_KEY)
+    set_state("flannel.network.configured")
+    remove_state("flannel.service.started")
 
 
-@when_any("config.changed.cidr", "config.changed.port", "config.changed.vni")
+def get_flannel_config():
+    """Returns the flannel network config."""
+    return network_config(
+        config("cidr"),
+        get_backend_config(),
+        subnet_len=config("subnet-len"),
+        subnet_min=config("subnet-min"),
+        subnet_max=config("subnet-max"),
+    )
+
+
+def get_subnet_plan():
+    """Returns the SubnetPlan of the IPv4 network, or None if IPv6 only."""
+    ipv4, _ = parse_cidrs(config("cidr"), config("subnet-len"))
+    if ipv4 is None:
+        return None
+    return plan_subnets(
+        ipv4, config("subnet-len"), config("subnet-min"), config("subnet-max")
+    )
+
+
+def get_backend_config():
+    """Returns the Backend section of the flannel network config."""
+    return backend_config(
+        backend=config("backend"),
+        vni=config("vni"),
+        port=config("port"),
+        direct_routing=config("direct-routing"),
+        gbp=config("vxlan-gbp"),
+        learning=config("vxlan-learning"),
+        keepalive=config("wireguard-persistent-keepalive"),
+    )
+
+
+@when_any(
+    "config.changed.cidr",
+    "config.changed.subnet-len",
+    "config.changed.subnet-min",
+    "config.changed.subnet-max",
+    "config.changed.port",
+    "config.changed.vni",
+    "config.changed.backend",
+    "config.changed.direct-routing",
+    "config.changed.vxlan-gbp",
+    "config.changed.vxlan-learning",
+    "config.changed.wireguard-persistent-keepalive",
+)
 def reconfigure_network():
     """Trigger the network configuration method."""
+    # New config deserves an attempt now rather than after a backoff.
+    unitdata.kv().unset(NEGOTIATION_KEY)
     remove_state("flannel.network.configured")
+    remove_state("flannel.cni.available")
 
 
 @when(
@@ -226,20 +674,108 @@ def reconfigure_network():
 )
 @when_not("flannel.service.started")
 def start_flannel_service():
-    """Start the flannel service."""
-    status.maintenance("Starting flannel service.")
-    if service_running("flannel"):
+    """Start the flannel service, restarting it only if its inputs changed."""
+    config_hash = flannel_config_hash()
+    kv = unitdata.kv()
+    if not service_running("flannel"):
+        status.maintenance("Starting flannel service.")
+        service_start("flannel")
+    elif kv.get("flannel.config-hash") != config_hash:
+        status.maintenance("Restarting flannel service.")
         service_restart("flannel")
     else:
-        service_start("flannel")
+        log("Flannel configuration unchanged, not restarting flannel.")
+    kv.set("flannel.config-hash", config_hash)
     set_state("flannel.service.started")
+    # flanneld recreates its devices when it starts, losing their offloads.
+    remove_state("flannel.tuning.applied")
+
+
+@when("flannel.service.started")
+@when_not("flannel.tuning.applied")
+def apply_tuning_profile():
+    """Apply the sysctls and overlay device offloads of tuning-profile.
+
+    The neighbour table thresholds scale with the number of nodes the
+    subnet config allows for.
+    """
+    profile = config("tuning-profile")
+    try:
+        plan = get_subnet_plan()
+        nodes, pods_per_node = (plan.max_nodes, plan.pods_per_node) if plan else (0, 0)
+        sysctls = profile_sysctls(profile, nodes, pods_per_node)
+    except (NetworkConfigError, TuningConfigError) as e:
+        status.blocked("Invalid config: {}".format(e))
+        return
+    offloads = {}
+    missing = []
+    if config("backend") == "vxlan" and profile_offloads(profile):
+        for device in backend_interfaces("vxlan", config("vni")):
+            if os.path.exists(os.path.join("/sys/class/net", device)):
+                offloads[device] = profile_offloads(profile)
+            else:
+                missing.append(device)
+    kv = unitdata.kv()
+    saved = kv.get(TUNING_KEY)
+    saved, errors = apply_tuning(sysctls, offloads, saved, SYSCTL_CONF_PATH)
+    kv.set(TUNING_KEY, saved)
+    for error in errors:
+        log("Unable to apply tuning-profile {}: {}".format(profile, error))
+    if missing:
+        # flanneld creates the VXLAN device once it has its lease.
+        log("Waiting for {} to set its offloads".format(", ".join(missing)))
+        return
+    set_state("flannel.tuning.applied")
+
+
+@when_any(
+    "config.changed.tuning-profile",
+    "config.changed.cidr",
+    "config.changed.subnet-len",
+    "config.changed.subnet-min",
+    "config.changed.subnet-max",
+    "config.changed.backend",
+    "config.changed.vni",
+)
+def reconfigure_tuning():
+    """Re-apply the tuning profile when it or the node count may have changed."""
+    remove_state("flannel.tuning.applied")
+
+
+def flannel_config_hash():
+    """Returns a hash of everything flanneld reads when it starts.
+
+    That is the systemd unit, the flanneld binary, the etcd client
+    credentials or the kubeconfig, and the network config. flanneld cannot
+    reload any of them, so a change to this hash is what requires a restart.
+    """
+    digest = hashlib.sha256()
+    paths = [
+        FLANNEL_SERVICE_PATH,
+        FLANNEL_BINARIES["flanneld"],
+        ETCD_CERT_PATH,
+        ETCD_KEY_PATH,
+        ETCD_CA_PATH,
+    ]
+    kubeconfig = unitdata.kv().get(KUBECONFIG_KEY)
+    if kubeconfig:
+        paths.append(kubeconfig)
+    for path in paths:
+        try:
+            digest.update(sha256_file(path).encode("utf-8"))
+        except FileNotFoundError:
+            digest.update(b"-")
+    digest.update(json.dumps(get_flannel_config(), sort_keys=True).encode("utf-8"))
+    return digest.hexdigest()
 
 
 @when("cni.connected", "flannel.service.started", "flannel.cni.configured")
 @when_not("flannel.cni.available")
 def set_available(cni):
     """Indicate to the CNI provider that we're ready."""
-    cni.set_config(cidr=config("cidr"), cni_conf_file="10-flannel.conflist")
+    cni.set_config(
+        cidr=normalize_cidr(config("cidr")), cni_conf_file="10-flannel.conflist"
+    )
     set_state("flannel.cni.available")
 
 
@@ -247,13 +783,29 @@ def set_available(cni):
 @when_not("flannel.version.set")
 def set_flannel_version():
     """Surface the currently deployed version of flannel to Juju"""
-    cmd = "flanneld -version"
-    version = check_output(split(cmd), stderr=STDOUT).decode("utf-8")
+    version = flanneld_version()
     if version:
-        application_version_set(version.split("v")[-1].strip())
+        application_version_set(version)
         set_state("flannel.version.set")
 
 
+def flanneld_version():
+    """Returns the version of the installed flanneld.
+
+    Cached until the resource installs a different flanneld binary.
+    """
+    flanneld = FLANNEL_BINARIES["flanneld"]
+    key = load_manifest(resource_manifest_path())["files"].get(flanneld)
+    kv = unitdata.kv()
+    return cached_fact(kv, "flanneld-version", key, _flanneld_version)
+
+
+def _flanneld_version():
+    cmd = "flanneld -version"
+    version = check_output(split(cmd), stderr=STDOUT).decode("utf-8")
+    return version.split("v")[-1].strip()
+
+
 NRPE_EXTERNAL = "nrpe-external-master"  # wokeignore:rule=master
 
 
@@ -266,7 +818,15 @@ def initial_nrpe_config(nagios=None):
 
 @when("flannel.service.started")
 @when(NRPE_EXTERNAL + ".available")
-@when_any("config.changed.nagios_context", "config.changed.nagios_servicegroups")
+@when_any(
+    "config.changed.nagios_context",
+    "config.changed.nagios_servicegroups",
+    "config.changed.iface",
+    "config.changed.backend",
+    "config.changed.vni",
+    "config.changed.subnet-manager",
+    "config.changed.subnet-lease-renew-margin",
+)
 def update_nrpe_config(unused=None):
     # List of systemd services that will be checked
     services = ("flannel",)
@@ -277,20 +837,96 @@ def update_nrpe_config(unused=None):
     current_unit = nrpe.get_nagios_unit_name()
     nrpe_setup = nrpe.NRPE(hostname=hostname, primary=False)
     nrpe.add_init_service_checks(nrpe_setup, services, current_unit)
+    add_data_path_checks(nrpe_setup)
     nrpe_setup.write()
 
 
+@when(NRPE_EXTERNAL + ".available", "flannel.service.installed")
+@when_not("flannel.lease-snapshot", "flannel.kube-subnet-mgr")
+def enable_lease_snapshot():
+    """Re-render the metrics timer to snapshot the leases for the checks."""
+    remove_state("flannel.service.installed")
+
+
+@when("flannel.lease-snapshot")
+@when_not(NRPE_EXTERNAL + ".available")
+def disable_lease_snapshot():
+    """Stop snapshotting the leases once nothing checks them."""
+    remove_state("flannel.service.installed")
+
+
+def add_data_path_checks(nrpe_setup):
+    """Register the checks of the overlay devices and the subnet lease."""
+    charm_lib = os.path.join(os.getenv("CHARM_DIR"), "lib")
+    render("check_flannel", NAGIOS_PLUGIN_PATH, {"charm_lib": charm_lib}, perms=0o755)
+    etcd = not is_state("flannel.kube-subnet-mgr")
+    snapshot = " --snapshot {}".format(LEASE_SNAPSHOT_PATH) if etcd else ""
+    if etcd:
+        # The thresholds follow when flanneld renews its lease.
+        warn, crit = lease_thresholds(config("subnet-lease-renew-margin"))
+        nrpe_setup.add_check(
+            shortname="flannel_lease",
+            description="Flannel subnet lease expiry",
+            check_cmd="check_flannel lease{} --warn {} --crit {}".format(
+                snapshot, warn, crit
+            ),
+        )
+    if config("backend") != "vxlan":
+        # The FDB and MTU checks only cover the VXLAN device.
+        return
+    iface = config("iface") or get_bind_address_interface()
+    overhead = OVERHEAD["vxlan"][6 if is_ipv6_underlay(iface) else 4]
+    (device,) = backend_interfaces("vxlan", config("vni"))
+    shortname = device.replace(".", "_")
+    # DirectRouting peers on the same L2 are routed without FDB entries.
+    direct = " --direct-routing" if config("direct-routing") else ""
+    nrpe_setup.add_check(
+        shortname="{}_fdb".format(shortname),
+        description="Flannel {} forwarding entries".format(device),
+        check_cmd="check_flannel fdb --device {}{}{}".format(device, snapshot, direct),
+    )
+    mtu_args = "--device {} --iface {} --overhead {}".format(device, iface, overhead)
+    nrpe_setup.add_check(
+        shortname="{}_mtu".format(shortname),
+        description="Flannel {} MTU".format(device),
+        check_cmd="check_flannel mtu " + mtu_args,
+    )
+
+
 @when("flannel.service.started")
 @when("flannel.cni.available")
 def ready():
     """Indicate that flannel is active."""
+    kv = unitdata.kv()
+    usage = kv.get(SUBNET_USAGE_KEY)
     try:
-        status.active("Flannel subnet " + get_flannel_subnet())
+        message = "Flannel subnet " + ", ".join(get_flannel_subnet())
     except FlannelSubnetNotFound:
-        status.waiting("Waiting for Flannel")
+        kv.unset("flannel.active-status")
+        if usage and usage[0] >= usage[1]:
+            status.blocked(
+                "Flannel subnet pool exhausted: {} of {} node subnets leased.".format(
+                    *usage
+                )
+            )
+        else:
+            status.waiting("Waiting for Flannel")
+        return
+    mtu = kv.get("flannel.mtu")
+    if mtu:
+        message += ", MTU {}".format(mtu)
+    if usage and usage[0] > usage[1] * SUBNET_USAGE_WARNING:
+        message += ", subnet pool {} of {} leased".format(usage[0], usage[1])
+    # Every unit runs update-status every few minutes, so skip sending the
+    # controller an unchanged status there. Other hooks always report it,
+    # since their handlers may have set a different status meanwhile.
+    if hook_name() == "update-status" and kv.get("flannel.active-status") == message:
+        return
+    status.active(message)
+    kv.set("flannel.active-status", message)
 
 
-@when_not("etcd.connected")
+@when_not("etcd.connected", "flannel.kube-subnet-mgr")
 def halt_execution():
     """send a clear message to the user that we are waiting on etcd"""
     status.blocked("Waiting for etcd relation.")
@@ -300,9 +936,8 @@ def halt_execution():
 def reset_states_and_redeploy():
     """Remove state and redeploy"""
     remove_state("flannel.cni.available")
+    # Re-check the resource; flannel is only restarted if flanneld changed.
     remove_state("flannel.binaries.installed")
-    remove_state("flannel.service.started")
-    remove_state("flannel.version.set")
     remove_state("flannel.network.configured")
     remove_state("flannel.service.installed")
     remove_state("flannel.cni.configured")
@@ -321,23 +956,30 @@ def pre_series_upgrade():
 @hook("stop")
 def cleanup_deployment():
     """Terminate services, and remove the deployed bins"""
+    remove_metrics_exporter()
     service_stop("flannel")
-    down = "ip link set flannel.1 down"
-    delete = "ip link delete flannel.1"
-    try:
-        check_call(split(down))
-        check_call(split(delete))
-    except CalledProcessError:
-        log("Unable to remove iface flannel.1")
+    for error in revert_tuning(unitdata.kv().get(TUNING_KEY), SYSCTL_CONF_PATH):
+        log("Unable to revert tuning-profile: {}".format(error))
+    unitdata.kv().unset(TUNING_KEY)
+    removed, errors = teardown(get_flannel_networks())
+    for item in removed:
+        log("Removed {}".format(item))
+    for error in errors:
+        log("Unable to remove {}".format(error))
         log("Potential indication that cleanup is not possible")
     files = [
-        "/usr/local/bin/flanneld",
         "/lib/systemd/system/flannel",
-        "/lib/systemd/system/flannel.service",
-        "/run/flannel/subnet.env",
-        "/usr/local/bin/flanneld",
-        "/usr/local/bin/etcdctl",
-        "/etc/cni/net.d/10-flannel.conflist",
+        FLANNEL_SERVICE_PATH,
+        SUBNET_ENV_PATH,
+        FLANNEL_BINARIES["flanneld"],
+        FLANNEL_BINARIES["etcdctl"],
+        FLANNEL_BINARIES["cni-plugin/flannel"],
+        CNI_CONFLIST_PATH,
+        KUBE_NET_CONF_PATH,
+        HANDLER_TIMINGS_PATH,
+        LEASE_SNAPSHOT_PATH,
+        LEASE_TTL_PATH,
+        NAGIOS_PLUGIN_PATH,
         ETCD_KEY_PATH,
         ETCD_CERT_PATH,
         ETCD_CA_PATH,
@@ -346,20 +988,41 @@ def cleanup_deployment():
         if os.path.exists(f):
             log("Removing {}".format(f))
             os.remove(f)
+    try:
+        os.rmdir(STATE_DIR)
+    except OSError:
+        # Missing, or holding files the charm did not put there.
+        pass
+
+
+def get_flannel_networks():
+    """Returns the networks flannel may have routed, from flanneld and config."""
+    networks = set()
+    env = read_subnet_env(SUBNET_ENV_PATH)
+    if env:
+        networks.update(n for n in (env.network, env.ipv6_network) if n)
+    try:
+        networks.update(n for n in parse_cidrs(config("cidr")) if n)
+    except NetworkConfigError:
+        pass
+    return sorted(networks, key=lambda n: (n.version, n))
 
 
 def get_flannel_subnet():
-    """Returns the flannel subnet reserved for this unit"""
-    try:
-        with open("/run/flannel/subnet.env") as f:
-            raw_data = dict(line.strip().split("=") for line in f)
-        return raw_data["FLANNEL_SUBNET"]
-    except FileNotFoundError as e:
-        raise FlannelSubnetNotFound() from e
+    """Returns the flannel subnets reserved for this unit, IPv4 first"""
+    env = read_subnet_env(SUBNET_ENV_PATH, unitdata.kv())
+    subnets = [str(s) for s in (env.subnet, env.ipv6_subnet) if s] if env else []
+    if not subnets:
+        raise FlannelSubnetNotFound()
+    return subnets
 
 
 def arch():
     """Return the package architecture as a string."""
+    return cached_fact(unitdata.kv(), "arch", None, _dpkg_architecture)
+
+
+def _dpkg_architecture():
     # Get the package architecture for this system.
     architecture = check_output(["dpkg", "--print-architecture"]).rstrip()
     # Convert the binary result into a string.
@@ -0,0 +1,528 @@
+"""Measure pod to pod throughput and latency over a simulated flannel overlay.
+
+Builds two or more network namespace "nodes" joined by veth pairs through a
+bridge, and programs each one the way flanneld would for the network config
+the charm writes: the flannel.<vni> VXLAN device with its routes, neighbour
+and FDB entries, or the host-gw routes, plus a cni0 bridge holding a pod
+namespace. With --ip-masq, flanneld's --ip-masq iptables rules are added on
+every node. A small iperf-style tool then measures TCP throughput, UDP
+packets per second and TCP request/response latency from the pod on the
+first node to the pod on the last.
+
+Needs root, iproute2 and, for --ip-masq, iptables, but no network:
+
+    sudo PYTHONPATH=src/lib python3 tests/benchmark/bench_datapath.py --json
+    sudo PYTHONPATH=src/lib python3 tests/benchmark/bench_datapath.py \\
+        --backend host-gw --underlay-mtu 9000 --json
+
+Each run prints one JSON document, so runs with different backends, VNIs,
+ports and MTUs can be collected and compared. The wireguard backend is not
+simulated, as its peers are configured by flanneld itself.
+"""
+import argparse
+import ipaddress
+import json
+import os
+import shutil
+import socket
+import statistics
+import subprocess
+import sys
+import threading
+import time
+
+from charms.flannel.network import backend_config, backend_interfaces
+from charms.flannel.network import network_config, overlay_mtu, plan_subnets
+from charms.flannel.network import pod_mtu
+
+UNDERLAY = ipaddress.ip_network("192.168.250.0/24")
+# flanneld's default VXLAN port on Linux.
+VXLAN_PORT = 8472
+BENCH_PORT = 5201
+HEADER_LEN = 8
+STREAM_BUFFER = 128 * 1024
+
+
+def _header(mode):
+    return mode.encode("ascii").ljust(HEADER_LEN)
+
+
+def _recv_exact(conn, size):
+    data = b""
+    while len(data) < size:
+        chunk = conn.recv(size - len(data))
+        if not chunk:
+            break
+        data += chunk
+    return data
+
+
+# The server and client below run inside the pod namespaces.
+
+
+def serve(bind, port=BENCH_PORT):
+    """Answer benchmark requests until a quit request arrives."""
+    listener = socket.create_server((bind, port))
+    udp = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    udp.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4 * 1024 * 1024)
+    udp.bind((bind, port))
+    udp.settimeout(0.1)
+    print("ready", flush=True)
+    while True:
+        conn, _ = listener.accept()
+        with conn:
+            mode = _recv_exact(conn, HEADER_LEN).strip().decode("ascii")
+            if mode == "stream":
+                buffer = bytearray(STREAM_BUFFER)
+                received = 0
+                while True:
+                    size = conn.recv_into(buffer)
+                    if not size:
+                        break
+                    received += size
+                conn.sendall(str(received).encode("ascii"))
+            elif mode == "rr":
+                conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                while True:
+                    byte = conn.recv(1)
+                    if not byte:
+                        break
+                    conn.sendall(byte)
+            elif mode == "udp":
+                counted = [0]
+                done = threading.Event()
+
+                def count():
+                    while not done.is_set():
+                        try:
+                            udp.recv(65536)
+                            counted[0] += 1
+                        except socket.timeout:
+                            pass
+
+                counter = threading.Thread(target=count)
+                counter.start()
+                conn.sendall(b"ok")
+                _recv_exact(conn, 4)
+                # Let the packets still in flight arrive.
+                time.sleep(0.2)
+                done.set()
+                counter.join()
+                conn.sendall(str(counted[0]).encode("ascii"))
+            elif mode == "quit":
+                return
+
+
+def tcp_stream(server, port, duration):
+    conn = socket.create_connection((server, port))
+    with conn:
+        conn.sendall(_header("stream"))
+        buffer = bytes(STREAM_BUFFER)
+        start = time.perf_counter()
+        deadline = start + duration
+        while time.perf_counter() < deadline:
+            conn.sendall(buffer)
+        conn.shutdown(socket.SHUT_WR)
+        received = int(conn.recv(64))
+        secs = time.perf_counter() - start
+    return {"bytes": received, "secs": secs, "gbps": received * 8 / secs / 1e9}
+
+
+def tcp_rr(server, port, count):
+    conn = socket.create_connection((server, port))
+    with conn:
+        conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        conn.sendall(_header("rr"))
+        samples = []
+        for _ in range(count):
+            start = time.perf_counter()
+            conn.sendall(b"x")
+            conn.recv(1)
+            samples.append((time.perf_counter() - start) * 1e6)
+    samples.sort()
+    return {
+        "count": count,
+        "mean_us": statistics.mean(samples),
+        "p50_us": samples[len(samples) // 2],
+        "p99_us": samples[max(int(len(samples) * 0.99) - 1, 0)],
+    }
+
+
+def udp_flood(server, port, duration, size):
+    conn = socket.create_connection((server, port))
+    with conn:
+        conn.sendall(_header("udp"))
+        _recv_exact(conn, 2)
+        udp = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        udp.connect((server, port))
+        payload = bytes(size)
+        sent = 0
+        start = time.perf_counter()
+        deadline = start + duration
+        while time.perf_counter() < deadline:
+            try:
+                udp.send(payload)
+                sent += 1
+            except OSError:
+                # The socket buffer is full, which is dropped traffic too.
+                pass
+        secs = time.perf_counter() - start
+        conn.sendall(b"stop")
+        received = int(conn.recv(64))
+    return {
+        "size": size,
+        "sent": sent,
+        "received": received,
+        "pps": received / secs,
+        "loss": 1 - received / sent if sent else 0,
+    }
+
+
+def client(server, port, duration, rr_count, udp_size):
+    results = {
+        "tcp_stream": tcp_stream(server, port, duration),
+        "tcp_rr": tcp_rr(server, port, rr_count),
+        "udp": udp_flood(server, port, duration, udp_size),
+    }
+    conn = socket.create_connection((server, port))
+    with conn:
+        conn.sendall(_header("quit"))
+    print(json.dumps(results))
+
+
+# The topology is built from the root namespace.
+
+
+class Node:
+    def __init__(self, prefix, index, subnet):
+        self.index = index
+        self.ns = "{}n{}".format(prefix, index)
+        self.pod_ns = "{}p{}".format(prefix, index)
+        self.uplink = "{}u{}".format(prefix, index)
+        self.subnet = subnet
+        self.address = UNDERLAY.network_address + 10 + index
+        self.pod_address = subnet.network_address + 2
+        self.vtep_mac = "02:fb:00:00:00:{:02x}".format(index + 1)
+
+
+class Topology:
+    """Network namespaces programmed the way flanneld programs nodes."""
+
+    def __init__(self, config, nodes, underlay_mtu, ip_masq, override_mtu=0):
+        backend = config["Backend"]
+        self.config = config
+        self.backend = backend["Type"]
+        self.vni = backend.get("VNI", 1)
+        self.port = backend.get("Port", VXLAN_PORT)
+        self.underlay_mtu = underlay_mtu
+        self.device_mtu = overlay_mtu(underlay_mtu, backend=self.backend)
+        self.pod_mtu = pod_mtu(underlay_mtu, override_mtu, backend=self.backend)
+        self.ip_masq = ip_masq
+        self.network = ipaddress.ip_network(config["Network"])
+        plan = plan_subnets(
+            self.network,
+            config["SubnetLen"],
+            config.get("SubnetMin", ""),
+            config.get("SubnetMax", ""),
+        )
+        size = 2 ** (32 - plan.subnet_len)
+        prefix = "flb{}".format(os.getpid() % 100000)
+        self.underlay_ns = prefix + "ul"
+        self.nodes = [
+            Node(
+                prefix,
+                i,
+                ipaddress.ip_network((plan.subnet_min + i * size, plan.subnet_len)),
+            )
+            for i in range(nodes)
+        ]
+        self.namespaces = []
+
+    def run(self, cmd, input=None):
+        subprocess.run(
+            cmd, input=input, universal_newlines=True, check=True, capture_output=True
+        )
+
+    def ip(self, ns, commands):
+        self.run(["ip", "-n", ns, "-batch", "-"], "\n".join(commands) + "\n")
+
+    def add_namespace(self, ns):
+        self.run(["ip", "netns", "add", ns])
+        self.namespaces.append(ns)
+        self.ip(ns, ["link set lo up"])
+
+    def setup(self):
+        self.add_namespace(self.underlay_ns)
+        self.ip(self.underlay_ns, ["link add name br0 type bridge", "link set br0 up"])
+        for node in self.nodes:
+            self.add_namespace(node.ns)
+            self.add_namespace(node.pod_ns)
+            self.setup_node(node)
+        for node in self.nodes:
+            self.program_peers(node)
+            if self.ip_masq:
+                self.add_masq_rules(node)
+
+    def setup_node(self, node):
+        ul, mtu = self.underlay_ns, self.underlay_mtu
+        self.ip(
+            ul,
+            [
+                "link add name {} mtu {} type veth peer name eth0 netns {}".format(
+                    node.uplink, mtu, node.ns
+                ),
+                "link set {} master br0 up".format(node.uplink),
+            ],
+        )
+        gateway = node.subnet.network_address + 1
+        commands = [
+            "link set eth0 mtu {} up".format(mtu),
+            "address add {}/{} dev eth0".format(node.address, UNDERLAY.prefixlen),
+            "link add name cni0 mtu {} type bridge".format(self.pod_mtu),
+            "address add {}/{} dev cni0".format(gateway, node.subnet.prefixlen),
+            "link set cni0 up",
+            "link add name veth0 mtu {} type veth peer name eth0 netns {}".format(
+                self.pod_mtu, node.pod_ns
+            ),
+            "link set veth0 master cni0 up",
+        ]
+        if self.backend == "vxlan":
+            device = backend_interfaces("vxlan", self.vni)[0]
+            commands += [
+                "link add name {} address {} mtu {} type vxlan id {} local {}"
+                " dev eth0 dstport {} nolearning".format(
+                    device,
+                    node.vtep_mac,
+                    self.device_mtu,
+                    self.vni,
+                    node.address,
+                    self.port,
+                ),
+                "address add {}/32 dev {}".format(node.subnet.network_address, device),
+                "link set {} up".format(device),
+            ]
+        self.ip(node.ns, commands)
+        self.run(
+            [
+                "ip",
+                "netns",
+                "exec",
+                node.ns,
+                "sysctl",
+                "-qw",
+                "net.ipv4.ip_forward=1",
+            ]
+        )
+        self.ip(
+            node.pod_ns,
+            [
+                "address add {}/{} dev eth0".format(
+                    node.pod_address, node.subnet.prefixlen
+                ),
+                "link set eth0 up",
+                "route add default via {}".format(gateway),
+            ],
+        )
+
+    def program_peers(self, node):
+        commands = []
+        for peer in self.nodes:
+            if peer is node:
+                continue
+            if self.backend == "vxlan":
+                device = backend_interfaces("vxlan", self.vni)[0]
+                gateway = peer.subnet.network_address
+                commands += [
+                    "route add {} via {} dev {} onlink".format(
+                        peer.subnet, gateway, device
+                    ),
+                    "neigh add {} lladdr {} dev {} nud permanent".format(
+                        gateway, peer.vtep_mac, device
+                    ),
+                ]
+                self.run(
+                    [
+                        "bridge",
+                        "-n",
+                        node.ns,
+                        "fdb",
+                        "append",
+                        peer.vtep_mac,
+                        "dev",
+                        device,
+                        "dst",
+                        str(peer.address),
+                        "self",
+                        "permanent",
+                    ]
+                )
+            else:
+                commands.append(
+                    "route add {} via {} dev eth0".format(peer.subnet, peer.address)
+                )
+        self.ip(node.ns, commands)
+
+    def add_masq_rules(self, node):
+        """Add the NAT and FORWARD rules flanneld adds for --ip-masq."""
+        network, subnet = self.network, node.subnet
+        rules = [
+            "*nat",
+            ":FLANNEL-POSTRTG - [0:0]",
+            '-A POSTROUTING -m comment --comment "flanneld masq" -j FLANNEL-POSTRTG',
+            "-A FLANNEL-POSTRTG -s {} -d {} -j RETURN".format(subnet, network),
+            "-A FLANNEL-POSTRTG -s {} -d {} -j RETURN".format(network, subnet),
+            "-A FLANNEL-POSTRTG ! -s {} -d {} -j RETURN".format(network, subnet),
+            "-A FLANNEL-POSTRTG -s {} ! -d 224.0.0.0/4 -j MASQUERADE"
+            " --random-fully".format(network),
+            "-A FLANNEL-POSTRTG ! -s {} -d {} -j MASQUERADE --random-fully".format(
+                network, network
+            ),
+            "COMMIT",
+            "*filter",
+            ":FLANNEL-FWD - [0:0]",
+            '-A FORWARD -m comment --comment "flanneld forward" -j FLANNEL-FWD',
+            "-A FLANNEL-FWD -s {} -j ACCEPT".format(network),
+            "-A FLANNEL-FWD -d {} -j ACCEPT".format(network),
+            "COMMIT",
+            "",
+        ]
+        self.run(
+            ["ip", "netns", "exec", node.ns, "iptables-restore", "--noflush"],
+            "\n".join(rules),
+        )
+
+    def teardown(self):
+        # Deleting a namespace deletes the devices in it and their veth peers.
+        for ns in reversed(self.namespaces):
+            subprocess.run(["ip", "netns", "delete", ns], capture_output=True)
+        self.namespaces = []
+
+    def measure(self, duration, rr_count, udp_size):
+        source, target = self.nodes[0], self.nodes[-1]
+        worker = [sys.executable, os.path.abspath(__file__)]
+        server = subprocess.Popen(
+            ["ip", "netns", "exec", target.pod_ns]
+            + worker
+            + ["serve", "--bind", str(target.pod_address)],
+            stdout=subprocess.PIPE,
+            universal_newlines=True,
+        )
+        try:
+            if server.stdout.readline().strip() != "ready":
+                raise RuntimeError("benchmark server failed to start")
+            output = subprocess.check_output(
+                ["ip", "netns", "exec", source.pod_ns]
+                + worker
+                + [
+                    "client",
+                    "--server",
+                    str(target.pod_address),
+                    "--duration",
+                    str(duration),
+                    "--rr-count",
+                    str(rr_count),
+                    "--udp-size",
+                    str(udp_size),
+                ],
+                universal_newlines=True,
+            )
+            server.wait(timeout=10)
+        finally:
+            if server.poll() is None:
+                server.kill()
+        return json.loads(output)
+
+    def describe(self):
+        return {
+            "backend": self.backend,
+            "vni": self.vni if self.backend == "vxlan" else None,
+            "port": self.port if self.backend == "vxlan" else None,
+            "nodes": len(self.nodes),
+            "underlay_mtu": self.underlay_mtu,
+            "device_mtu": self.device_mtu if self.backend == "vxlan" else None,
+            "pod_mtu": self.pod_mtu,
+            "ip_masq": self.ip_masq,
+            "network_config": self.config,
+        }
+
+
+def format_results(results):
+    stream, rr, udp = results["tcp_stream"], results["tcp_rr"], results["udp"]
+    config = results["config"]
+    return "\n".join(
+        [
+            "{} over {} nodes, underlay MTU {}, pod MTU {}, ip-masq {}".format(
+                config["backend"],
+                config["nodes"],
+                config["underlay_mtu"],
+                config["pod_mtu"],
+                "on" if config["ip_masq"] else "off",
+            ),
+            "tcp stream  {:>10.2f} Gbit/s".format(stream["gbps"]),
+            "udp {:>4}B   {:>10.0f} pps, {:.1%} loss".format(
+                udp["size"], udp["pps"], udp["loss"]
+            ),
+            "tcp rr      {:>10.1f}us p50, {:.1f}us p99".format(
+                rr["p50_us"], rr["p99_us"]
+            ),
+        ]
+    )
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    modes = parser.add_subparsers(dest="mode")
+    server = modes.add_parser("serve")
+    server.add_argument("--bind", required=True)
+    worker = modes.add_parser("client")
+    worker.add_argument("--server", required=True)
+    worker.add_argument("--duration", type=float, required=True)
+    worker.add_argument("--rr-count", type=int, required=True)
+    worker.add_argument("--udp-size", type=int, required=True)
+    parser.add_argument("--backend", choices=("vxlan", "host-gw"), default="vxlan")
+    parser.add_argument("--vni", type=int, default=0)
+    parser.add_argument("--port", type=int, default=0)
+    parser.add_argument("--cidr", default="10.1.0.0/16")
+    parser.add_argument("--subnet-len", type=int, default=24)
+    parser.add_argument("--underlay-mtu", type=int, default=1500)
+    parser.add_argument("--mtu", type=int, default=0, help="pod MTU override")
+    parser.add_argument("--ip-masq", action="store_true")
+    parser.add_argument("--nodes", type=int, default=2)
+    parser.add_argument("--duration", type=float, default=5)
+    parser.add_argument("--rr-count", type=int, default=5000)
+    parser.add_argument("--udp-size", type=int, default=64)
+    parser.add_argument("--json", action="store_true")
+    args = parser.parse_args(argv)
+
+    if args.mode == "serve":
+        return serve(args.bind)
+    if args.mode == "client":
+        return client(
+            args.server, BENCH_PORT, args.duration, args.rr_count, args.udp_size
+        )
+    if os.geteuid() != 0:
+        parser.error("must run as root to create network namespaces")
+    if args.nodes < 2:
+        parser.error("--nodes must be at least 2")
+    if args.ip_masq and not shutil.which("iptables-restore"):
+        parser.error("--ip-masq needs iptables-restore")
+
+    backend = backend_config(args.backend, vni=args.vni, port=args.port)
+    config = network_config(args.cidr, backend, subnet_len=args.subnet_len)
+    topology = Topology(config, args.nodes, args.underlay_mtu, args.ip_masq, args.mtu)
+    try:
+        topology.setup()
+        results = topology.measure(args.duration, args.rr_count, args.udp_size)
+    except subprocess.CalledProcessError as e:
+        sys.exit("{} failed: {}".format(" ".join(e.cmd), (e.stderr or "").strip()))
+    finally:
+        topology.teardown()
+    results["config"] = topology.describe()
+    if args.json:
+        print(json.dumps(results, indent=2, sort_keys=True))
+    else:
+        print(format_results(results))
+
+
+if __name__ == "__main__":
+    main()
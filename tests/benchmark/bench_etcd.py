@@ -0,0 +1,81 @@
+"""Compare the cost of writing the flannel network config to etcd.
+
+Times the old per-attempt `etcdctl put` fork against the in-charm JSON
+gateway client, which reuses a single connection across attempts.
+
+Usage:
+    PYTHONPATH=src/lib python tests/benchmark/bench_etcd.py \\
+        --endpoints https://10.0.0.1:2379 \\
+        --cert client-cert.pem --key client-key.pem --ca client-ca.pem
+"""
+import argparse
+import json
+import os
+import shutil
+import statistics
+import time
+from subprocess import check_call, DEVNULL
+
+from charms.flannel.etcd import EtcdClient
+
+KEY = "/flannel-benchmark/network/config"
+DATA = json.dumps({"Network": "10.1.0.0/16", "Backend": {"Type": "vxlan"}})
+
+
+def etcdctl_put(args):
+    cmd = [
+        "etcdctl",
+        "--endpoints",
+        args.endpoints,
+        "--cert",
+        args.cert,
+        "--key",
+        args.key,
+        "--cacert",
+        args.ca,
+        "put",
+        KEY,
+        DATA,
+    ]
+    check_call(cmd, env=dict(os.environ, ETCDCTL_API="3"), stdout=DEVNULL)
+
+
+def run(name, func, iterations):
+    samples = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        func()
+        samples.append((time.perf_counter() - start) * 1000)
+    samples.sort()
+    print(
+        "{:<10} n={} mean={:.2f}ms p50={:.2f}ms p99={:.2f}ms".format(
+            name,
+            iterations,
+            statistics.mean(samples),
+            samples[len(samples) // 2],
+            samples[int(len(samples) * 0.99) - 1],
+        )
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--endpoints", required=True)
+    parser.add_argument("--cert")
+    parser.add_argument("--key")
+    parser.add_argument("--ca")
+    parser.add_argument("-n", "--iterations", type=int, default=100)
+    args = parser.parse_args()
+
+    if shutil.which("etcdctl"):
+        run("etcdctl", lambda: etcdctl_put(args), args.iterations)
+    else:
+        print("etcdctl not found, skipping subprocess path")
+
+    client = EtcdClient(args.endpoints, args.cert, args.key, args.ca)
+    run("client", lambda: client.put(KEY, DATA), args.iterations)
+    client.close()
+
+
+if __name__ == "__main__":
+    main()
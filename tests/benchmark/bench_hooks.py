@@ -0,0 +1,538 @@
+"""Measure the cost of each charm hook and the reactive handlers it runs.
+
+Every handler in reactive/flannel.py is driven through the hooks of a unit's
+lifecycle. Subprocesses, etcd and the network are stubbed out, and all files
+are written below a temporary directory. Handlers run through Handler.invoke
+wrapped by charms.flannel.metrics.time_handlers, as on a unit with the
+metrics exporter enabled, so the cost of recording their timings is
+included. For each hook this reports the median wall time, the subprocesses
+the handlers would fork, the etcd requests they make and the files they
+read, write and remove.
+
+Needs charms.unit_test and pyyaml, as for the unit tests:
+
+    PYTHONPATH=src:src/lib python tests/benchmark/bench_hooks.py [--json]
+
+Use --max-ms to fail when any hook gets slower than a budget. To profile
+hooks on a real unit, see charms.flannel.profiling.
+"""
+import argparse
+import builtins
+import io
+import json
+import os
+import socket
+import statistics
+import sys
+import tarfile
+import tempfile
+import time
+from contextlib import ExitStack
+from unittest import mock
+
+import charms.unit_test
+import yaml
+
+charms.unit_test.patch_reactive()
+
+from charms.flannel import teardown, tuning  # noqa: E402
+from charms.flannel.metrics import time_handlers  # noqa: E402
+from charms.flannel.routes import DefaultRoute  # noqa: E402
+from reactive import flannel  # noqa: E402
+
+CONFIG_YAML = os.path.join(os.path.dirname(__file__), "..", "..", "src", "config.yaml")
+with open(CONFIG_YAML) as f:
+    CONFIG = {
+        name: option.get("default")
+        for name, option in yaml.safe_load(f)["options"].items()
+    }
+CONFIG["metrics-textfile-path"] = "/var/lib/prometheus/node-exporter/flannel.prom"
+SUBNET_ENV = "FLANNEL_NETWORK=10.1.0.0/16\nFLANNEL_SUBNET=10.1.5.1/24\n"
+NRPE_AVAILABLE = flannel.NRPE_EXTERNAL + ".available"
+
+
+class Counters:
+    def __init__(self):
+        self.subprocesses = 0
+        self.etcd = 0
+        self.reads = 0
+        self.writes = 0
+        self.removes = 0
+
+    def as_dict(self):
+        return dict(vars(self))
+
+
+class FakeEtcd:
+    """The parts of charms.flannel.etcd.EtcdClient the handlers use."""
+
+    def __init__(self, counters):
+        self.counters = counters
+        self.kvs = {}
+        self.revision = 0
+
+    def get(self, key):
+        self.counters.etcd += 1
+        return self.kvs.get(key)
+
+    def count(self, prefix):
+        self.counters.etcd += 1
+        return sum(1 for key in self.kvs if key.startswith(prefix))
+
+    def put_if_revision(self, key, value, mod_revision):
+        self.counters.etcd += 1
+        current = self.kvs.get(key)
+        if (current["mod_revision"] if current else 0) != mod_revision:
+            return False
+        self.revision += 1
+        self.kvs[key] = {"key": key, "value": value, "mod_revision": self.revision}
+        return True
+
+
+class BenchHandler:
+    """Stands in for charms.reactive.bus.Handler, mocked out here."""
+
+    def __init__(self, action, *args):
+        self._action = action
+        self._args = args
+
+    def invoke(self):
+        return self._action(*self._args)
+
+
+def build_resource(directory):
+    """Write a flannel resource tarball with the members the charm installs."""
+    path = os.path.join(directory, "flannel-amd64.tar.gz")
+    members = {
+        # Incompressible, so the archive passes the charm's size check.
+        "flanneld": os.urandom(1200 * 1024),
+        "etcdctl": os.urandom(64 * 1024),
+        "cni-plugin/flannel": os.urandom(64 * 1024),
+    }
+    with tarfile.open(path, "w:gz") as tar:
+        for name, data in members.items():
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            info.mode = 0o755
+            tar.addfile(info, io.BytesIO(data))
+    return path
+
+
+class Sandbox:
+    """One unit's filesystem, config and stubbed services."""
+
+    def __init__(self, root, archive):
+        self.root = root
+        self.archive = archive
+        self.config = dict(CONFIG)
+        self.counters = Counters()
+        self.client = FakeEtcd(self.counters)
+        self.store = {}
+        self.running = set()
+        self.etcd = mock.MagicMock()
+        self.etcd.get_connection_string.return_value = "https://10.0.0.1:2379"
+        self.etcd.get_client_credentials.return_value = {"client_cert": "cert"}
+        self.etcd.save_client_credentials.side_effect = self.save_credentials
+        self.cni = mock.MagicMock()
+        self.cni.config_available.return_value = True
+        kubeconfig = self.path("root/cdk/kubeconfig")
+        self.cni.get_config.return_value = {"kubeconfig_path": kubeconfig}
+
+    def path(self, path):
+        """Map an absolute path on the unit into the sandbox."""
+        if path.startswith(self.root):
+            return path
+        return os.path.join(self.root, path.lstrip("/"))
+
+    def inside(self, path):
+        return os.path.realpath(path).startswith(self.root + os.sep)
+
+    # Stubs for subprocesses and services.
+
+    def check_call(self, cmd, **kwargs):
+        self.counters.subprocesses += 1
+        return 0
+
+    def check_output(self, cmd, **kwargs):
+        self.counters.subprocesses += 1
+        if cmd[0] == "dpkg":
+            return b"amd64\n"
+        if cmd[0] == "flanneld":
+            return b"Flannel v0.22.0\n"
+        return b""
+
+    def service(self, action, name):
+        self.counters.subprocesses += 1
+        if action in ("start", "restart"):
+            self.running.add(name)
+        elif action == "stop":
+            self.running.discard(name)
+        return True
+
+    def run(self, cmd, input=None):
+        """Command runner for charms.flannel.teardown."""
+        self.counters.subprocesses += 1
+        return "[]" if "-j" in cmd else ""
+
+    def network_get(self, binding):
+        # A hook tool, so a fork like any other subprocess.
+        self.counters.subprocesses += 1
+        return {"bind-addresses": [{"interfacename": "ens3"}]}
+
+    def service_running(self, name):
+        self.counters.subprocesses += 1
+        return name in self.running
+
+    # Stubs for charmhelpers and charms.reactive helpers.
+
+    def render(self, source, target, context, perms=0o444, **kwargs):
+        target = self.path(target)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        with open(target, "w") as f:
+            f.write(json.dumps([source, context], sort_keys=True, default=str))
+        os.chmod(target, perms)
+
+    def data_changed(self, key, data):
+        value = json.dumps(data, sort_keys=True, default=str)
+        changed = self.store.get(key) != value
+        self.store[key] = value
+        return changed
+
+    def any_file_changed(self, paths):
+        changed = False
+        for path in paths:
+            path = self.path(path)
+            try:
+                with open(path, "rb") as f:
+                    value = f.read()
+            except FileNotFoundError:
+                value = None
+            changed |= self.store.get(path) != value
+            self.store[path] = value
+        return changed
+
+    def apply_tuning(self, sysctls, offloads, saved, conf_path):
+        return tuning.apply_tuning(
+            sysctls, offloads, saved, conf_path, self.root, self.run
+        )
+
+    def revert_tuning(self, saved, conf_path):
+        return tuning.revert_tuning(saved, conf_path, self.root, self.run)
+
+    def save_credentials(self, key, cert, ca):
+        for path in (key, cert, ca):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, "w") as f:
+                f.write(path)
+
+    def patches(self):
+        """Return the patches that run the charm against this sandbox."""
+        p = self.path
+        paths = {
+            name: p(getattr(flannel, name))
+            for name in (
+                "ETCD_PATH",
+                "ETCD_KEY_PATH",
+                "ETCD_CERT_PATH",
+                "ETCD_CA_PATH",
+                "KUBE_NET_CONF_PATH",
+                "CNI_CONFLIST_PATH",
+                "SYSCTL_CONF_PATH",
+                "SUBNET_ENV_PATH",
+                "FLANNEL_SERVICE_PATH",
+                "METRICS_SERVICE_PATH",
+                "METRICS_TIMER_PATH",
+                "NAGIOS_PLUGIN_PATH",
+                "STATE_DIR",
+                "LEASE_TTL_PATH",
+                "RESOURCE_CACHE_DIR",
+                "HANDLER_TIMINGS_PATH",
+                "LEASE_SNAPSHOT_PATH",
+            )
+        }
+        paths["FLANNEL_BINARIES"] = {
+            name: p(dest) for name, dest in flannel.FLANNEL_BINARIES.items()
+        }
+        route = DefaultRoute("ens3", "10.0.0.1", 100, socket.AF_INET, 1500)
+        kv = charms.unit_test.MockKV()
+        stubs = dict(
+            paths,
+            config=self.config.get,
+            resource_get=lambda name: self.archive,
+            get_client=lambda *args: self.client,
+            default_route=lambda root="/": route,
+            interface_mtu=lambda iface, root="/": 1500,
+            network_get=self.network_get,
+            check_call=self.check_call,
+            check_output=self.check_output,
+            service=self.service,
+            service_start=lambda name: self.service("start", name),
+            service_stop=lambda name: self.service("stop", name),
+            service_restart=lambda name: self.service("restart", name),
+            service_running=self.service_running,
+            render=self.render,
+            data_changed=self.data_changed,
+            any_file_changed=self.any_file_changed,
+            teardown=lambda networks: teardown.teardown(networks, self.root, self.run),
+            apply_tuning=self.apply_tuning,
+            revert_tuning=self.revert_tuning,
+        )
+        patches = [mock.patch.object(flannel, k, v) for k, v in stubs.items()]
+        patches.append(mock.patch.object(flannel.unitdata, "kv", return_value=kv))
+        charm_dir = p("var/lib/juju/agents/unit-flannel-0/charm")
+        patches.append(mock.patch.dict(os.environ, CHARM_DIR=charm_dir))
+        return patches
+
+
+def track_files(sandbox):
+    """Count file I/O, refusing to write or remove anything outside root."""
+    real_open = builtins.open
+    real_remove = os.remove
+
+    def counting_open(file, mode="r", *args, **kwargs):
+        if not isinstance(file, int):
+            if set(mode) & set("wax+"):
+                if not sandbox.inside(os.fspath(file)):
+                    raise RuntimeError("refusing to write {}".format(file))
+                sandbox.counters.writes += 1
+            else:
+                sandbox.counters.reads += 1
+        return real_open(file, mode, *args, **kwargs)
+
+    def counting_replace(src, dst, *args, **kwargs):
+        if not sandbox.inside(os.fspath(dst)):
+            raise RuntimeError("refusing to replace {}".format(dst))
+        sandbox.counters.writes += 1
+        return os.rename(src, dst)
+
+    def counting_remove(path, *args, **kwargs):
+        sandbox.counters.removes += 1
+        if sandbox.inside(os.fspath(path)):
+            return real_remove(path, *args, **kwargs)
+        # Paths the charm hardcodes are left alone on the host.
+        if not os.path.exists(path):
+            raise FileNotFoundError(path)
+
+    return [
+        mock.patch.object(builtins, "open", counting_open),
+        mock.patch.object(os, "replace", counting_replace),
+        mock.patch.object(os, "remove", counting_remove),
+    ]
+
+
+def hooks(sandbox):
+    """Return (hook, config changes, flags, handlers and their arguments).
+
+    The flags, such as those of relations, are set or cleared before the
+    hook runs.
+    """
+    f, etcd, cni = flannel, sandbox.etcd, sandbox.cni
+    configure = [
+        (f.install_flannel_service, etcd),
+        (f.invoke_configure_network, etcd),
+        (f.configure_cni, cni),
+        (f.start_flannel_service,),
+        (f.apply_tuning_profile,),
+        (f.set_available, cni),
+        (f.ready,),
+    ]
+    return [
+        (
+            "install",
+            {},
+            {},
+            [
+                (f.install_flannel_binaries,),
+                (f.set_flannel_version,),
+                (f.halt_execution,),
+            ],
+        ),
+        (
+            "etcd-relation-changed",
+            {},
+            {},
+            [
+                (f.install_etcd_credentials, etcd),
+                (f.install_flannel_service, etcd),
+                (f.invoke_configure_network, etcd),
+                (f.start_flannel_service,),
+                (f.apply_tuning_profile,),
+                (f.etcd_changed, etcd),
+            ],
+        ),
+        (
+            "cni-relation-changed",
+            {},
+            {},
+            [(f.configure_cni, cni), (f.set_available, cni), (f.ready,)],
+        ),
+        (
+            "nrpe-external-master-relation-changed",
+            {},
+            {NRPE_AVAILABLE: True},
+            [
+                (f.initial_nrpe_config,),
+                (f.enable_lease_snapshot,),
+                (f.install_flannel_service, etcd),
+                (f.start_flannel_service,),
+            ],
+        ),
+        (
+            "update-status",
+            {},
+            {},
+            [(f.etcd_changed, etcd), (f.refresh_subnet_usage, etcd), (f.ready,)],
+        ),
+        (
+            "config-changed",
+            {"cidr": "10.2.0.0/16", "iface": "ens3", "tuning-profile": "throughput"},
+            {},
+            [
+                (f.reconfigure_cni,),
+                (f.reconfigure_flannel_service,),
+                (f.reconfigure_network,),
+                (f.reconfigure_tuning,),
+            ]
+            + configure
+            + [(f.update_nrpe_config,)],
+        ),
+        (
+            "upgrade-charm",
+            {},
+            {},
+            [(f.reset_states_and_redeploy,), (f.install_flannel_binaries,)]
+            + configure,
+        ),
+        (
+            "nrpe-external-master-relation-departed",
+            {},
+            {NRPE_AVAILABLE: False},
+            [
+                (f.disable_lease_snapshot,),
+                (f.install_flannel_service, etcd),
+                (f.start_flannel_service,),
+            ],
+        ),
+        (
+            "config-changed (kube subnet manager)",
+            {"subnet-manager": "kube"},
+            {},
+            [
+                (f.update_subnet_manager,),
+                (f.configure_network_kube,),
+                (f.install_flannel_service_kube, cni),
+                (f.kubeconfig_changed, cni),
+                (f.start_flannel_service,),
+                (f.apply_tuning_profile,),
+                (f.ready,),
+            ],
+        ),
+        ("pre-series-upgrade", {}, {}, [(f.pre_series_upgrade,)]),
+        ("stop", {}, {}, [(f.cleanup_deployment,)]),
+    ]
+
+
+def populate(sandbox):
+    """Write the files of a unit the charm reads but does not create."""
+    files = {
+        flannel.SUBNET_ENV_PATH: SUBNET_ENV,
+        "/root/cdk/kubeconfig": "apiVersion: v1\nkind: Config\n",
+    }
+    # Every sysctl a tuning profile sets, at a value none of them uses.
+    for profile in tuning.PROFILES:
+        for name in tuning.profile_sysctls(profile):
+            files["/proc/sys/" + name.replace(".", "/")] = "1\n"
+    for path, content in files.items():
+        path = sandbox.path(path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "w") as f:
+            f.write(content)
+
+
+def run_lifecycle(archive):
+    """Run every hook once on a fresh unit, returning per hook results."""
+    results = []
+    with tempfile.TemporaryDirectory(prefix="flannel-bench-") as root:
+        sandbox = Sandbox(os.path.realpath(root), archive)
+        populate(sandbox)
+        # Time the handlers the way the charm does with the exporter enabled.
+        timed = type("TimedHandler", (BenchHandler,), {})
+        timings = sandbox.path(flannel.HANDLER_TIMINGS_PATH)
+        time_handlers(timed, flannel.__name__, timings)
+        with ExitStack() as stack:
+            for patch in sandbox.patches() + track_files(sandbox):
+                stack.enter_context(patch)
+            for hook, config, flags, handlers in hooks(sandbox):
+                sandbox.config.update(config)
+                for flag, value in flags.items():
+                    (flannel.set_state if value else flannel.remove_state)(flag)
+                # As in the charm, the stop hook records no timings.
+                handler_class = timed
+                if hook == "stop" or not sandbox.config["metrics-textfile-path"]:
+                    handler_class = BenchHandler
+                sandbox.counters = sandbox.client.counters = Counters()
+                start = time.perf_counter()
+                for handler in handlers:
+                    handler_class(*handler).invoke()
+                elapsed = time.perf_counter() - start
+                result = dict(sandbox.counters.as_dict(), hook=hook)
+                result["handlers"] = [h.__name__ for h, *_ in handlers]
+                result["ms"] = elapsed * 1000
+                results.append(result)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("-n", "--iterations", type=int, default=20)
+    parser.add_argument("--json", action="store_true", help="print JSON results")
+    parser.add_argument("--max-ms", type=float, help="fail above this median")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(prefix="flannel-resource-") as directory:
+        archive = build_resource(directory)
+        runs = [run_lifecycle(archive) for _ in range(args.iterations)]
+
+    summary = []
+    for results in zip(*runs):
+        hook = dict(results[-1])
+        hook["ms"] = statistics.median(r["ms"] for r in results)
+        hook["max_ms"] = max(r["ms"] for r in results)
+        summary.append(hook)
+
+    if args.json:
+        print(json.dumps(summary, indent=2))
+    else:
+        handlers = {h for hook in summary for h in hook["handlers"]}
+        print(
+            "{} handlers over {} hooks, n={}".format(
+                len(handlers), len(summary), args.iterations
+            )
+        )
+        columns = ("p50 ms", "max ms", "subproc", "etcd", "reads", "writes", "removes")
+        header = "{:<40} {:>8} {:>8} {:>8} {:>5} {:>6} {:>6} {:>7}"
+        print(header.format("hook", *columns))
+        row = "{:<40} {:>8.2f} {:>8.2f} {:>8} {:>5} {:>6} {:>6} {:>7}"
+        for hook in summary:
+            print(
+                row.format(
+                    hook["hook"],
+                    hook["ms"],
+                    hook["max_ms"],
+                    hook["subprocesses"],
+                    hook["etcd"],
+                    hook["reads"],
+                    hook["writes"],
+                    hook["removes"],
+                )
+            )
+
+    if args.max_ms is not None:
+        slow = [hook["hook"] for hook in summary if hook["ms"] > args.max_ms]
+        if slow:
+            print("Slower than {}ms: {}".format(args.max_ms, ", ".join(slow)))
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,37 @@
+"""Compare default route discovery via /proc with forking `route`.
+
+Usage:
+    PYTHONPATH=src/lib python tests/benchmark/bench_routes.py
+"""
+import shutil
+import timeit
+from subprocess import check_output
+
+from charms.flannel.routes import default_route
+
+
+def route_subprocess():
+    output = check_output(["route"]).decode("utf8")
+    for line in output.split("\n"):
+        if "default" in line:
+            return line.split(" ")[-1]
+
+
+def proc_uncached():
+    default_route.cache_clear()
+    return default_route()
+
+
+def main(number=200):
+    benchmarks = [("proc", proc_uncached), ("proc cached", default_route)]
+    if shutil.which("route"):
+        benchmarks.insert(0, ("route", route_subprocess))
+    else:
+        print("route not found, skipping subprocess path")
+    for name, func in benchmarks:
+        secs = timeit.timeit(func, number=number)
+        print("{:<12} {:>10.1f}us/call".format(name, secs / number * 1e6))
+
+
+if __name__ == "__main__":
+    main()
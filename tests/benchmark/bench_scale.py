@@ -0,0 +1,548 @@
+"""Simulate hundreds of flannel units converging on one etcd cluster.
+
+Every simulated unit runs the etcd facing handlers of reactive/flannel.py
+in its own thread, with its own config, unitdata, flags and etcd client, as
+the units of a large deployment do when their hooks fire together:
+
+    join            etcd-relation-changed on a new unit, then flanneld
+                    leasing a subnet for it
+    config-changed  every unit writing a new cidr to the network config
+    churn           some units leaving, their leases expiring, and as many
+                    new units joining
+
+The units talk HTTP to an etcd stand-in served in process, which
+serialises writes behind a simulated commit delay, or to a real etcd
+started from --etcd-binary. Per phase this reports p50/p99/max hook
+latency, etcd requests, write amplification (write requests per write the
+phase needs), units whose etcd negotiation failed and was deferred to a
+later hook, and lease conflicts.
+
+Needs charms.unit_test and pyyaml, as for the unit tests:
+
+    PYTHONPATH=src:src/lib python tests/benchmark/bench_scale.py --units 500
+
+Use --max-p99-ms to fail when any phase gets slower than a budget.
+"""
+import argparse
+import base64
+import json
+import os
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest import mock
+
+import charms.unit_test
+import yaml
+
+charms.unit_test.patch_reactive()
+
+from charms.flannel.etcd import EtcdClient  # noqa: E402
+from charms.flannel.network import plan_subnets  # noqa: E402
+from reactive import flannel  # noqa: E402
+
+# Room for 4095 node subnets of the default /24.
+CIDRS = ("10.64.0.0/12", "10.96.0.0/12")
+CONFIG_YAML = os.path.join(os.path.dirname(__file__), "..", "..", "src", "config.yaml")
+with open(CONFIG_YAML) as f:
+    CONFIG = {
+        name: option.get("default")
+        for name, option in yaml.safe_load(f)["options"].items()
+    }
+CONFIG.update(cidr=CIDRS[0], iface="ens3")
+
+
+def _b64(value):
+    return base64.b64decode(value or "")
+
+
+class StandIn(BaseHTTPRequestHandler):
+    """The etcd v3 JSON gateway calls the charm and flanneld make.
+
+    Writes are applied one at a time, each holding the store for the
+    commit delay, as etcd's raft log and fsync serialise them.
+    """
+
+    protocol_version = "HTTP/1.1"
+
+    def do_POST(self):
+        server = self.server
+        payload = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        if self.path == "/v3/kv/range":
+            with server.lock:
+                response = self.range(payload)
+        elif self.path == "/v3/kv/put":
+            with server.lock:
+                time.sleep(server.commit_secs)
+                self.put(payload["key"], payload["value"])
+                response = {"header": {"revision": str(server.revision)}}
+        elif self.path == "/v3/kv/txn":
+            with server.lock:
+                response = self.txn(payload)
+        else:
+            self.send_response(404)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        body = json.dumps(response).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def range(self, payload):
+        store = self.server.store
+        start = _b64(payload["key"])
+        end = _b64(payload.get("range_end")) or start + b"\0"
+        keys = sorted(k for k in store if start <= k < end)
+        response = {
+            "header": {"revision": str(self.server.revision)},
+            "count": str(len(keys)),
+        }
+        limit = payload.get("limit", 0)
+        if limit and len(keys) > limit:
+            keys = keys[:limit]
+            response["more"] = True
+        if not payload.get("count_only"):
+            response["kvs"] = [
+                {
+                    "key": base64.b64encode(k).decode("ascii"),
+                    "value": store[k][0],
+                    "mod_revision": str(store[k][1]),
+                }
+                for k in keys
+            ]
+        return response
+
+    def put(self, key, value):
+        self.server.revision += 1
+        self.server.store[_b64(key)] = (value, self.server.revision)
+
+    def txn(self, payload):
+        store = self.server.store
+        succeeded = all(
+            store.get(_b64(c["key"]), (None, 0))[1] == int(c["mod_revision"])
+            for c in payload["compare"]
+        )
+        if succeeded:
+            time.sleep(self.server.commit_secs)
+            self.server.revision += 1
+            for op in payload["success"]:
+                if "request_put" in op:
+                    put = op["request_put"]
+                    store[_b64(put["key"])] = (put["value"], self.server.revision)
+                else:
+                    store.pop(_b64(op["request_delete_range"]["key"]), None)
+        return {
+            "header": {"revision": str(self.server.revision)},
+            "succeeded": succeeded,
+        }
+
+    def log_message(self, *args):
+        pass
+
+
+class StandInServer(ThreadingHTTPServer):
+    daemon_threads = True
+    # Every unit keeps a connection open, and they all connect at once.
+    request_queue_size = 1024
+
+
+def start_stand_in(commit_ms):
+    server = StandInServer(("127.0.0.1", 0), StandIn)
+    server.store = {}
+    server.revision = 0
+    server.lock = threading.Lock()
+    server.commit_secs = commit_ms / 1000
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return "http://127.0.0.1:{}".format(server.server_address[1]), server.shutdown
+
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def start_etcd(binary, data_dir):
+    client_url = "http://127.0.0.1:{}".format(_free_port())
+    peer_url = "http://127.0.0.1:{}".format(_free_port())
+    process = subprocess.Popen(
+        [
+            binary,
+            "--data-dir",
+            data_dir,
+            "--listen-client-urls",
+            client_url,
+            "--advertise-client-urls",
+            client_url,
+            "--listen-peer-urls",
+            peer_url,
+            "--initial-advertise-peer-urls",
+            peer_url,
+            "--initial-cluster",
+            "default=" + peer_url,
+        ],
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        try:
+            urllib.request.urlopen(client_url + "/health", timeout=1)
+            break
+        except OSError:
+            time.sleep(0.1)
+    else:
+        process.kill()
+        sys.exit("etcd did not become healthy")
+
+    def stop():
+        process.terminate()
+        process.wait()
+
+    return client_url, stop
+
+
+class Stats:
+    """Thread safe counters for one phase."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counts = {}
+        self.hook_ms = []
+
+    def add(self, name, value=1):
+        with self.lock:
+            self.counts[name] = self.counts.get(name, 0) + value
+
+    def hook(self, ms):
+        with self.lock:
+            self.hook_ms.append(ms)
+
+
+class CountingClient(EtcdClient):
+    """An EtcdClient counting its requests by kind into the current Stats."""
+
+    def __init__(self, endpoint, harness):
+        super().__init__(endpoint, timeout=60)
+        self.harness = harness
+
+    def request(self, path, payload):
+        stats = self.harness.stats
+        response = super().request(path, payload)
+        kind = path.rsplit("/", 1)[-1]
+        if kind == "txn":
+            ops = payload["success"]
+            kind = "delete" if "request_delete_range" in ops[0] else "txn"
+            if not response.get("succeeded"):
+                stats.add(kind + "_failed")
+            else:
+                stats.add("writes")
+        elif kind == "put":
+            stats.add("writes")
+        stats.add(kind)
+        return response
+
+
+class Unit:
+    def __init__(self, number, endpoint, harness):
+        self.name = "flannel/{}".format(number)
+        self.address = "172.16.{}.{}".format(number // 250, number % 250 + 1)
+        self.config = dict(harness.config)
+        self.kv = charms.unit_test.MockKV()
+        self.store = {}
+        self.flags = set()
+        self.status = None
+        self.client = CountingClient(endpoint, harness)
+        self.etcd = mock.MagicMock()
+        self.etcd.get_connection_string.return_value = endpoint
+        self.etcd.get_client_credentials.return_value = {"client_cert": "cert"}
+        self.lease = None
+
+    def data_changed(self, key, data):
+        value = json.dumps(data, sort_keys=True)
+        changed = self.store.get(key) != value
+        self.store[key] = value
+        return changed
+
+
+class Harness:
+    """Runs handlers for many units, each in a thread of its own."""
+
+    def __init__(self, endpoint, concurrency):
+        self.endpoint = endpoint
+        self.concurrency = concurrency
+        self.local = threading.local()
+        self.stats = Stats()
+        self.units = []
+        self.next_unit = 0
+        # The application config, which new units start with.
+        self.config = dict(CONFIG)
+
+    def unit(self):
+        return self.local.unit
+
+    def add_units(self, count):
+        units = []
+        for _ in range(count):
+            units.append(Unit(self.next_unit, self.endpoint, self))
+            self.next_unit += 1
+        self.units.extend(units)
+        return units
+
+    def patches(self):
+        """Route the charm's helpers to the unit of the calling thread."""
+        unit = self.unit
+        harness = self
+
+        class Status:
+            def __getattr__(self, name):
+                def set_status(message):
+                    unit().status = (name, message)
+
+                return set_status
+
+        def check_subnet_capacity(client):
+            # Called once per attempt to reach etcd.
+            harness.stats.add("configure_attempts")
+            return real_check_subnet_capacity(client)
+
+        real_check_subnet_capacity = flannel.check_subnet_capacity
+        stubs = dict(
+            config=lambda key=None: unit().config.get(key),
+            status=Status(),
+            log=lambda *args, **kwargs: None,
+            set_state=lambda flag: unit().flags.add(flag),
+            remove_state=lambda flag: unit().flags.discard(flag),
+            is_state=lambda flag: flag in unit().flags,
+            data_changed=lambda key, data: unit().data_changed(key, data),
+            get_client=lambda *args: unit().client,
+            check_subnet_capacity=check_subnet_capacity,
+            render=lambda *args, **kwargs: None,
+            any_file_changed=lambda paths: False,
+            check_call=lambda *args, **kwargs: None,
+            service=lambda *args: True,
+        )
+        patches = [mock.patch.object(flannel, k, v) for k, v in stubs.items()]
+        patches.append(mock.patch.object(flannel.unitdata, "kv", lambda: unit().kv))
+        patches.append(mock.patch.dict(os.environ, CHARM_DIR="/var/lib/juju/charm"))
+        return patches
+
+    def run(self, units, hook):
+        """Run hook(unit) for each unit concurrently, timing each one."""
+
+        def run_one(u):
+            self.local.unit = u
+            start = time.perf_counter()
+            hook(u)
+            self.stats.hook((time.perf_counter() - start) * 1000)
+
+        with ThreadPoolExecutor(self.concurrency) as pool:
+            for future in [pool.submit(run_one, u) for u in units]:
+                future.result()
+
+    def join(self, unit):
+        """etcd-relation-changed on a new unit, then flanneld starting."""
+        unit.flags.update(
+            {"flannel.binaries.installed", "flannel.etcd.credentials.installed"}
+        )
+        flannel.invoke_configure_network(unit.etcd)
+        flannel.install_flannel_service(unit.etcd)
+        flannel.etcd_changed(unit.etcd)
+        acquire_lease(unit, self.stats)
+
+    def change_cidr(self, unit):
+        """config-changed with a new cidr."""
+        unit.config["cidr"] = self.config["cidr"]
+        flannel.reconfigure_network()
+        flannel.invoke_configure_network(unit.etcd)
+
+
+def acquire_lease(unit, stats):
+    """Lease a free subnet the way flanneld does, retrying on conflict.
+
+    flanneld lists the leases, picks a random free subnet and creates its
+    key only if nobody else has in the meantime.
+    """
+    client = unit.client
+    config = json.loads(client.get(flannel.NETWORK_CONFIG_KEY)["value"])
+    plan = plan_subnets(config["Network"], config["SubnetLen"])
+    size = 2 ** (32 - plan.subnet_len)
+    value = json.dumps({"PublicIP": unit.address, "BackendType": "vxlan"})
+    while True:
+        taken = {kv["key"] for kv in client.iter_prefix(flannel.SUBNET_LEASE_PREFIX)}
+        free = []
+        for i in range(plan.max_nodes):
+            subnet = "{}-{}".format(plan.subnet_min + i * size, plan.subnet_len)
+            key = flannel.SUBNET_LEASE_PREFIX + subnet
+            if key not in taken:
+                free.append(key)
+                if len(free) == 100:
+                    break
+        if not free:
+            raise RuntimeError("no free subnet for {}".format(unit.name))
+        key = random.choice(free)
+        if client.put_if_revision(key, value, 0):
+            unit.lease = key
+            return
+        stats.add("lease_conflicts")
+
+
+def expire_lease(unit):
+    kv = unit.client.get(unit.lease)
+    if kv:
+        unit.client.delete_if_revisions([(unit.lease, kv["mod_revision"])])
+
+
+def percentile(samples, fraction):
+    samples = sorted(samples)
+    return samples[max(int(len(samples) * fraction + 0.5) - 1, 0)]
+
+
+def summarize(phase, stats, needed_writes, units, deferred):
+    counts = stats.counts
+    write_kinds = ("put", "txn", "delete", "txn_failed", "delete_failed")
+    write_requests = sum(counts.get(k, 0) for k in write_kinds)
+    requests = write_requests + counts.get("range", 0)
+    return {
+        "phase": phase,
+        "units": units,
+        "p50_ms": percentile(stats.hook_ms, 0.5),
+        "p99_ms": percentile(stats.hook_ms, 0.99),
+        "max_ms": max(stats.hook_ms),
+        "etcd_requests": requests,
+        "etcd_reads": counts.get("range", 0),
+        "etcd_writes": counts.get("writes", 0),
+        "failed_txns": counts.get("txn_failed", 0) + counts.get("delete_failed", 0),
+        "write_amplification": write_requests / needed_writes if needed_writes else 0,
+        "configure_attempts": counts.get("configure_attempts", 0),
+        "deferred": deferred,
+        "lease_conflicts": counts.get("lease_conflicts", 0),
+    }
+
+
+def run(harness, args):
+    results = []
+
+    def phase(name, units, hook, needed_writes):
+        harness.stats = Stats()
+        harness.run(units, hook)
+        deferred = sum(1 for u in units if u.kv.get(flannel.NEGOTIATION_KEY))
+        results.append(
+            summarize(name, harness.stats, needed_writes, len(units), deferred)
+        )
+
+    # The network config once, then one lease per unit.
+    units = harness.add_units(args.units)
+    phase("join", units, harness.join, 1 + len(units))
+    # One write of the new network config.
+    harness.config["cidr"] = CIDRS[1]
+    phase("config-changed", harness.units, harness.change_cidr, 1)
+    churn = int(len(harness.units) * args.churn)
+    leaving = random.sample(harness.units, churn)
+    for unit in leaving:
+        harness.local.unit = unit
+        expire_lease(unit)
+        harness.units.remove(unit)
+    # A lease per joining unit; the config is already in place.
+    phase("churn", harness.add_units(churn), harness.join, churn)
+    return results
+
+
+def format_results(results):
+    columns = (
+        "p50 ms",
+        "p99 ms",
+        "max ms",
+        "requests",
+        "writes",
+        "failed",
+        "amplif",
+        "deferred",
+        "conflicts",
+    )
+    lines = ["{:<16}{:>6}".format("phase", "units") + "".join(
+        "{:>10}".format(c) for c in columns
+    )]
+    for r in results:
+        values = (
+            "{:.1f}".format(r["p50_ms"]),
+            "{:.1f}".format(r["p99_ms"]),
+            "{:.1f}".format(r["max_ms"]),
+            r["etcd_requests"],
+            r["etcd_writes"],
+            r["failed_txns"],
+            "{:.2f}".format(r["write_amplification"]),
+            r["deferred"],
+            r["lease_conflicts"],
+        )
+        lines.append(
+            "{:<16}{:>6}".format(r["phase"], r["units"])
+            + "".join("{:>10}".format(v) for v in values)
+        )
+    return "\n".join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--units", type=int, default=500)
+    parser.add_argument("--concurrency", type=int, default=100)
+    parser.add_argument(
+        "--churn", type=float, default=0.1, help="fraction of units replaced"
+    )
+    parser.add_argument(
+        "--commit-ms", type=float, default=2, help="stand-in write commit delay"
+    )
+    parser.add_argument("--etcd-binary", help="run against a real etcd instead")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", action="store_true", help="print JSON results")
+    parser.add_argument("--max-p99-ms", type=float, help="fail above this p99")
+    args = parser.parse_args()
+    random.seed(args.seed)
+
+    with ExitStack() as stack:
+        if args.etcd_binary:
+            if not shutil.which(args.etcd_binary):
+                parser.error("{} not found".format(args.etcd_binary))
+            data_dir = stack.enter_context(tempfile.TemporaryDirectory())
+            endpoint, stop = start_etcd(args.etcd_binary, data_dir)
+        else:
+            endpoint, stop = start_stand_in(args.commit_ms)
+        stack.callback(stop)
+        harness = Harness(endpoint, args.concurrency)
+        for patch in harness.patches():
+            stack.enter_context(patch)
+        results = run(harness, args)
+        for unit in harness.units:
+            unit.client.close()
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        print(
+            "{} units, {} concurrent hooks, {}".format(
+                args.units,
+                args.concurrency,
+                "etcd" if args.etcd_binary else "stand-in etcd",
+            )
+        )
+        print(format_results(results))
+    if args.max_p99_ms is not None:
+        slow = [r["phase"] for r in results if r["p99_ms"] > args.max_p99_ms]
+        if slow:
+            sys.exit("p99 over {}ms: {}".format(args.max_p99_ms, ", ".join(slow)))
+
+
+if __name__ == "__main__":
+    main()
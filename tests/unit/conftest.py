@@ -1,4 +1,17 @@
 import charms.unit_test
+import pytest
 
 
 charms.unit_test.patch_reactive()
+
+
+@pytest.fixture(autouse=True)
+def reset_reactive():
+    """Give each test fresh flags and call counts on the shared mocks."""
+    from charms import layer, reactive
+
+    yield
+    charms.unit_test.flags.clear()
+    reactive.set_state.reset_mock()
+    reactive.remove_state.reset_mock()
+    layer.status.reset_mock()
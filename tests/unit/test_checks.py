@@ -0,0 +1,153 @@
+import json
+import time
+
+import pytest
+
+from charms.flannel import checks
+
+# Two remote nodes as flanneld programs them on flannel.1.
+ROUTES = [
+    {"dst": "10.1.6.0/24", "gateway": "10.1.6.0", "flags": ["onlink"]},
+    {"dst": "10.1.7.0/24", "gateway": "10.1.7.0", "flags": ["onlink"]},
+]
+NEIGH = [
+    {"dst": "10.1.6.0", "lladdr": "aa:bb:cc:dd:ee:06", "state": ["PERMANENT"]},
+    {"dst": "10.1.7.0", "lladdr": "aa:bb:cc:dd:ee:07", "state": ["PERMANENT"]},
+]
+FDB = [
+    {"mac": "aa:bb:cc:dd:ee:06", "dst": "10.0.0.6", "flags": ["self"]},
+    {"mac": "aa:bb:cc:dd:ee:07", "dst": "10.0.0.7", "flags": ["self"]},
+]
+
+
+def _run_json(routes=ROUTES, neigh=NEIGH, fdb=FDB):
+    outputs = {"route": routes, "neigh": neigh, "fdb": fdb}
+    return lambda cmd: outputs[cmd[2]]
+
+
+def _snapshot(**overrides):
+    snapshot = {
+        "timestamp": time.time(),
+        "subnet": "10.1.5.0-24",
+        "ttl": 86000,
+        "leases": {
+            "10.1.5.0-24": {"public_ip": "10.0.0.5", "vtep_mac": "aa:bb:cc:dd:ee:05"},
+            "10.1.6.0-24": {"public_ip": "10.0.0.6", "vtep_mac": "aa:bb:cc:dd:ee:06"},
+            "10.1.7.0-24": {"public_ip": "10.0.0.7", "vtep_mac": "aa:bb:cc:dd:ee:07"},
+        },
+    }
+    snapshot.update(overrides)
+    return snapshot
+
+
+def test_fdb_ok():
+    status, message = checks.check_fdb("flannel.1", _snapshot(), _run_json())
+    assert status == checks.OK
+    assert message == "flannel.1 has 2 peers"
+
+
+def test_fdb_missing_neighbour():
+    status, message = checks.check_fdb("flannel.1", run_json=_run_json(neigh=NEIGH[:1]))
+    assert status == checks.CRITICAL
+    assert "neighbour 10.1.7.0" in message
+
+
+def test_fdb_missing_lease_entry():
+    leases = dict(_snapshot()["leases"])
+    leases["10.1.8.0-24"] = {"public_ip": "10.0.0.8", "vtep_mac": "aa:bb:cc:dd:ee:08"}
+    snapshot = _snapshot(leases=leases)
+    status, message = checks.check_fdb("flannel.1", snapshot, _run_json())
+    assert status == checks.CRITICAL
+    assert message == "flannel.1 missing: fdb aa:bb:cc:dd:ee:08 -> 10.0.0.8"
+
+
+def test_fdb_direct_routing():
+    # 10.1.8.0/24 is on the same L2 and routed over the underlay instead.
+    leases = dict(_snapshot()["leases"])
+    leases["10.1.8.0-24"] = {"public_ip": "10.0.0.8", "vtep_mac": "aa:bb:cc:dd:ee:08"}
+    snapshot = _snapshot(leases=leases)
+    status, _ = checks.check_fdb("flannel.1", snapshot, _run_json(), True)
+    assert status == checks.OK
+    status, _ = checks.check_fdb("flannel.1", snapshot, _run_json(fdb=FDB[:1]), True)
+    assert status == checks.CRITICAL
+
+
+def test_fdb_stale_entry():
+    fdb = FDB + [{"mac": "aa:bb:cc:dd:ee:09", "dst": "10.0.0.9", "flags": ["self"]}]
+    status, message = checks.check_fdb("flannel.1", _snapshot(), _run_json(fdb=fdb))
+    assert status == checks.WARNING
+    assert message == "flannel.1 stale fdb entries: aa:bb:cc:dd:ee:09"
+
+
+def test_fdb_unreadable():
+    with pytest.raises(checks.CheckError):
+        checks.check_fdb("flannel.1", run_json=lambda cmd: None)
+
+
+@pytest.mark.parametrize(
+    "ttl, expected",
+    [(86000, checks.OK), (2000, checks.WARNING), (300, checks.CRITICAL)],
+)
+def test_lease(ttl, expected):
+    status, _ = checks.check_lease(_snapshot(ttl=ttl))
+    assert status == expected
+
+
+def test_lease_thresholds():
+    assert checks.lease_thresholds() == (3000, 900)
+    warn, crit = checks.lease_thresholds(10)
+    # Ten minutes before expiry flanneld has not renewed the lease yet.
+    status, _ = checks.check_lease(_snapshot(ttl=700), warn, crit)
+    assert status == checks.OK
+    status, _ = checks.check_lease(_snapshot(ttl=300), warn, crit)
+    assert status == checks.WARNING
+
+
+def test_lease_counts_down_from_snapshot():
+    snapshot = _snapshot(ttl=4000)
+    now = snapshot["timestamp"] + 2000
+    status, message = checks.check_lease(snapshot, now=now)
+    assert status == checks.WARNING
+    assert message == "lease for 10.1.5.0-24 expires in 2000s"
+
+
+def test_lease_missing():
+    status, _ = checks.check_lease(_snapshot(subnet=None))
+    assert status == checks.CRITICAL
+
+
+def test_load_snapshot_stale(tmp_path):
+    path = tmp_path / "leases.json"
+    path.write_text(json.dumps(_snapshot(timestamp=0)))
+    with pytest.raises(checks.CheckError):
+        checks.load_snapshot(str(path))
+
+
+def _mtu_root(tmp_path, device_mtu, underlay_mtu):
+    for iface, mtu in (("flannel.1", device_mtu), ("ens3", underlay_mtu)):
+        path = tmp_path / "sys" / "class" / "net" / iface
+        path.mkdir(parents=True)
+        (path / "mtu").write_text("{}\n".format(mtu))
+    return str(tmp_path)
+
+
+@pytest.mark.parametrize(
+    "device_mtu, expected",
+    [(1450, checks.OK), (1500, checks.CRITICAL), (1400, checks.WARNING)],
+)
+def test_mtu(tmp_path, device_mtu, expected):
+    root = _mtu_root(tmp_path, device_mtu, 1500)
+    status, _ = checks.check_mtu("flannel.1", "ens3", 50, root)
+    assert status == expected
+
+
+def test_main_unknown(tmp_path, capsys):
+    status = checks.main(["lease", "--snapshot", str(tmp_path / "missing.json")])
+    assert status == checks.UNKNOWN
+    assert capsys.readouterr().out.startswith("FLANNEL LEASE UNKNOWN: no lease")
+
+
+def test_main_fdb(capsys):
+    status = checks.main(["fdb", "--device", "flannel.1"], run_json=_run_json())
+    assert status == checks.OK
+    assert capsys.readouterr().out == "FLANNEL FDB OK: flannel.1 has 2 peers\n"
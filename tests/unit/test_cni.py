@@ -0,0 +1,80 @@
+import json
+
+import pytest
+
+from charms.flannel.cni import CNIConfigError, conflist, parse_conditions
+from charms.flannel.cni import parse_sysctls, write_conflist
+
+
+def test_conflist_defaults():
+    assert conflist(mtu=1450) == {
+        "name": "CDK-flannel-network",
+        "cniVersion": "0.3.1",
+        "plugins": [
+            {
+                "type": "flannel",
+                "delegate": {
+                    "mtu": 1450,
+                    "hairpinMode": True,
+                    "isDefaultGateway": True,
+                },
+            },
+            {"type": "portmap", "capabilities": {"portMappings": True}, "snat": True},
+        ],
+    }
+
+
+def test_conflist_options():
+    conf = conflist(
+        hairpin=False,
+        bandwidth=True,
+        sysctls={"net.core.somaxconn": "1024"},
+        conditions=["-d", "10.0.0.0/8"],
+    )
+    flannel, tuning, portmap, bandwidth = conf["plugins"]
+    assert flannel["delegate"] == {"hairpinMode": False, "isDefaultGateway": True}
+    assert tuning == {"type": "tuning", "sysctl": {"net.core.somaxconn": "1024"}}
+    assert portmap["conditionsV4"] == ["-d", "10.0.0.0/8"]
+    assert bandwidth == {"type": "bandwidth", "capabilities": {"bandwidth": True}}
+
+
+def test_parse_sysctls():
+    assert parse_sysctls("") == {}
+    assert parse_sysctls(
+        "net.core.somaxconn=1024  net.ipv4.tcp_keepalive_time=600"
+    ) == {"net.core.somaxconn": "1024", "net.ipv4.tcp_keepalive_time": "600"}
+
+
+@pytest.mark.parametrize(
+    "value", ["net.core.somaxconn", "net.core.somaxconn=", "vm.swappiness=1"]
+)
+def test_parse_sysctls_invalid(value):
+    with pytest.raises(CNIConfigError):
+        parse_sysctls(value)
+
+
+def test_parse_conditions():
+    assert parse_conditions("") == []
+    assert parse_conditions("-d 10.0.0.0/8 ! -s 10.1.0.0/16") == [
+        "-d",
+        "10.0.0.0/8",
+        "!",
+        "-s",
+        "10.1.0.0/16",
+    ]
+    with pytest.raises(CNIConfigError):
+        parse_conditions("10.0.0.0/8")
+    with pytest.raises(CNIConfigError):
+        parse_conditions('-m comment --comment "open')
+
+
+def test_write_conflist(tmp_path):
+    path = tmp_path / "net.d" / "10-flannel.conflist"
+    assert write_conflist(str(path), conflist(mtu=1450))
+    assert json.loads(path.read_text()) == conflist(mtu=1450)
+    mtime = path.stat().st_mtime_ns
+    assert not write_conflist(str(path), conflist(mtu=1450))
+    assert path.stat().st_mtime_ns == mtime
+    assert write_conflist(str(path), conflist(mtu=8950))
+    assert json.loads(path.read_text())["plugins"][0]["delegate"]["mtu"] == 8950
+    assert [p.name for p in path.parent.iterdir()] == ["10-flannel.conflist"]
@@ -0,0 +1,145 @@
+import pytest
+
+from charms.flannel.common import backoff_delay, retry
+
+
+class FakeClock:
+    """Clock whose sleep only advances the reported time."""
+
+    def __init__(self):
+        self.now = 0.0
+        self.sleeps = []
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, secs):
+        self.sleeps.append(secs)
+        self.now += secs
+
+
+def _flaky(outcomes):
+    """Return a function producing the given outcomes in order."""
+    outcomes = list(outcomes)
+    calls = []
+
+    def func():
+        calls.append(1)
+        outcome = outcomes.pop(0)
+        if isinstance(outcome, Exception):
+            raise outcome
+        return outcome
+
+    func.calls = calls
+    return func
+
+
+def test_fixed_delay_compatible():
+    clock = FakeClock()
+    func = _flaky([False, False, False, False])
+    wrapped = retry(times=3, delay_secs=20, clock=clock, sleep=clock.sleep)(func)
+    assert wrapped() is False
+    assert len(func.calls) == 4
+    assert clock.sleeps == [20, 20, 20]
+
+
+def test_stops_on_success():
+    clock = FakeClock()
+    func = _flaky([False, True])
+    wrapped = retry(times=3, delay_secs=20, clock=clock, sleep=clock.sleep)(func)
+    assert wrapped() is True
+    assert clock.sleeps == [20]
+
+
+def test_exponential_backoff_capped():
+    clock = FakeClock()
+    func = _flaky([False] * 6)
+    wrapped = retry(
+        times=5,
+        delay_secs=1,
+        backoff=2,
+        max_delay_secs=5,
+        clock=clock,
+        sleep=clock.sleep,
+    )(func)
+    wrapped()
+    assert clock.sleeps == [1, 2, 4, 5, 5]
+
+
+def test_full_jitter(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr("random.uniform", lambda low, high: high / 2)
+    func = _flaky([False] * 3)
+    wrapped = retry(
+        times=2, delay_secs=4, backoff=2, jitter=True, clock=clock, sleep=clock.sleep
+    )(func)
+    wrapped()
+    assert clock.sleeps == [2, 4]
+
+
+def test_deadline():
+    clock = FakeClock()
+    func = _flaky([False] * 4)
+    wrapped = retry(
+        times=3,
+        delay_secs=10,
+        backoff=2,
+        deadline_secs=35,
+        clock=clock,
+        sleep=clock.sleep,
+    )(func)
+    assert wrapped() is False
+    # 10 + 20 fits the deadline, another 40 would not.
+    assert clock.sleeps == [10, 20]
+    assert len(func.calls) == 3
+
+
+def test_retryable_exceptions():
+    clock = FakeClock()
+    func = _flaky([OSError("down"), True])
+    wrapped = retry(
+        times=3, delay_secs=1, exceptions=(OSError,), clock=clock, sleep=clock.sleep
+    )(func)
+    assert wrapped() is True
+
+    func = _flaky([OSError("down")] * 2)
+    wrapped = retry(
+        times=1, delay_secs=1, exceptions=(OSError,), clock=clock, sleep=clock.sleep
+    )(func)
+    with pytest.raises(OSError):
+        wrapped()
+
+
+def test_other_exceptions_propagate():
+    clock = FakeClock()
+    func = _flaky([ValueError("bug"), True])
+    wrapped = retry(
+        times=3, delay_secs=1, exceptions=(OSError,), clock=clock, sleep=clock.sleep
+    )(func)
+    with pytest.raises(ValueError):
+        wrapped()
+    assert clock.sleeps == []
+
+
+def test_on_retry_callback():
+    clock = FakeClock()
+    error = OSError("down")
+    events = []
+    func = _flaky([error, False, True])
+    wrapped = retry(
+        times=3,
+        delay_secs=1,
+        backoff=3,
+        exceptions=(OSError,),
+        on_retry=lambda *args: events.append(args),
+        clock=clock,
+        sleep=clock.sleep,
+    )(func)
+    wrapped()
+    assert events == [(1, 1, error), (2, 3, False)]
+
+
+def test_backoff_delay():
+    delays = [backoff_delay(n, 10, backoff=2, max_delay_secs=300) for n in range(7)]
+    assert delays == [10, 20, 40, 80, 160, 300, 300]
+    assert 0 <= backoff_delay(3, 10, backoff=2, jitter=True) <= 80
@@ -0,0 +1,115 @@
+import os
+
+import pytest
+from jinja2 import Environment, FileSystemLoader
+
+from charms.flannel.daemon import ServiceConfigError, flanneld_args
+from charms.flannel.daemon import resource_controls
+
+TEMPLATES = os.path.join(os.path.dirname(__file__), "..", "..", "src", "templates")
+
+
+def _render(**context):
+    env = Environment(loader=FileSystemLoader(TEMPLATES))
+    context.setdefault("flanneld_args", flanneld_args())
+    return env.get_template("flannel.service").render(context)
+
+
+def _exec_start(unit):
+    return next(x for x in unit.splitlines() if x.startswith("ExecStart="))
+
+
+def test_flanneld_args_defaults():
+    assert flanneld_args() == [
+        "--subnet-lease-renew-margin=60",
+        "--iptables-resync=5",
+        "--iptables-forward-rules=true",
+    ]
+
+
+def test_flanneld_args_tuned():
+    args = flanneld_args(
+        renew_margin=120,
+        iptables_resync=30,
+        iptables_forward_rules=False,
+        healthz_port=8471,
+    )
+    assert "--subnet-lease-renew-margin=120" in args
+    assert "--iptables-resync=30" in args
+    assert "--iptables-forward-rules=false" in args
+    assert "--healthz-port=8471" in args
+
+
+@pytest.mark.parametrize(
+    "options",
+    [
+        {"renew_margin": 0},
+        {"renew_margin": 1440},
+        {"iptables_resync": 0},
+        {"healthz_port": 70000},
+    ],
+)
+def test_flanneld_args_invalid(options):
+    with pytest.raises(ServiceConfigError):
+        flanneld_args(**options)
+
+
+def test_resource_controls():
+    assert resource_controls() == {}
+    assert resource_controls(
+        gomaxprocs=2, cpu_affinity="0-1,4", nice=5, cpu_weight=50
+    ) == {"gomaxprocs": 2, "cpu_affinity": "0-1 4", "nice": 5, "cpu_weight": 50}
+
+
+@pytest.mark.parametrize(
+    "options",
+    [
+        {"gomaxprocs": -1},
+        {"cpu_affinity": "all"},
+        {"cpu_affinity": "0-"},
+        {"nice": -21},
+        {"nice": 20},
+        {"cpu_weight": 10001},
+    ],
+)
+def test_resource_controls_invalid(options):
+    with pytest.raises(ServiceConfigError):
+        resource_controls(**options)
+
+
+def test_render_etcd_defaults():
+    unit = _render(
+        iface="ens3",
+        connection_string="https://10.0.0.1:2379",
+        cert_path="/etc/ssl/flannel",
+    )
+    exec_start = _exec_start(unit)
+    assert "-etcd-endpoints=https://10.0.0.1:2379" in exec_start
+    assert exec_start.endswith(
+        "--ip-masq --subnet-lease-renew-margin=60 --iptables-resync=5"
+        " --iptables-forward-rules=true"
+    )
+    for setting in ("GOMAXPROCS", "CPUAffinity", "Nice", "CPUWeight"):
+        assert setting not in unit
+
+
+def test_render_kube_tuned():
+    unit = _render(
+        kube_subnet_mgr=True,
+        node_name="node-1",
+        iface="ens3",
+        kubeconfig="/root/cdk/kubeconfig",
+        net_conf_path="/etc/kube-flannel/net-conf.json",
+        flanneld_args=flanneld_args(healthz_port=8471),
+        **resource_controls(gomaxprocs=2, cpu_affinity="0-1", nice=5, cpu_weight=50),
+    )
+    assert "-kube-subnet-mgr" in _exec_start(unit)
+    assert "--healthz-port=8471" in _exec_start(unit)
+    service = unit.split("[Service]")[1].split("[Install]")[0].splitlines()
+    for line in (
+        "Environment=GOMAXPROCS=2",
+        "CPUAffinity=0-1",
+        "Nice=5",
+        "CPUWeight=50",
+    ):
+        assert line in service
@@ -0,0 +1,207 @@
+import base64
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+import pytest
+
+from charms.flannel.etcd import EtcdClient, EtcdError, get_client, prefix_range_end
+
+
+def _b64(value):
+    return base64.b64encode(value.encode("utf-8")).decode("ascii")
+
+
+class StubEtcd(BaseHTTPRequestHandler):
+    """Just enough of the etcd v3 JSON gateway for the client tests."""
+
+    protocol_version = "HTTP/1.1"
+
+    def do_POST(self):
+        length = int(self.headers["Content-Length"])
+        payload = json.loads(self.rfile.read(length))
+        server = self.server
+        server.requests.append((self.path, payload))
+        server.connections.add(self.client_address)
+        if self.path == "/v3/kv/put":
+            server.revision += 1
+            server.store[payload["key"]] = (payload["value"], server.revision)
+            response = {"header": {"revision": str(server.revision)}}
+        elif self.path == "/v3/kv/range":
+            start = base64.b64decode(payload["key"])
+            end = base64.b64decode(payload.get("range_end", "")) or start + b"\0"
+            kvs = [
+                {"key": k, "value": v, "mod_revision": str(rev)}
+                for k, (v, rev) in sorted(
+                    server.store.items(), key=lambda item: base64.b64decode(item[0])
+                )
+                if start <= base64.b64decode(k) < end
+            ]
+            response = {
+                "header": {"revision": str(server.revision)},
+                "count": str(len(kvs)),
+            }
+            limit = payload.get("limit", 0)
+            if limit and len(kvs) > limit:
+                kvs = kvs[:limit]
+                response["more"] = True
+            if not payload.get("count_only"):
+                response["kvs"] = kvs
+        elif self.path == "/v3/kv/txn":
+            response = {}
+            if all(
+                server.store.get(c["key"], (None, 0))[1] == int(c["mod_revision"])
+                for c in payload["compare"]
+            ):
+                server.revision += 1
+                for op in payload["success"]:
+                    if "request_put" in op:
+                        put = op["request_put"]
+                        server.store[put["key"]] = (put["value"], server.revision)
+                    else:
+                        server.store.pop(op["request_delete_range"]["key"], None)
+                response["succeeded"] = True
+        elif self.path == "/proxy-page":
+            # A proxy in front of etcd answering with its own page.
+            body = b"<html>Service Unavailable</html>"
+            self.send_response(200)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+            return
+        else:
+            self.send_response(404)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        body = json.dumps(response).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def stub_etcd():
+    server = HTTPServer(("127.0.0.1", 0), StubEtcd)
+    server.requests = []
+    server.connections = set()
+    server.store = {}
+    server.revision = 0
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def _endpoint(server):
+    return "http://127.0.0.1:{}".format(server.server_address[1])
+
+
+def test_put_and_get(stub_etcd):
+    client = EtcdClient(_endpoint(stub_etcd))
+    client.put("/coreos.com/network/config", '{"Network": "10.1.0.0/16"}')
+    kv = client.get("/coreos.com/network/config")
+    assert kv["value"] == '{"Network": "10.1.0.0/16"}'
+    assert kv["mod_revision"] == 1
+    assert stub_etcd.requests[0] == (
+        "/v3/kv/put",
+        {
+            "key": _b64("/coreos.com/network/config"),
+            "value": _b64('{"Network": "10.1.0.0/16"}'),
+        },
+    )
+    assert client.get("/missing") is None
+
+
+def test_put_if_revision(stub_etcd):
+    client = EtcdClient(_endpoint(stub_etcd))
+    assert client.put_if_revision("/key", "first", 0)
+    assert not client.put_if_revision("/key", "second", 0)
+    revision = client.get("/key")["mod_revision"]
+    assert client.put_if_revision("/key", "second", revision)
+    assert client.get("/key")["value"] == "second"
+
+
+def test_count(stub_etcd):
+    client = EtcdClient(_endpoint(stub_etcd))
+    client.put("/coreos.com/network/config", "{}")
+    client.put("/coreos.com/network/subnets/10.1.5.0-24", "{}")
+    client.put("/coreos.com/network/subnets/10.1.6.0-24", "{}")
+    assert client.count("/coreos.com/network/subnets/") == 2
+    range_end = prefix_range_end("/coreos.com/network/subnets/")
+    assert range_end == b"/coreos.com/network/subnets0"
+
+
+def test_connection_reused(stub_etcd):
+    client = EtcdClient(_endpoint(stub_etcd))
+    for i in range(5):
+        client.put("/key", str(i))
+    assert len(stub_etcd.requests) == 5
+    assert len(stub_etcd.connections) == 1
+
+
+def test_failover(stub_etcd):
+    # Nothing listens on port 1, so the client must move on to the stub.
+    client = EtcdClient("http://127.0.0.1:1," + _endpoint(stub_etcd), timeout=1)
+    client.put("/key", "value")
+    assert client.endpoint == _endpoint(stub_etcd)
+    assert len(stub_etcd.requests) == 1
+
+
+def test_all_endpoints_down():
+    client = EtcdClient("http://127.0.0.1:1,http://127.0.0.1:2", timeout=1)
+    with pytest.raises(EtcdError):
+        client.put("/key", "value")
+
+
+def test_http_error(stub_etcd):
+    client = EtcdClient(_endpoint(stub_etcd))
+    with pytest.raises(EtcdError):
+        client.request("/v3/kv/unknown", {})
+
+
+def test_invalid_json(stub_etcd):
+    client = EtcdClient(_endpoint(stub_etcd))
+    with pytest.raises(EtcdError):
+        client.request("/proxy-page", {})
+
+
+def test_prefix_range_end():
+    assert prefix_range_end("/coreos.com/") == b"/coreos.com0"
+    assert prefix_range_end(b"a\xff\xff") == b"b"
+    assert prefix_range_end(b"\xff") == b"\0"
+
+
+def test_get_client_pooled():
+    first = get_client("https://10.0.0.1:2379", "cert", "key", "ca")
+    assert get_client("https://10.0.0.1:2379", "cert", "key", "ca") is first
+    assert get_client("https://10.0.0.2:2379", "cert", "key", "ca") is not first
+
+
+def test_iter_prefix_pages(stub_etcd):
+    client = EtcdClient(_endpoint(stub_etcd))
+    client.put("/coreos.com/network/config", "{}")
+    for i in range(5):
+        client.put("/coreos.com/network/subnets/10.1.{}.0-24".format(i), "{}")
+    stub_etcd.requests.clear()
+    keys = [kv["key"] for kv in client.iter_prefix("/coreos.com/network/", 2)]
+    assert len(keys) == 6
+    assert len(stub_etcd.requests) == 3
+    # Later pages are read at the revision of the first.
+    assert stub_etcd.requests[1][1]["revision"] == "6"
+
+
+def test_delete_if_revisions(stub_etcd):
+    client = EtcdClient(_endpoint(stub_etcd))
+    client.put("/a", "1")
+    client.put("/b", "2")
+    assert not client.delete_if_revisions([("/a", 1), ("/b", 1)])
+    assert client.count("/") == 2
+    assert client.delete_if_revisions([("/a", 1), ("/b", 2)])
+    assert client.count("/") == 0
@@ -0,0 +1,23 @@
+from unittest.mock import MagicMock
+
+from charms.unit_test import MockKV
+
+from charms.flannel.facts import cached_fact
+
+
+def test_cached_until_key_changes():
+    kv = MockKV()
+    compute = MagicMock(side_effect=["v1", "v2"])
+    assert cached_fact(kv, "version", "hash-1", compute) == "v1"
+    assert cached_fact(kv, "version", "hash-1", compute) == "v1"
+    assert compute.call_count == 1
+    assert cached_fact(kv, "version", "hash-2", compute) == "v2"
+    assert compute.call_count == 2
+
+
+def test_tuple_key_matches_after_storage():
+    kv = MockKV()
+    compute = MagicMock(return_value="ens3")
+    cached_fact(kv, "iface", ("ens3", "10.0.0.1"), compute)
+    cached_fact(kv, "iface", ["ens3", "10.0.0.1"], compute)
+    assert compute.call_count == 1
@@ -1,7 +1,26 @@
+import ipaddress
+import json
+import socket
+import time
 from unittest.mock import MagicMock
 from reactive import flannel
 from charmhelpers.core import hookenv
+from charms.flannel.etcd import EtcdError
+from charms.flannel.routes import DefaultRoute
 from charms.reactive import set_state
+from charms.unit_test import MockKV
+
+# Defaults of the flanneld options in config.yaml.
+SERVICE_OPTIONS = {
+    "subnet-lease-renew-margin": 60,
+    "iptables-resync": 5,
+    "iptables-forward-rules": True,
+    "healthz-port": 0,
+    "gomaxprocs": 0,
+    "cpu-affinity": "",
+    "nice": 0,
+    "cpu-weight": 0,
+}
 
 
 def test_set_available():
@@ -18,3 +37,733 @@ def test_series_upgrade():
     assert flannel.status.blocked.call_count == 0
     flannel.pre_series_upgrade()
     assert flannel.status.blocked.call_count == 1
+
+
+def _network_mocks(monkeypatch):
+    client = MagicMock()
+    client.count.return_value = 0
+    options = {"cidr": "10.1.0.0/16", "backend": "vxlan", "vni": 1, "port": 8472}
+    monkeypatch.setattr(flannel, "config", options.get)
+    monkeypatch.setattr(flannel, "get_client", MagicMock(return_value=client))
+    monkeypatch.setattr(flannel, "data_changed", MagicMock(return_value=True))
+    monkeypatch.setattr(flannel.unitdata, "kv", MagicMock(return_value=MockKV()))
+    etcd = MagicMock()
+    etcd.get_connection_string.return_value = "https://10.0.0.1:2379"
+    return client, etcd
+
+
+def test_configure_network(monkeypatch):
+    client, etcd = _network_mocks(monkeypatch)
+    client.get.return_value = None
+    client.put_if_revision.return_value = True
+    assert flannel.configure_network(etcd)
+    flannel.get_client.assert_called_once_with(
+        "https://10.0.0.1:2379",
+        flannel.ETCD_CERT_PATH,
+        flannel.ETCD_KEY_PATH,
+        flannel.ETCD_CA_PATH,
+        flannel.ETCD_TIMEOUT,
+    )
+    key, data, revision = client.put_if_revision.call_args[0]
+    assert key == "/coreos.com/network/config"
+    assert revision == 0
+    assert json.loads(data) == {
+        "Network": "10.1.0.0/16",
+        "SubnetLen": 24,
+        "Backend": {"Type": "vxlan", "VNI": 1, "Port": 8472},
+    }
+
+
+def test_configure_network_up_to_date(monkeypatch):
+    client, etcd = _network_mocks(monkeypatch)
+    # Key order differs from what the charm renders but the content matches.
+    current = (
+        '{"Backend": {"Port": 8472, "Type": "vxlan", "VNI": 1},'
+        ' "Network": "10.1.0.0/16", "SubnetLen": 24}'
+    )
+    client.get.return_value = {"value": current, "mod_revision": 7}
+    assert flannel.configure_network(etcd)
+    client.put_if_revision.assert_not_called()
+
+
+def test_configure_network_cas(monkeypatch):
+    client, etcd = _network_mocks(monkeypatch)
+    client.get.return_value = {"value": '{"Network": "10.2.0.0/16"}', "mod_revision": 7}
+    client.put_if_revision.return_value = True
+    assert flannel.configure_network(etcd)
+    assert client.put_if_revision.call_args[0][2] == 7
+
+
+def test_configure_network_cached(monkeypatch):
+    client, etcd = _network_mocks(monkeypatch)
+    flannel.data_changed.return_value = False
+    assert flannel.configure_network(etcd)
+    flannel.get_client.assert_not_called()
+
+
+def test_refresh_subnet_usage(monkeypatch):
+    client, etcd = _network_mocks(monkeypatch)
+    client.count.return_value = 12
+    monkeypatch.setattr(flannel.time, "time", lambda: 1000.0)
+    flannel.refresh_subnet_usage(etcd)
+    kv = flannel.unitdata.kv()
+    assert kv.get(flannel.SUBNET_USAGE_KEY) == [12, 255, 1000.0]
+    later = 1000.0 + flannel.SUBNET_USAGE_INTERVAL
+    monkeypatch.setattr(flannel.time, "time", lambda: later - 1)
+    flannel.refresh_subnet_usage(etcd)
+    assert client.count.call_count == 1
+    monkeypatch.setattr(flannel.time, "time", lambda: later)
+    client.count.side_effect = EtcdError("connection refused")
+    flannel.refresh_subnet_usage(etcd)
+    assert client.count.call_count == 2
+    assert kv.get(flannel.SUBNET_USAGE_KEY) == [12, 255, 1000.0]
+
+
+def _negotiate(etcd):
+    """Run invoke_configure_network, failing if it sleeps or takes long."""
+    start = time.monotonic()
+    flannel.invoke_configure_network(etcd)
+    assert time.monotonic() - start < 1
+
+
+def test_invoke_configure_network_defers(monkeypatch):
+    client, etcd = _network_mocks(monkeypatch)
+    monkeypatch.setattr(time, "sleep", MagicMock(side_effect=AssertionError))
+    monkeypatch.setattr(flannel.time, "time", lambda: 1000.0)
+    client.count.side_effect = EtcdError("connection refused")
+    _negotiate(etcd)
+    assert client.count.call_count == 1
+    deferral = flannel.unitdata.kv().get(flannel.NEGOTIATION_KEY)
+    assert deferral["failures"] == 1
+    assert 1000 <= deferral["next_attempt"] <= 1000 + flannel.NEGOTIATION_DELAY
+    assert flannel.status.waiting.call_count == 1
+    set_state.assert_not_called()
+
+
+def test_invoke_configure_network_waits_for_backoff(monkeypatch):
+    client, etcd = _network_mocks(monkeypatch)
+    kv = flannel.unitdata.kv()
+    kv.set(flannel.NEGOTIATION_KEY, {"failures": 3, "next_attempt": 1100.0})
+    monkeypatch.setattr(flannel.time, "time", lambda: 1050.0)
+    _negotiate(etcd)
+    flannel.get_client.assert_not_called()
+    assert flannel.status.waiting.call_count == 1
+    # Once due, the next hook (update-status at the latest) tries again.
+    monkeypatch.setattr(flannel.time, "time", lambda: 1100.0)
+    client.get.return_value = None
+    client.put_if_revision.return_value = True
+    _negotiate(etcd)
+    set_state.assert_called_once_with("flannel.network.configured")
+    assert kv.get(flannel.NEGOTIATION_KEY) is None
+
+
+def test_invoke_configure_network_backoff_grows(monkeypatch):
+    client, etcd = _network_mocks(monkeypatch)
+    monkeypatch.setattr(flannel, "backoff_delay", MagicMock(return_value=40))
+    kv = flannel.unitdata.kv()
+    kv.set(flannel.NEGOTIATION_KEY, {"failures": 2, "next_attempt": 0})
+    client.count.side_effect = EtcdError("connection refused")
+    _negotiate(etcd)
+    assert flannel.backoff_delay.call_args.args[0] == 2
+    assert kv.get(flannel.NEGOTIATION_KEY)["failures"] == 3
+
+
+def test_reconfigure_network_resets_backoff(monkeypatch):
+    kv = MockKV()
+    kv.set(flannel.NEGOTIATION_KEY, {"failures": 5, "next_attempt": 1e12})
+    monkeypatch.setattr(flannel.unitdata, "kv", MagicMock(return_value=kv))
+    flannel.reconfigure_network()
+    assert kv.get(flannel.NEGOTIATION_KEY) is None
+
+
+def test_default_route_interface(monkeypatch):
+    route = MagicMock(interface="ens3")
+    monkeypatch.setattr(flannel, "default_route", MagicMock(return_value=route))
+    assert flannel.default_route_interface() == "ens3"
+    flannel.default_route.return_value = None
+    assert flannel.default_route_interface() is None
+
+
+CNI_OPTIONS = {
+    "iface": "ens3",
+    "mtu": 0,
+    "backend": "vxlan",
+    "cni-hairpin-mode": True,
+    "cni-bandwidth": False,
+    "cni-sysctls": "",
+    "portmap-conditions": "",
+}
+
+
+def _cni_mocks(monkeypatch, tmp_path, **options):
+    options = dict(CNI_OPTIONS, **options)
+    monkeypatch.setattr(flannel, "config", options.get)
+    monkeypatch.setattr(flannel, "default_route", MagicMock(return_value=None))
+    monkeypatch.setattr(flannel, "interface_mtu", MagicMock(return_value=9000))
+    conflist = tmp_path / "10-flannel.conflist"
+    monkeypatch.setattr(flannel, "CNI_CONFLIST_PATH", str(conflist))
+    return conflist
+
+
+def test_configure_cni_mtu(monkeypatch, tmp_path):
+    conflist = _cni_mocks(monkeypatch, tmp_path)
+    flannel.configure_cni(MagicMock())
+    flannel.interface_mtu.assert_called_once_with("ens3")
+    conf = json.loads(conflist.read_text())
+    assert conf["plugins"][0]["delegate"]["mtu"] == 8950
+    assert [p["type"] for p in conf["plugins"]] == ["flannel", "portmap"]
+    set_state.assert_called_once_with("flannel.cni.configured")
+
+
+def test_configure_cni_plugins(monkeypatch, tmp_path):
+    conflist = _cni_mocks(
+        monkeypatch,
+        tmp_path,
+        **{"cni-bandwidth": True, "cni-sysctls": "net.core.somaxconn=1024"},
+    )
+    flannel.configure_cni(MagicMock())
+    plugins = json.loads(conflist.read_text())["plugins"]
+    assert [p["type"] for p in plugins] == ["flannel", "tuning", "portmap", "bandwidth"]
+    assert plugins[1]["sysctl"] == {"net.core.somaxconn": "1024"}
+
+
+def test_configure_cni_unchanged(monkeypatch, tmp_path):
+    conflist = _cni_mocks(monkeypatch, tmp_path)
+    flannel.configure_cni(MagicMock())
+    inode = conflist.stat().st_ino
+    flannel.configure_cni(MagicMock())
+    assert conflist.stat().st_ino == inode
+
+
+def test_configure_cni_invalid_mtu(monkeypatch, tmp_path):
+    conflist = _cni_mocks(monkeypatch, tmp_path, mtu=9001)
+    flannel.configure_cni(MagicMock())
+    assert not conflist.exists()
+    assert flannel.status.blocked.call_count == 1
+
+
+def test_configure_cni_invalid_sysctl(monkeypatch, tmp_path):
+    conflist = _cni_mocks(monkeypatch, tmp_path, **{"cni-sysctls": "kernel.pid_max=1"})
+    flannel.configure_cni(MagicMock())
+    assert not conflist.exists()
+    assert flannel.status.blocked.call_count == 1
+
+
+def test_configure_network_invalid_backend(monkeypatch):
+    client, etcd = _network_mocks(monkeypatch)
+    monkeypatch.setattr(flannel, "config", {"backend": "udp"}.get)
+    flannel.invoke_configure_network(etcd)
+    assert flannel.status.blocked.call_count == 1
+    set_state.assert_not_called()
+
+
+def test_install_flannel_service_stores_etcd(monkeypatch):
+    _, etcd = _network_mocks(monkeypatch)
+    monkeypatch.setattr(flannel, "render_flannel_service", MagicMock())
+    options = dict(SERVICE_OPTIONS, **{"subnet-lease-renew-margin": 30})
+    monkeypatch.setattr(flannel, "config", options.get)
+    kv = MockKV()
+    monkeypatch.setattr(flannel.unitdata, "kv", MagicMock(return_value=kv))
+    flannel.install_flannel_service(etcd)
+    settings = kv.get(flannel.ETCD_SETTINGS_KEY)
+    assert settings["connection_string"] == "https://10.0.0.1:2379"
+    assert settings["ca"] == flannel.ETCD_CA_PATH
+    assert settings["renew_margin"] == 30
+
+
+def test_install_flannel_service_kube(monkeypatch):
+    options = dict(SERVICE_OPTIONS, iface="ens3")
+    monkeypatch.setattr(flannel, "config", options.get)
+    monkeypatch.setattr(flannel, "render", MagicMock())
+    monkeypatch.setattr(flannel, "check_call", MagicMock())
+    monkeypatch.setattr(flannel.socket, "gethostname", lambda: "Node-1")
+    cni = MagicMock()
+    cni.get_config.return_value = {"kubeconfig_path": "/root/cdk/kubeconfig"}
+    flannel.install_flannel_service_kube(cni)
+    flannel.render.assert_called_once_with(
+        "flannel.service",
+        "/lib/systemd/system/flannel.service",
+        {
+            "kube_subnet_mgr": True,
+            "kubeconfig": "/root/cdk/kubeconfig",
+            "node_name": "node-1",
+            "net_conf_path": flannel.KUBE_NET_CONF_PATH,
+            "flanneld_args": [
+                "--subnet-lease-renew-margin=60",
+                "--iptables-resync=5",
+                "--iptables-forward-rules=true",
+            ],
+            "iface": "ens3",
+        },
+    )
+    set_state.assert_called_once_with("flannel.service.installed")
+
+
+def test_install_flannel_service_kube_waiting(monkeypatch):
+    monkeypatch.setattr(flannel, "render", MagicMock())
+    cni = MagicMock()
+    cni.config_available.return_value = False
+    flannel.install_flannel_service_kube(cni)
+    flannel.render.assert_not_called()
+    assert flannel.status.waiting.call_count == 1
+
+
+def test_configure_network_kube(monkeypatch, tmp_path):
+    net_conf = tmp_path / "kube-flannel" / "net-conf.json"
+    monkeypatch.setattr(flannel, "KUBE_NET_CONF_PATH", str(net_conf))
+    options = {"cidr": "10.1.0.0/16", "backend": "host-gw"}
+    monkeypatch.setattr(flannel, "config", options.get)
+    flannel.configure_network_kube()
+    assert json.loads(net_conf.read_text()) == {
+        "Network": "10.1.0.0/16",
+        "SubnetLen": 24,
+        "Backend": {"Type": "host-gw"},
+    }
+    set_state.assert_called_once_with("flannel.network.configured")
+
+
+def test_configure_network_dual_stack(monkeypatch):
+    client, etcd = _network_mocks(monkeypatch)
+    options = {"cidr": "fd00:10:1::/48,10.1.0.0/16", "backend": "vxlan"}
+    monkeypatch.setattr(flannel, "config", options.get)
+    client.get.return_value = None
+    client.put_if_revision.return_value = True
+    assert flannel.configure_network(etcd)
+    assert json.loads(client.put_if_revision.call_args[0][1]) == {
+        "Network": "10.1.0.0/16",
+        "SubnetLen": 24,
+        "EnableIPv6": True,
+        "IPv6Network": "fd00:10:1::/48",
+        "IPv6SubnetLen": 64,
+        "Backend": {"Type": "vxlan"},
+    }
+
+
+def test_set_available_dual_stack(monkeypatch):
+    cni = MagicMock()
+    monkeypatch.setattr(flannel, "config", {"cidr": "fd00::/48, 10.1.0.0/16"}.get)
+    flannel.set_available(cni)
+    cni.set_config.assert_called_once_with(
+        cidr="10.1.0.0/16,fd00::/48", cni_conf_file="10-flannel.conflist"
+    )
+
+
+def test_get_flannel_subnet(monkeypatch, tmp_path):
+    subnet_env = tmp_path / "subnet.env"
+    subnet_env.write_text(
+        "FLANNEL_NETWORK=10.1.0.0/16\n"
+        "FLANNEL_SUBNET=10.1.5.1/24\n"
+        "FLANNEL_IPV6_NETWORK=fd00:10:1::/48\n"
+        "FLANNEL_IPV6_SUBNET=fd00:10:1:5::1/64\n"
+    )
+    monkeypatch.setattr(flannel, "SUBNET_ENV_PATH", str(subnet_env))
+    monkeypatch.setattr(flannel.unitdata, "kv", MagicMock(return_value=MockKV()))
+    assert flannel.get_flannel_subnet() == ["10.1.5.1/24", "fd00:10:1:5::1/64"]
+
+
+def test_configure_network_subnet_pool(monkeypatch):
+    client, etcd = _network_mocks(monkeypatch)
+    options = {"cidr": "10.1.0.0/16", "backend": "vxlan", "subnet-len": 20}
+    monkeypatch.setattr(flannel, "config", options.get)
+    client.get.return_value = None
+    client.put_if_revision.return_value = True
+    client.count.return_value = 16
+    flannel.invoke_configure_network(etcd)
+    client.count.assert_called_once_with("/coreos.com/network/subnets/")
+    client.put_if_revision.assert_not_called()
+    assert flannel.status.blocked.call_count == 1
+    set_state.assert_not_called()
+
+
+def _binaries_mocks(monkeypatch, tmp_path, changed):
+    archive = tmp_path / "flannel.tar.gz"
+    archive.write_bytes(b"\0" * 1000001)
+    monkeypatch.setenv("CHARM_DIR", str(tmp_path))
+    monkeypatch.setattr(flannel, "arch", lambda: "amd64")
+    monkeypatch.setattr(flannel, "resource_get", lambda name: str(archive))
+    install = MagicMock(return_value=changed)
+    monkeypatch.setattr(flannel, "install_resource", install)
+    return install
+
+
+def test_install_flannel_binaries_unchanged(monkeypatch, tmp_path):
+    _binaries_mocks(monkeypatch, tmp_path, [])
+    flannel.install_flannel_binaries()
+    set_state.assert_called_once_with("flannel.binaries.installed")
+    flannel.remove_state.assert_not_called()
+
+
+def test_install_flannel_binaries_changed(monkeypatch, tmp_path):
+    _binaries_mocks(monkeypatch, tmp_path, ["/usr/local/bin/flanneld"])
+    flannel.install_flannel_binaries()
+    set_state.assert_called_once_with("flannel.binaries.installed")
+    flannel.remove_state.assert_any_call("flannel.service.started")
+
+
+def _service_mocks(monkeypatch, running, stored_hash):
+    kv = MagicMock()
+    kv.get.return_value = stored_hash
+    monkeypatch.setattr(flannel.unitdata, "kv", MagicMock(return_value=kv))
+    monkeypatch.setattr(flannel, "flannel_config_hash", lambda: "new-hash")
+    monkeypatch.setattr(flannel, "service_running", lambda name: running)
+    monkeypatch.setattr(flannel, "service_start", MagicMock())
+    monkeypatch.setattr(flannel, "service_restart", MagicMock())
+    return kv
+
+
+def test_start_flannel_service_unchanged(monkeypatch):
+    _service_mocks(monkeypatch, running=True, stored_hash="new-hash")
+    flannel.start_flannel_service()
+    flannel.service_restart.assert_not_called()
+    flannel.service_start.assert_not_called()
+    set_state.assert_called_once_with("flannel.service.started")
+
+
+def test_start_flannel_service_changed(monkeypatch):
+    kv = _service_mocks(monkeypatch, running=True, stored_hash="old-hash")
+    flannel.start_flannel_service()
+    flannel.service_restart.assert_called_once_with("flannel")
+    kv.set.assert_called_once_with("flannel.config-hash", "new-hash")
+
+
+def test_start_flannel_service_stopped(monkeypatch):
+    _service_mocks(monkeypatch, running=False, stored_hash="new-hash")
+    flannel.start_flannel_service()
+    flannel.service_start.assert_called_once_with("flannel")
+
+
+def test_start_flannel_service_reapplies_tuning(monkeypatch):
+    _service_mocks(monkeypatch, running=False, stored_hash="new-hash")
+    flannel.start_flannel_service()
+    flannel.remove_state.assert_called_with("flannel.tuning.applied")
+
+
+def _tuning_mocks(monkeypatch, profile, devices=("flannel.1",)):
+    options = {
+        "tuning-profile": profile,
+        "cidr": "10.1.0.0/16",
+        "subnet-len": 0,
+        "subnet-min": "",
+        "subnet-max": "",
+        "backend": "vxlan",
+        "vni": 0,
+    }
+    monkeypatch.setattr(flannel, "config", options.get)
+    kv = MockKV()
+    monkeypatch.setattr(flannel.unitdata, "kv", lambda: kv)
+    monkeypatch.setattr(flannel.os.path, "exists", lambda p: p.endswith(devices))
+    saved = {"sysctls": {"net.core.rmem_max": "212992"}, "offloads": {}}
+    monkeypatch.setattr(flannel, "apply_tuning", MagicMock(return_value=(saved, [])))
+    return kv
+
+
+def test_apply_tuning_profile(monkeypatch):
+    kv = _tuning_mocks(monkeypatch, "throughput")
+    flannel.apply_tuning_profile()
+    sysctls, offloads, saved, path = flannel.apply_tuning.call_args[0]
+    # 10.1.0.0/16 holds 255 node subnets of 253 pods each.
+    assert sysctls["net.ipv4.neigh.default.gc_thresh1"] == str(2 * 255 + 253)
+    assert offloads == {"flannel.1": {"gso": "on", "gro": "on"}}
+    assert saved is None
+    assert path == flannel.SYSCTL_CONF_PATH
+    assert kv.get(flannel.TUNING_KEY)["sysctls"] == {"net.core.rmem_max": "212992"}
+    set_state.assert_called_once_with("flannel.tuning.applied")
+
+
+def test_apply_tuning_profile_waits_for_device(monkeypatch):
+    _tuning_mocks(monkeypatch, "throughput", devices=())
+    flannel.apply_tuning_profile()
+    assert flannel.apply_tuning.call_args[0][1] == {}
+    set_state.assert_not_called()
+
+
+def test_apply_tuning_profile_invalid(monkeypatch):
+    _tuning_mocks(monkeypatch, "fastest")
+    flannel.apply_tuning_profile()
+    flannel.apply_tuning.assert_not_called()
+    assert "tuning-profile" in flannel.status.blocked.call_args[0][0]
+    set_state.assert_not_called()
+
+
+def test_flannel_config_hash(monkeypatch, tmp_path):
+    unit = tmp_path / "flannel.service"
+    cert = tmp_path / "client-cert.pem"
+    unit.write_text("[Service]")
+    cert.write_text("cert-1")
+    monkeypatch.setattr(flannel, "FLANNEL_SERVICE_PATH", str(unit))
+    monkeypatch.setattr(flannel, "ETCD_CERT_PATH", str(cert))
+    monkeypatch.setattr(flannel, "config", {"cidr": "10.1.0.0/16"}.get)
+    monkeypatch.setattr(flannel, "get_backend_config", lambda: {"Type": "vxlan"})
+    original = flannel.flannel_config_hash()
+    assert flannel.flannel_config_hash() == original
+    cert.write_text("cert-2")
+    assert flannel.flannel_config_hash() != original
+
+
+def test_flannel_config_hash_kubeconfig(monkeypatch, tmp_path):
+    kubeconfig = tmp_path / "kubeconfig"
+    kubeconfig.write_text("token: 1")
+    kv = MockKV()
+    kv.set(flannel.KUBECONFIG_KEY, str(kubeconfig))
+    monkeypatch.setattr(flannel.unitdata, "kv", MagicMock(return_value=kv))
+    monkeypatch.setattr(flannel, "config", {"cidr": "10.1.0.0/16"}.get)
+    monkeypatch.setattr(flannel, "get_backend_config", lambda: {"Type": "vxlan"})
+    original = flannel.flannel_config_hash()
+    kubeconfig.write_text("token: 2")
+    assert flannel.flannel_config_hash() != original
+
+
+def test_kubeconfig_changed(monkeypatch, tmp_path):
+    kubeconfig = tmp_path / "kubeconfig"
+    kubeconfig.write_text("token: 1")
+    cni = MagicMock()
+    cni.get_config.return_value = {"kubeconfig_path": str(kubeconfig)}
+    seen = {}
+
+    def data_changed(key, value):
+        changed = seen.get(key) != value
+        seen[key] = value
+        return changed
+
+    monkeypatch.setattr(flannel, "data_changed", data_changed)
+    flannel.kubeconfig_changed(cni)
+    flannel.remove_state.reset_mock()
+    flannel.kubeconfig_changed(cni)
+    flannel.remove_state.assert_not_called()
+    kubeconfig.write_text("token: 2")
+    flannel.kubeconfig_changed(cni)
+    flannel.remove_state.assert_called_once_with("flannel.service.installed")
+
+
+def test_render_flannel_service_daemon_reload(monkeypatch):
+    options = dict(SERVICE_OPTIONS, iface="ens3")
+    monkeypatch.setattr(flannel, "config", options.get)
+    monkeypatch.setattr(flannel, "render", MagicMock())
+    monkeypatch.setattr(flannel, "check_call", MagicMock())
+    monkeypatch.setattr(flannel, "any_file_changed", MagicMock(return_value=False))
+    flannel.render_flannel_service({})
+    flannel.check_call.assert_not_called()
+    flannel.any_file_changed.return_value = True
+    flannel.render_flannel_service({})
+    flannel.check_call.assert_called_once_with(["systemctl", "daemon-reload"])
+
+
+def test_render_flannel_service_invalid_option(monkeypatch):
+    options = dict(SERVICE_OPTIONS, iface="ens3", nice=40)
+    monkeypatch.setattr(flannel, "config", options.get)
+    monkeypatch.setattr(flannel, "render", MagicMock())
+    flannel.render_flannel_service({})
+    flannel.render.assert_not_called()
+    assert flannel.status.blocked.call_count == 1
+    set_state.assert_not_called()
+
+
+def test_render_flannel_service_etcd_without_nrpe(monkeypatch):
+    options = dict(SERVICE_OPTIONS, iface="ens3")
+    monkeypatch.setattr(flannel, "config", options.get)
+    monkeypatch.setattr(flannel, "render", MagicMock())
+    monkeypatch.setattr(flannel, "any_file_changed", MagicMock(return_value=False))
+    monkeypatch.setattr(flannel, "is_state", lambda flag: False)
+    flannel.render_flannel_service({"connection_string": "https://10.0.0.1:2379"})
+    sources = [c.args[0] for c in flannel.render.call_args_list]
+    assert sources == ["flannel.service"]
+    flannel.remove_state.assert_any_call("flannel.lease-snapshot")
+
+
+def test_render_flannel_service_etcd_lease_snapshot(monkeypatch):
+    options = dict(SERVICE_OPTIONS, iface="ens3")
+    monkeypatch.setattr(flannel, "config", options.get)
+    monkeypatch.setattr(flannel, "render", MagicMock())
+    monkeypatch.setattr(flannel, "any_file_changed", MagicMock(return_value=False))
+    monkeypatch.setattr(flannel, "is_state", lambda flag: True)
+    monkeypatch.setenv("CHARM_DIR", "/var/lib/juju/charm")
+    flannel.render_flannel_service({"connection_string": "https://10.0.0.1:2379"})
+    sources = [c.args[0] for c in flannel.render.call_args_list]
+    assert sources == [
+        "flannel.service",
+        "flannel-metrics.service",
+        "flannel-metrics.timer",
+    ]
+    context = flannel.render.call_args.args[2]
+    assert context["lease_snapshot"] == flannel.LEASE_SNAPSHOT_PATH
+    assert context["metrics_output"] is None
+    set_state.assert_any_call("flannel.lease-snapshot")
+
+
+def test_update_nrpe_config_direct_routing(monkeypatch):
+    options = {"backend": "vxlan", "vni": 0, "iface": "ens3", "direct-routing": True}
+    options["subnet-lease-renew-margin"] = 60
+    monkeypatch.setattr(flannel, "config", options.get)
+    monkeypatch.setattr(flannel, "render", MagicMock())
+    monkeypatch.setattr(flannel, "is_ipv6_underlay", lambda iface: False)
+    monkeypatch.setattr(flannel, "is_state", lambda flag: False)
+    monkeypatch.setenv("CHARM_DIR", "/var/lib/juju/charm")
+    nrpe_setup = flannel.nrpe.NRPE.return_value
+    nrpe_setup.reset_mock()
+    flannel.update_nrpe_config()
+    checks = {
+        c.kwargs["shortname"]: c.kwargs["check_cmd"]
+        for c in nrpe_setup.add_check.call_args_list
+    }
+    assert checks["flannel_1_fdb"].endswith(" --direct-routing")
+
+
+def test_update_nrpe_config(monkeypatch):
+    options = {
+        "backend": "vxlan",
+        "vni": 4096,
+        "iface": "ens3",
+        "subnet-lease-renew-margin": 10,
+    }
+    monkeypatch.setattr(flannel, "config", options.get)
+    monkeypatch.setattr(flannel, "render", MagicMock())
+    monkeypatch.setattr(flannel, "is_ipv6_underlay", lambda iface: False)
+    monkeypatch.setattr(flannel, "is_state", lambda flag: False)
+    monkeypatch.setenv("CHARM_DIR", "/var/lib/juju/charm")
+    nrpe_setup = flannel.nrpe.NRPE.return_value
+    nrpe_setup.reset_mock()
+    flannel.update_nrpe_config()
+    checks = {
+        c.kwargs["shortname"]: c.kwargs["check_cmd"]
+        for c in nrpe_setup.add_check.call_args_list
+    }
+    snapshot = "--snapshot " + flannel.LEASE_SNAPSHOT_PATH
+    assert checks == {
+        "flannel_lease": "check_flannel lease {} --warn 500 --crit 150".format(
+            snapshot
+        ),
+        "flannel_4096_fdb": "check_flannel fdb --device flannel.4096 " + snapshot,
+        "flannel_4096_mtu": (
+            "check_flannel mtu --device flannel.4096 --iface ens3 --overhead 50"
+        ),
+    }
+    nrpe_setup.write.assert_called_once_with()
+
+
+def _fact_mocks(monkeypatch, tmp_path):
+    monkeypatch.setattr(flannel.unitdata, "kv", MagicMock(return_value=MockKV()))
+    monkeypatch.setenv("CHARM_DIR", str(tmp_path))
+    outputs = {"dpkg": b"amd64\n", "flanneld": b"Flannel v0.22.0\n"}
+    check_output = MagicMock(side_effect=lambda cmd, **kwargs: outputs[cmd[0]])
+    monkeypatch.setattr(flannel, "check_output", check_output)
+    return check_output
+
+
+def test_arch_forks_once(monkeypatch, tmp_path):
+    check_output = _fact_mocks(monkeypatch, tmp_path)
+    assert flannel.arch() == "amd64"
+    assert flannel.arch() == "amd64"
+    assert check_output.call_count == 1
+
+
+def test_flanneld_version_cached_per_binary(monkeypatch, tmp_path):
+    check_output = _fact_mocks(monkeypatch, tmp_path)
+    manifest = tmp_path / "files" / "flannel" / "manifest.json"
+    manifest.parent.mkdir(parents=True)
+    files = {flannel.FLANNEL_BINARIES["flanneld"]: "hash-1"}
+    manifest.write_text(json.dumps({"resource": "r1", "files": files}))
+    for _ in range(3):
+        flannel.set_flannel_version()
+    assert check_output.call_count == 1
+    flannel.application_version_set.assert_called_with("0.22.0")
+    files[flannel.FLANNEL_BINARIES["flanneld"]] = "hash-2"
+    manifest.write_text(json.dumps({"resource": "r2", "files": files}))
+    flannel.set_flannel_version()
+    assert check_output.call_count == 2
+
+
+def test_bind_address_interface_cached_per_route(monkeypatch, tmp_path):
+    _fact_mocks(monkeypatch, tmp_path)
+    route = DefaultRoute("ens3", "10.0.0.1", 100, socket.AF_INET, 1500)
+    monkeypatch.setattr(flannel, "default_route", MagicMock(return_value=route))
+    bind_addresses = {"bind-addresses": [{"interfacename": "ens4"}]}
+    network_get = MagicMock(return_value=bind_addresses)
+    monkeypatch.setattr(flannel, "network_get", network_get)
+    assert flannel.get_bind_address_interface() == "ens4"
+    assert flannel.get_bind_address_interface() == "ens4"
+    assert network_get.call_count == 1
+    flannel.default_route.return_value = route._replace(gateway="10.0.0.254")
+    flannel.get_bind_address_interface()
+    assert network_get.call_count == 2
+
+
+def _ready_mocks(monkeypatch, hook):
+    kv = MockKV()
+    kv.set("flannel.mtu", 1450)
+    monkeypatch.setattr(flannel.unitdata, "kv", MagicMock(return_value=kv))
+    monkeypatch.setattr(flannel, "get_flannel_subnet", lambda: ["10.1.5.1/24"])
+    monkeypatch.setattr(flannel, "hook_name", lambda: hook)
+    return kv
+
+
+def test_ready_update_status_unchanged(monkeypatch):
+    _ready_mocks(monkeypatch, "update-status")
+    flannel.ready()
+    flannel.ready()
+    message = "Flannel subnet 10.1.5.1/24, MTU 1450"
+    flannel.status.active.assert_called_once_with(message)
+
+
+def test_ready_reports_after_change(monkeypatch):
+    kv = _ready_mocks(monkeypatch, "update-status")
+    flannel.ready()
+    kv.set("flannel.mtu", 8950)
+    flannel.ready()
+    assert flannel.status.active.call_count == 2
+
+
+def test_ready_other_hooks_always_report(monkeypatch):
+    _ready_mocks(monkeypatch, "config-changed")
+    flannel.ready()
+    flannel.ready()
+    assert flannel.status.active.call_count == 2
+
+
+def test_ready_subnet_pool_nearly_full(monkeypatch):
+    kv = _ready_mocks(monkeypatch, "update-status")
+    kv.set(flannel.SUBNET_USAGE_KEY, [229, 255, 0])
+    flannel.ready()
+    kv.set(flannel.SUBNET_USAGE_KEY, [230, 255, 0])
+    flannel.ready()
+    flannel.status.active.assert_called_with(
+        "Flannel subnet 10.1.5.1/24, MTU 1450, subnet pool 230 of 255 leased"
+    )
+
+
+def test_ready_subnet_pool_exhausted(monkeypatch):
+    kv = _ready_mocks(monkeypatch, "update-status")
+    kv.set(flannel.SUBNET_USAGE_KEY, [255, 255, 0])
+    monkeypatch.setattr(
+        flannel,
+        "get_flannel_subnet",
+        MagicMock(side_effect=flannel.FlannelSubnetNotFound),
+    )
+    flannel.ready()
+    assert flannel.status.blocked.call_count == 1
+
+
+def test_cleanup_deployment(monkeypatch, tmp_path):
+    monkeypatch.setattr(flannel, "config", {"cidr": "10.1.0.0/16"}.get)
+    monkeypatch.setattr(flannel, "SUBNET_ENV_PATH", str(tmp_path / "subnet.env"))
+    state_dir = tmp_path / "charm-flannel"
+    state_dir.mkdir()
+    (state_dir / "handler-timings.json").write_text("{}")
+    monkeypatch.setattr(flannel, "STATE_DIR", str(state_dir))
+    monkeypatch.setattr(
+        flannel, "HANDLER_TIMINGS_PATH", str(state_dir / "handler-timings.json")
+    )
+    monkeypatch.setattr(flannel, "remove_metrics_exporter", MagicMock())
+    teardown = MagicMock(return_value=(["cni0"], []))
+    monkeypatch.setattr(flannel, "teardown", teardown)
+    kv = MockKV()
+    kv.set(flannel.TUNING_KEY, {"sysctls": {"net.core.rmem_max": "212992"}})
+    monkeypatch.setattr(flannel.unitdata, "kv", lambda: kv)
+    monkeypatch.setattr(flannel, "revert_tuning", MagicMock(return_value=[]))
+    flannel.cleanup_deployment()
+    flannel.service_stop.assert_called_with("flannel")
+    flannel.revert_tuning.assert_called_once_with(
+        {"sysctls": {"net.core.rmem_max": "212992"}}, flannel.SYSCTL_CONF_PATH
+    )
+    assert kv.get(flannel.TUNING_KEY) is None
+    teardown.assert_called_once_with([ipaddress.ip_network("10.1.0.0/16")])
+    assert not state_dir.exists()
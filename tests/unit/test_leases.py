@@ -0,0 +1,133 @@
+import json
+from unittest.mock import MagicMock
+
+import pytest
+from charms.unit_test import MockKV
+
+from charms.flannel.leases import (
+    ETCD_SETTINGS_KEY,
+    Lease,
+    LeaseError,
+    etcd_client,
+    format_leases,
+    lease_subnet,
+    lease_ttls,
+    list_leases,
+    reclaim_leases,
+    stale_leases,
+    stale_threshold,
+    subnet_lease_key,
+)
+
+PREFIX = "/coreos.com/network/subnets/"
+
+
+def _lease(subnet, ttl, revision=1):
+    return Lease(subnet, "10.0.0.1", None, ttl, PREFIX + subnet, revision)
+
+
+def test_subnet_lease_key():
+    key = subnet_lease_key("10.1.5.1/24")
+    assert key == PREFIX + "10.1.5.0-24"
+    assert lease_subnet(key) == "10.1.5.0-24"
+
+
+def test_etcd_client():
+    kv = MockKV()
+    assert etcd_client(kv) is None
+    kv.set(
+        ETCD_SETTINGS_KEY,
+        {
+            "connection_string": "https://10.0.0.1:2379",
+            "cert": "/etc/ssl/flannel/client-cert.pem",
+            "key": "/etc/ssl/flannel/client-key.pem",
+            "ca": "/etc/ssl/flannel/client-ca.pem",
+        },
+    )
+    assert etcd_client(kv).endpoints == ["https://10.0.0.1:2379"]
+
+
+def test_list_leases():
+    client = MagicMock()
+    value = {"PublicIP": "10.0.0.5", "BackendData": {"VtepMAC": "aa:bb"}}
+    client.iter_prefix.return_value = [
+        {
+            "key": PREFIX + "10.1.5.0-24",
+            "value": json.dumps(value),
+            "lease": "7",
+            "mod_revision": 3,
+        },
+        {"key": PREFIX + "10.1.6.0-24", "value": "garbage", "mod_revision": 4},
+    ]
+    client.request.return_value = {"TTL": "86000"}
+    leases = list(list_leases(client, 100))
+    client.request.assert_called_once_with("/v3/lease/timetolive", {"ID": "7"})
+    client.iter_prefix.assert_called_once_with(PREFIX, 100)
+    assert leases == [
+        Lease("10.1.5.0-24", "10.0.0.5", "aa:bb", 86000, PREFIX + "10.1.5.0-24", 3),
+        Lease("10.1.6.0-24", None, None, None, PREFIX + "10.1.6.0-24", 4),
+    ]
+
+
+def test_lease_ttls():
+    client = MagicMock()
+    copies = []
+
+    def copy():
+        copies.append(MagicMock())
+        copies[-1].request.side_effect = lambda path, body: {"TTL": body["ID"]}
+        return copies[-1]
+
+    client.copy.side_effect = copy
+    ids = [str(i) for i in range(20)]
+    assert lease_ttls(client, ids + ids[:5], workers=4) == {i: int(i) for i in ids}
+    client.request.assert_not_called()
+    assert 1 <= len(copies) <= 4
+    assert sum(c.request.call_count for c in copies) == 20
+    for c in copies:
+        c.close.assert_called_once_with()
+
+
+def test_stale_threshold():
+    assert stale_threshold({}) == 3000
+    assert stale_threshold({"renew_margin": 30}) == 1500
+    assert stale_threshold({"renew_margin": 30}, 1700) == 1700
+    with pytest.raises(LeaseError):
+        stale_threshold({"renew_margin": 30}, 1800)
+
+
+def test_stale_leases():
+    leases = [
+        _lease("10.1.1.0-24", 86000),
+        _lease("10.1.2.0-24", 600),
+        _lease("10.1.3.0-24", 10),
+        _lease("10.1.4.0-24", None),
+    ]
+    stale = stale_leases(leases, keep={"10.1.3.0-24"})
+    assert [lease.subnet for lease in stale] == ["10.1.2.0-24"]
+
+
+def test_reclaim_leases_batches():
+    client = MagicMock()
+    client.delete_if_revisions.return_value = True
+    leases = [_lease("10.1.{}.0-24".format(i), 10) for i in range(5)]
+    assert reclaim_leases(client, leases, batch_size=2) == leases
+    assert client.delete_if_revisions.call_count == 3
+
+
+def test_reclaim_leases_renewed():
+    # The second lease was renewed after it was read, which fails its batch.
+    leases = [_lease("10.1.{}.0-24".format(i), 10) for i in range(3)]
+    client = MagicMock()
+    client.delete_if_revisions.side_effect = lambda keys: leases[1].key not in dict(
+        keys
+    )
+    assert reclaim_leases(client, leases) == [leases[0], leases[2]]
+    assert client.delete_if_revisions.call_count == 4
+
+
+def test_format_leases():
+    lease = Lease("10.1.5.0-24", "10.0.0.5", "aa:bb", 90, PREFIX, 1)
+    assert format_leases([lease, _lease("10.1.6.0-24", None)]) == (
+        "10.1.5.0-24 10.0.0.5 aa:bb ttl=90\n10.1.6.0-24 10.0.0.1 - ttl=None"
+    )
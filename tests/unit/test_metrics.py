@@ -0,0 +1,164 @@
+import json
+import os
+from pathlib import Path
+from unittest.mock import MagicMock
+
+from charms.flannel import metrics
+
+ROOT = str(Path(__file__).parent.parent / "data" / "proc-root")
+
+
+def test_overlay_devices():
+    assert metrics.overlay_devices(ROOT) == ["cni0", "flannel.1"]
+
+
+def test_device_metrics():
+    found = {(n, labels["device"]): v for n, labels, v in metrics.device_metrics(ROOT)}
+    assert found[("flannel_device_rx_bytes_total", "flannel.1")] == 1000
+    assert found[("flannel_device_tx_dropped_total", "flannel.1")] == 6000
+    assert found[("flannel_device_rx_packets_total", "cni0")] == 30
+    assert len(found) == 12
+
+
+def test_lease_metrics_local():
+    mtime = os.stat(os.path.join(ROOT, "run/flannel/subnet.env")).st_mtime
+    found = {n: v for n, _, v in metrics.lease_metrics(ROOT, now=mtime + 60)}
+    assert found == {
+        "flannel_subnet_lease_present": 1,
+        "flannel_subnet_lease_age_seconds": 60,
+    }
+
+
+def test_lease_metrics_missing(tmp_path):
+    found = list(metrics.lease_metrics(str(tmp_path)))
+    assert found == [("flannel_subnet_lease_present", {}, 0)]
+
+
+def test_lease_metrics_expiry():
+    client = MagicMock()
+    client.get.return_value = {"value": "{}", "lease": "7587"}
+    client.request.return_value = {"ID": "7587", "TTL": "3600"}
+    found = {n: v for n, _, v in metrics.lease_metrics(ROOT, client)}
+    client.get.assert_called_once_with("/coreos.com/network/subnets/10.1.5.0-24")
+    client.request.assert_called_once_with("/v3/lease/timetolive", {"ID": "7587"})
+    assert found["flannel_subnet_lease_expiry_seconds"] == 3600
+
+
+def test_lease_metrics_expiry_throttled(tmp_path):
+    client = MagicMock()
+    client.get.return_value = {"value": "{}", "lease": "7587"}
+    client.request.return_value = {"ID": "7587", "TTL": "3600"}
+    ttl_path = str(tmp_path / "lease-ttl.json")
+
+    def expiry(now):
+        found = metrics.lease_metrics(ROOT, client, now, ttl_path=ttl_path)
+        return {n: v for n, _, v in found}["flannel_subnet_lease_expiry_seconds"]
+
+    assert expiry(1000) == 3600
+    # Within the interval the TTL is counted down instead of asked for again.
+    assert expiry(1030) == 3570
+    assert client.get.call_count == 1
+    assert expiry(1000 + metrics.LEASE_SNAPSHOT_INTERVAL) == 3600
+    assert client.get.call_count == 2
+
+
+def test_lease_metrics_expiry_from_snapshot(tmp_path):
+    client = MagicMock()
+    snapshot = tmp_path / "leases.json"
+    snapshot.write_text(
+        json.dumps({"timestamp": 1000, "subnet": "10.1.5.0-24", "ttl": 3600})
+    )
+    found = metrics.lease_metrics(ROOT, client, 1060, str(snapshot))
+    assert {n: v for n, _, v in found}["flannel_subnet_lease_expiry_seconds"] == 3540
+    client.get.assert_not_called()
+
+
+def test_write_lease_snapshot(tmp_path):
+    client = MagicMock()
+    client.iter_prefix.return_value = [
+        {
+            "key": "/coreos.com/network/subnets/10.1.5.0-24",
+            "value": '{"PublicIP": "10.0.0.5", "BackendData": {"VtepMAC": "m5"}}',
+            "lease": "7587",
+        },
+        {
+            "key": "/coreos.com/network/subnets/10.1.6.0-24",
+            "value": '{"PublicIP": "10.0.0.6", "BackendData": null}',
+            "lease": "7588",
+        },
+    ]
+    client.request.return_value = {"ID": "7587", "TTL": "3600"}
+    path = tmp_path / "leases.json"
+    metrics.write_lease_snapshot(client, ROOT, str(path), now=1000)
+    assert json.loads(path.read_text()) == {
+        "timestamp": 1000,
+        "subnet": "10.1.5.0-24",
+        "ttl": 3600,
+        "leases": {
+            "10.1.5.0-24": {"public_ip": "10.0.0.5", "vtep_mac": "m5"},
+            "10.1.6.0-24": {"public_ip": "10.0.0.6", "vtep_mac": None},
+        },
+    }
+    # A fresh snapshot is not read again.
+    client.iter_prefix.reset_mock()
+    metrics.write_lease_snapshot(client, ROOT, str(path))
+    client.iter_prefix.assert_not_called()
+
+
+def test_neighbour_metrics():
+    fdb = [{"mac": "aa:bb:cc:dd:ee:01", "dst": "10.0.0.2", "flags": ["self"]}] * 3
+    neigh = [{"dst": "10.1.6.0", "lladdr": "aa:bb:cc:dd:ee:01"}] * 2
+    outputs = {"bridge": fdb, "ip": neigh}
+    found = list(metrics.neighbour_metrics(ROOT, lambda cmd: outputs[cmd[0]]))
+    assert found == [
+        ("flannel_fdb_entries", {"device": "flannel.1"}, 3),
+        ("flannel_neighbour_entries", {"device": "flannel.1"}, 2),
+    ]
+
+
+def test_handler_timings(tmp_path):
+    path = str(tmp_path / "timings.json")
+    metrics.record_handler_time("ready", 0.25, path)
+    metrics.record_handler_time("ready", 0.5, path)
+    found = {n: v for n, _, v in metrics.handler_metrics(path)}
+    assert found["flannel_charm_handler_duration_seconds"] == 0.5
+    assert found["flannel_charm_handler_runs_total"] == 2
+
+
+def test_time_handlers(tmp_path):
+    path = str(tmp_path / "timings.json")
+
+    def ours():
+        pass
+
+    def theirs():
+        pass
+
+    theirs.__module__ = "reactive.other"
+
+    class Handler:
+        def __init__(self, action):
+            self._action = action
+
+        def invoke(self):
+            self._action()
+
+    metrics.time_handlers(Handler, __name__, path)
+    Handler(ours).invoke()
+    Handler(theirs).invoke()
+    with open(path) as f:
+        assert list(json.load(f)) == ["ours"]
+
+
+def test_format_metrics():
+    text = metrics.format_metrics(
+        [("flannel_fdb_entries", {"device": "flannel.1"}, 3), ("up", {}, 1)]
+    )
+    assert text == 'flannel_fdb_entries{device="flannel.1"} 3\nup 1\n'
+
+
+def test_main(tmp_path, monkeypatch):
+    output = tmp_path / "textfile" / "flannel.prom"
+    monkeypatch.setattr(metrics, "collect", lambda **kwargs: [("up", {}, 1)])
+    metrics.main(["--output", str(output)])
+    assert output.read_text() == "up 1\n"
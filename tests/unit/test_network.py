@@ -0,0 +1,201 @@
+import pytest
+
+from charms.flannel.network import (
+    InvalidBackend,
+    InvalidCIDR,
+    InvalidMTU,
+    SubnetPoolExhausted,
+    backend_config,
+    backend_interfaces,
+    check_lease_capacity,
+    network_config,
+    normalize_cidr,
+    overlay_mtu,
+    parse_cidrs,
+    plan_subnets,
+    pod_mtu,
+)
+
+
+@pytest.mark.parametrize(
+    "underlay, ipv6, backend, expected",
+    [
+        (1500, False, "vxlan", 1450),
+        (1500, True, "vxlan", 1430),
+        (9000, False, "vxlan", 8950),
+        (9000, True, "vxlan", 8930),
+        (1450, False, "vxlan", 1400),
+        (9000, False, "host-gw", 9000),
+        (1500, False, "wireguard", 1440),
+        (1500, True, "wireguard", 1420),
+    ],
+)
+def test_overlay_mtu(underlay, ipv6, backend, expected):
+    assert overlay_mtu(underlay, ipv6, backend) == expected
+
+
+@pytest.mark.parametrize(
+    "underlay, override, ipv6, expected",
+    [
+        (9000, 0, False, 8950),
+        (9000, 0, True, 8930),
+        (9000, 1500, False, 1500),
+        (9000, 8950, False, 8950),
+        (None, 1400, False, 1400),
+        (None, 0, False, None),
+    ],
+)
+def test_pod_mtu(underlay, override, ipv6, expected):
+    assert pod_mtu(underlay, override, ipv6) == expected
+
+
+@pytest.mark.parametrize(
+    "underlay, override, ipv6",
+    [(1500, 1000, False), (1500, 1451, False), (1500, 1440, True), (9000, 9000, False)],
+)
+def test_pod_mtu_invalid(underlay, override, ipv6):
+    with pytest.raises(InvalidMTU):
+        pod_mtu(underlay, override, ipv6)
+
+
+def test_backend_config_vxlan():
+    assert backend_config() == {"Type": "vxlan"}
+    config = backend_config(
+        "vxlan", vni=2, port=8472, direct_routing=True, gbp=True, learning=True
+    )
+    assert config == {
+        "Type": "vxlan",
+        "VNI": 2,
+        "Port": 8472,
+        "DirectRouting": True,
+        "GBP": True,
+        "Learning": True,
+    }
+
+
+def test_backend_config_host_gw():
+    # vxlan only options do not leak into other backends
+    assert backend_config("host-gw", vni=2, direct_routing=True) == {"Type": "host-gw"}
+
+
+def test_backend_config_wireguard():
+    assert backend_config("wireguard", port=51820, keepalive=25) == {
+        "Type": "wireguard",
+        "ListenPort": 51820,
+        "PersistentKeepaliveInterval": 25,
+    }
+    with pytest.raises(InvalidBackend):
+        backend_config("wireguard", keepalive=-1)
+
+
+def test_backend_config_invalid():
+    with pytest.raises(InvalidBackend):
+        backend_config("udp")
+
+
+def test_backend_interfaces():
+    assert backend_interfaces("vxlan") == ["flannel.1"]
+    assert backend_interfaces("vxlan", 4096) == ["flannel.4096"]
+    assert backend_interfaces("wireguard") == ["flannel-wg", "flannel-wg-v6"]
+    assert backend_interfaces("host-gw") == []
+
+
+def test_network_config_dual_stack():
+    config = network_config("fd00:10:1::/48, 10.1.0.0/16", {"Type": "vxlan"})
+    assert config == {
+        "Network": "10.1.0.0/16",
+        "SubnetLen": 24,
+        "EnableIPv6": True,
+        "IPv6Network": "fd00:10:1::/48",
+        "IPv6SubnetLen": 64,
+        "Backend": {"Type": "vxlan"},
+    }
+
+
+def test_network_config_ipv6_only():
+    config = network_config("fd00:10:1::/48", {"Type": "vxlan"})
+    assert config["EnableIPv4"] is False
+    assert "Network" not in config
+
+
+@pytest.mark.parametrize(
+    "cidr",
+    [
+        "",
+        "not-a-cidr",
+        "10.1.0.1/16",
+        "10.1.0.0/16,10.1.128.0/17",
+        "10.1.0.0/16,10.2.0.0/16",
+        "fd00::/48,fd00:0:0:1::/64",
+    ],
+)
+def test_parse_cidrs_invalid(cidr):
+    with pytest.raises(InvalidCIDR):
+        parse_cidrs(cidr)
+
+
+def test_parse_cidrs_small_network():
+    # flanneld splits networks too small for the default subnets in two.
+    ipv4, ipv6 = parse_cidrs("10.1.0.0/24,fd00::/64", 24)
+    assert (ipv4.prefixlen, ipv6.prefixlen) == (24, 64)
+    config = network_config("10.1.0.0/25,fd00::/64", {"Type": "vxlan"}, 24)
+    assert config["SubnetLen"] == 26
+    assert config["IPv6SubnetLen"] == 65
+    assert plan_subnets("10.1.0.0/24", 24).max_nodes == 1
+    # A length asked for explicitly must still fit.
+    with pytest.raises(InvalidCIDR):
+        parse_cidrs("10.1.0.0/24", 22)
+
+
+def test_normalize_cidr():
+    assert normalize_cidr("fd00::/48, 10.1.0.0/16") == "10.1.0.0/16,fd00::/48"
+    assert normalize_cidr("10.1.0.0/16") == "10.1.0.0/16"
+
+
+@pytest.mark.parametrize(
+    "network, subnet_len, subnet_min, subnet_max, nodes, pods",
+    [
+        ("10.1.0.0/16", 0, "", "", 255, 253),
+        ("10.1.0.0/16", 26, "", "", 1023, 61),
+        ("10.1.0.0/16", 22, "", "", 63, 1021),
+        ("10.0.0.0/8", 24, "", "", 65535, 253),
+        ("10.1.0.0/16", 24, "10.1.10.0", "10.1.19.0", 10, 253),
+        ("10.1.0.0/16", 17, "", "", 1, 32765),
+    ],
+)
+def test_plan_subnets(network, subnet_len, subnet_min, subnet_max, nodes, pods):
+    plan = plan_subnets(network, subnet_len, subnet_min, subnet_max)
+    assert plan.max_nodes == nodes
+    assert plan.pods_per_node == pods
+
+
+@pytest.mark.parametrize(
+    "subnet_len, subnet_min, subnet_max",
+    [
+        (16, "", ""),
+        (31, "", ""),
+        (24, "10.2.0.0", ""),
+        (24, "10.1.1.128", ""),
+        (24, "", "not-an-ip"),
+        (24, "10.1.20.0", "10.1.10.0"),
+    ],
+)
+def test_plan_subnets_invalid(subnet_len, subnet_min, subnet_max):
+    with pytest.raises(InvalidCIDR):
+        plan_subnets("10.1.0.0/16", subnet_len, subnet_min, subnet_max)
+
+
+def test_network_config_subnet_options():
+    config = network_config(
+        "10.1.0.0/16", {"Type": "vxlan"}, 26, "10.1.1.0", "10.1.200.0"
+    )
+    assert config["SubnetLen"] == 26
+    assert config["SubnetMin"] == "10.1.1.0"
+    assert config["SubnetMax"] == "10.1.200.0"
+
+
+def test_check_lease_capacity():
+    plan = plan_subnets("10.1.0.0/16", 20)
+    check_lease_capacity(plan, 15)
+    with pytest.raises(SubnetPoolExhausted):
+        check_lease_capacity(plan, 16)
@@ -0,0 +1,21 @@
+import pstats
+
+from charms.flannel import profiling
+
+
+def test_disabled():
+    callbacks = []
+    assert profiling.profile_hook("update-status", callbacks.append, {}) is None
+    assert callbacks == []
+
+
+def test_profile_hook(tmp_path):
+    callbacks = []
+    environ = {profiling.PROFILE_ENV: str(tmp_path / "profiles")}
+    assert profiling.profile_hook("update-status", callbacks.append, environ)
+    sum(range(1000))
+    for callback in callbacks:
+        callback()
+    (path,) = (tmp_path / "profiles").iterdir()
+    assert path.name.startswith("update-status-")
+    assert pstats.Stats(str(path)).total_calls > 0
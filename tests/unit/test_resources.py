@@ -0,0 +1,135 @@
+import errno
+import hashlib
+import io
+import os
+import tarfile
+
+import pytest
+
+from charms.flannel.resources import (
+    ResourceError,
+    evict,
+    install_resource,
+    load_manifest,
+    sha256_file,
+)
+
+
+def _archive(path, files):
+    with tarfile.open(str(path), "w:gz") as tar:
+        for name, data in files.items():
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            tar.addfile(info, io.BytesIO(data))
+    return str(path)
+
+
+@pytest.fixture
+def install(tmp_path):
+    members = {
+        "flanneld": str(tmp_path / "bin" / "flanneld"),
+        "cni-plugin/flannel": str(tmp_path / "cni" / "flannel"),
+    }
+    manifest = str(tmp_path / "manifest.json")
+    cache = str(tmp_path / "cache")
+
+    def _install(files, name="flannel.tar.gz"):
+        archive = _archive(tmp_path / name, files)
+        return install_resource(archive, members, manifest, cache)
+
+    _install.members = members
+    _install.manifest = manifest
+    _install.cache = cache
+    return _install
+
+
+def test_fresh_install(install, tmp_path):
+    changed = install({"./flanneld": b"flanneld-1", "./cni-plugin/flannel": b"cni-1"})
+    assert sorted(changed) == sorted(install.members.values())
+    flanneld = install.members["flanneld"]
+    with open(flanneld, "rb") as f:
+        assert f.read() == b"flanneld-1"
+    assert os.stat(flanneld).st_mode & 0o777 == 0o755
+    manifest = load_manifest(install.manifest)
+    assert manifest["files"][flanneld] == hashlib.sha256(b"flanneld-1").hexdigest()
+    assert manifest["resource"] == sha256_file(str(tmp_path / "flannel.tar.gz"))
+
+
+def test_unchanged_resource_is_noop(install):
+    files = {"flanneld": b"flanneld-1", "cni-plugin/flannel": b"cni-1"}
+    install(files)
+    mtime = os.stat(install.members["flanneld"]).st_mtime_ns
+    assert install(files) == []
+    assert os.stat(install.members["flanneld"]).st_mtime_ns == mtime
+
+
+def test_only_changed_binaries_replaced(install):
+    install({"flanneld": b"flanneld-1", "cni-plugin/flannel": b"cni-1"})
+    cni_inode = os.stat(install.members["cni-plugin/flannel"]).st_ino
+    changed = install(
+        {"flanneld": b"flanneld-2", "cni-plugin/flannel": b"cni-1"}, "new.tar.gz"
+    )
+    assert changed == [install.members["flanneld"]]
+    assert os.stat(install.members["cni-plugin/flannel"]).st_ino == cni_inode
+
+
+def test_missing_member(install):
+    with pytest.raises(ResourceError):
+        install({"flanneld": b"flanneld-1"})
+
+
+def test_corrupt_archive(install, tmp_path):
+    archive = tmp_path / "corrupt.tar.gz"
+    archive.write_bytes(b"not a tarball")
+    with pytest.raises(ResourceError):
+        install_resource(
+            str(archive), install.members, install.manifest, install.cache
+        )
+    assert os.listdir(install.cache) == [".lock"]
+
+
+def test_installs_link_the_cache(install, tmp_path):
+    install({"flanneld": b"flanneld-1", "cni-plugin/flannel": b"cni-1"})
+    resource_hash = sha256_file(str(tmp_path / "flannel.tar.gz"))
+    cached = os.path.join(install.cache, resource_hash, "flanneld")
+    assert os.path.samefile(cached, install.members["flanneld"])
+
+
+def test_cache_shared_between_units(install, tmp_path, monkeypatch):
+    install({"flanneld": b"flanneld-1", "cni-plugin/flannel": b"cni-1"})
+    # Another unit installing the same resource does not extract it again.
+    monkeypatch.setattr(tarfile, "open", None)
+    archive = str(tmp_path / "flannel.tar.gz")
+    other = str(tmp_path / "other-manifest.json")
+    assert install_resource(archive, install.members, other, install.cache) == []
+    assert load_manifest(other)["files"] == load_manifest(install.manifest)["files"]
+
+
+def test_cache_evicts_least_recently_used(install, tmp_path):
+    install({"flanneld": b"1" * 1000, "cni-plugin/flannel": b"cni-1"}, "a.tar.gz")
+    install({"flanneld": b"2" * 1000, "cni-plugin/flannel": b"cni-1"}, "b.tar.gz")
+    a = sha256_file(str(tmp_path / "a.tar.gz"))
+    b = sha256_file(str(tmp_path / "b.tar.gz"))
+    assert sorted(os.listdir(install.cache)) == sorted([".lock", a, b])
+    os.utime(os.path.join(install.cache, a), (0, 0))
+    os.mkdir(os.path.join(install.cache, ".tmp-interrupted"))
+    assert evict(install.cache, max_size=1500) == [a]
+    assert sorted(os.listdir(install.cache)) == [".lock", b]
+    assert evict(install.cache, max_size=1500, keep=(b,)) == []
+    # The installed files outlive their cache entry.
+    assert evict(install.cache, max_size=0) == [b]
+    with open(install.members["flanneld"], "rb") as f:
+        assert f.read() == b"2" * 1000
+
+
+def test_install_across_filesystems(install, monkeypatch):
+    def link(source, dest):
+        raise OSError(errno.EXDEV, "Invalid cross-device link")
+
+    monkeypatch.setattr(os, "link", link)
+    install({"flanneld": b"flanneld-1", "cni-plugin/flannel": b"cni-1"})
+    flanneld = install.members["flanneld"]
+    with open(flanneld, "rb") as f:
+        assert f.read() == b"flanneld-1"
+    assert os.stat(flanneld).st_nlink == 1
+    assert os.stat(flanneld).st_mode & 0o777 == 0o755
@@ -0,0 +1,65 @@
+import socket
+from pathlib import Path
+
+import pytest
+
+from charms.flannel import routes
+
+PROC_ROOT = str(Path(__file__).parent.parent / "data" / "proc-root")
+
+IPV4_HEADER = "Iface\tDestination\tGateway\tFlags\tRefCnt\tUse\tMetric\tMask\tMTU\n"
+
+
+@pytest.fixture(autouse=True)
+def clear_cache():
+    routes.default_route.cache_clear()
+    yield
+    routes.default_route.cache_clear()
+
+
+def _root(tmp_path, ipv4="", ipv6="", mtus=None):
+    net = tmp_path / "proc" / "net"
+    net.mkdir(parents=True)
+    (net / "route").write_text(IPV4_HEADER + ipv4)
+    (net / "ipv6_route").write_text(ipv6)
+    for iface, mtu in (mtus or {}).items():
+        sys_path = tmp_path / "sys" / "class" / "net" / iface
+        sys_path.mkdir(parents=True)
+        (sys_path / "mtu").write_text("{}\n".format(mtu))
+    return str(tmp_path)
+
+
+def test_lowest_metric_skipping_fan():
+    route = routes.default_route(PROC_ROOT)
+    assert route == routes.DefaultRoute("ens3", "10.10.0.1", 100, socket.AF_INET, 9000)
+
+
+def test_cached():
+    assert routes.default_route(PROC_ROOT) is routes.default_route(PROC_ROOT)
+
+
+def test_ipv6_only(tmp_path):
+    ipv6 = (
+        "00000000000000000000000000000000 00 00000000000000000000000000000000 00 "
+        "fe800000000000000000000000000001 00000400 00000001 00000000 00000003 ens3\n"
+        "00000000000000000000000000000000 00 00000000000000000000000000000000 00 "
+        "00000000000000000000000000000000 ffffffff 00000001 00000000 00200200 lo\n"
+    )
+    root = _root(tmp_path, ipv6=ipv6, mtus={"ens3": 1500})
+    route = routes.default_route(root)
+    assert route == routes.DefaultRoute("ens3", "fe80::1", 1024, socket.AF_INET6, 1500)
+
+
+def test_no_default_route(tmp_path):
+    ipv4 = "ens3\t00000A0A\t00000000\t0001\t0\t0\t0\t0000FFFF\t0\t0\t0\n"
+    assert routes.default_route(_root(tmp_path, ipv4=ipv4)) is None
+
+
+def test_only_overlay_routes(tmp_path):
+    ipv4 = "flannel.1\t00000000\t0100010A\t0003\t0\t0\t0\t00000000\t0\t0\t0\n"
+    assert routes.default_route(_root(tmp_path, ipv4=ipv4)) is None
+
+
+def test_missing_mtu(tmp_path):
+    ipv4 = "ens3\t00000000\t01000A0A\t0003\t0\t0\t0\t00000000\t0\t0\t0\n"
+    assert routes.default_route(_root(tmp_path, ipv4=ipv4)).mtu is None
@@ -0,0 +1,66 @@
+import ipaddress
+import os
+
+from charms.unit_test import MockKV
+
+from charms.flannel import subnet_env
+
+
+SUBNET_ENV = """\
+# written by flanneld
+FLANNEL_NETWORK=10.1.0.0/16
+FLANNEL_SUBNET=10.1.5.1/24
+FLANNEL_IPV6_NETWORK=fd00:10:1::/48
+FLANNEL_IPV6_SUBNET=fd00:10:1:5::1/64
+FLANNEL_MTU=8950
+FLANNEL_IPMASQ=true
+FLANNEL_EXTRA="a=b"
+"""
+
+
+def test_parse_keeps_equals_in_values():
+    values = subnet_env.parse_subnet_env(SUBNET_ENV)
+    assert values["FLANNEL_EXTRA"] == "a=b"
+    assert len(values) == 7
+
+
+def test_typed_record(tmp_path):
+    path = tmp_path / "subnet.env"
+    path.write_text(SUBNET_ENV)
+    env = subnet_env.read_subnet_env(str(path))
+    assert env == subnet_env.SubnetEnv(
+        network=ipaddress.ip_network("10.1.0.0/16"),
+        subnet=ipaddress.ip_interface("10.1.5.1/24"),
+        mtu=8950,
+        ipmasq=True,
+        ipv6_network=ipaddress.ip_network("fd00:10:1::/48"),
+        ipv6_subnet=ipaddress.ip_interface("fd00:10:1:5::1/64"),
+    )
+
+
+def test_malformed_values():
+    env = subnet_env.subnet_env({"FLANNEL_SUBNET": "bogus", "FLANNEL_MTU": "x"})
+    assert env.subnet is None
+    assert env.mtu is None
+    assert env.ipmasq is False
+
+
+def test_missing(tmp_path):
+    assert subnet_env.read_subnet_env(str(tmp_path / "subnet.env")) is None
+
+
+def test_cached_until_modified(tmp_path, monkeypatch):
+    path = tmp_path / "subnet.env"
+    path.write_text(SUBNET_ENV)
+    kv = MockKV()
+    assert subnet_env.read_subnet_env(str(path), kv).mtu == 8950
+    opened = []
+    real_open = open
+    monkeypatch.setattr(
+        "builtins.open", lambda *args: opened.append(args) or real_open(*args)
+    )
+    assert subnet_env.read_subnet_env(str(path), kv).mtu == 8950
+    assert opened == []
+    path.write_text(SUBNET_ENV.replace("8950", "1450"))
+    os.utime(str(path), ns=(0, 1))
+    assert subnet_env.read_subnet_env(str(path), kv).mtu == 1450
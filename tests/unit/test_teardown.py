@@ -0,0 +1,131 @@
+import ipaddress
+import json
+import subprocess
+
+from charms.flannel import teardown
+
+NETWORKS = [ipaddress.ip_network("10.1.0.0/16")]
+
+IPTABLES_SAVE = """\
+*nat
+:PREROUTING ACCEPT [0:0]
+:POSTROUTING ACCEPT [0:0]
+:FLANNEL-POSTRTG - [0:0]
+:KUBE-POSTROUTING - [0:0]
+-A POSTROUTING -m comment --comment "flanneld masq" -j FLANNEL-POSTRTG
+-A POSTROUTING -j KUBE-POSTROUTING
+-A FLANNEL-POSTRTG -s 10.1.0.0/16 -d 10.1.0.0/16 -j RETURN
+COMMIT
+*filter
+:FORWARD ACCEPT [0:0]
+:FLANNEL-FWD - [0:0]
+-A FORWARD -m comment --comment "flanneld forward" -j FLANNEL-FWD
+-A FLANNEL-FWD -s 10.1.0.0/16 -j ACCEPT
+COMMIT
+"""
+
+
+class FakeHost:
+    """Answers the commands teardown runs and applies what it removes."""
+
+    def __init__(self, root, links=("flannel.1", "cni0")):
+        self.root = root
+        for link in links:
+            (root / "sys" / "class" / "net" / link).mkdir(parents=True)
+        self.routes = [
+            {"dst": "default", "gateway": "10.0.0.1", "dev": "ens3"},
+            {"dst": "10.1.6.0/24", "gateway": "10.0.0.6", "dev": "ens3"},
+            {"dst": "10.1.7.0/24", "gateway": "10.1.7.0", "dev": "flannel.1"},
+            {"dst": "192.168.1.0/24", "gateway": "10.0.0.1", "dev": "ens3"},
+        ]
+        self.iptables = IPTABLES_SAVE
+        self.nft_tables = "table ip filter\ntable ip flannel-ipv4\n"
+        self.calls = []
+
+    def run(self, cmd, input=None):
+        self.calls.append((cmd, input))
+        if cmd[:2] == ["ip", "-j"]:
+            return json.dumps(self.routes)
+        if cmd[:2] == ["ip", "-force"]:
+            for line in input.splitlines():
+                words = line.split()
+                if words[:2] == ["link", "delete"]:
+                    (self.root / "sys" / "class" / "net" / words[2]).rmdir()
+                    self.routes = [r for r in self.routes if r["dev"] != words[2]]
+                elif words[:2] == ["route", "del"]:
+                    self.routes = [r for r in self.routes if r["dst"] != words[2]]
+            return ""
+        if cmd == ["iptables-save"]:
+            return self.iptables
+        if cmd == ["iptables-restore", "--noflush"]:
+            self.iptables = "*nat\n-A POSTROUTING -j KUBE-POSTROUTING\nCOMMIT\n"
+            return ""
+        if cmd == ["nft", "list", "tables"]:
+            return self.nft_tables
+        if cmd == ["nft", "-f", "-"]:
+            self.nft_tables = "table ip filter\n"
+            return ""
+        # ip6tables is not installed.
+        return None
+
+
+def test_iptables_cleanup():
+    assert teardown.iptables_cleanup(IPTABLES_SAVE).splitlines() == [
+        "*nat",
+        '-D POSTROUTING -m comment --comment "flanneld masq" -j FLANNEL-POSTRTG',
+        "-F FLANNEL-POSTRTG",
+        "-X FLANNEL-POSTRTG",
+        "COMMIT",
+        "*filter",
+        '-D FORWARD -m comment --comment "flanneld forward" -j FLANNEL-FWD',
+        "-F FLANNEL-FWD",
+        "-X FLANNEL-FWD",
+        "COMMIT",
+    ]
+
+
+def test_iptables_cleanup_nothing():
+    assert teardown.iptables_cleanup("*nat\n:POSTROUTING ACCEPT [0:0]\nCOMMIT\n") == ""
+
+
+def test_teardown(tmp_path):
+    host = FakeHost(tmp_path)
+    ipam = tmp_path / "var" / "lib" / "cni" / "networks" / "CDK-flannel-network"
+    ipam.mkdir(parents=True)
+    (ipam / "10.1.5.2").write_text("container-id")
+    removed, errors = teardown.teardown(NETWORKS, str(tmp_path), host.run)
+    assert errors == []
+    batch = [i for c, i in host.calls if c[:2] == ["ip", "-force"]]
+    assert batch == ["route del 10.1.6.0/24\nlink delete cni0\nlink delete flannel.1\n"]
+    assert [r["dst"] for r in host.routes] == ["default", "192.168.1.0/24"]
+    assert host.nft_tables == "table ip filter\n"
+    assert not ipam.exists()
+    assert len(removed) == 4
+
+
+def test_teardown_idempotent(tmp_path):
+    host = FakeHost(tmp_path)
+    teardown.teardown(NETWORKS, str(tmp_path), host.run)
+    host.calls = []
+    removed, errors = teardown.teardown(NETWORKS, str(tmp_path), host.run)
+    assert (removed, errors) == ([], [])
+    # Only the read-only discovery commands run.
+    assert [c for c, _ in host.calls] == [
+        ["ip", "-j", "route", "show"],
+        ["iptables-save"],
+        ["ip6tables-save"],
+        ["nft", "list", "tables"],
+    ]
+
+
+def test_teardown_continues_after_failure(tmp_path):
+    host = FakeHost(tmp_path)
+
+    def run(cmd, input=None):
+        if cmd[:2] == ["ip", "-force"]:
+            raise subprocess.CalledProcessError(1, cmd, stderr="RTNETLINK busy\n")
+        return host.run(cmd, input)
+
+    removed, errors = teardown.teardown(NETWORKS, str(tmp_path), run)
+    assert errors == ["links and routes: cni0, flannel.1, 10.1.6.0/24: RTNETLINK busy"]
+    assert removed == ["iptables rules", "nftables tables"]
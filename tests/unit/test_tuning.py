@@ -0,0 +1,149 @@
+import pytest
+
+from charms.flannel import tuning
+
+SYSCTLS = {
+    "net.ipv4.conf.all.rp_filter": "1",
+    "net.ipv4.neigh.default.gc_thresh1": "128",
+    "net.ipv4.neigh.default.gc_thresh2": "512",
+    "net.ipv4.neigh.default.gc_thresh3": "1024",
+    "net.ipv6.neigh.default.gc_thresh1": "128",
+    "net.ipv6.neigh.default.gc_thresh2": "512",
+    "net.ipv6.neigh.default.gc_thresh3": "1024",
+    "net.core.rmem_max": "212992",
+    "net.core.wmem_max": "212992",
+    "net.core.netdev_max_backlog": "1000",
+    "net.ipv4.tcp_rmem": "4096\t131072\t6291456",
+    "net.ipv4.tcp_wmem": "4096\t16384\t4194304",
+}
+
+
+class FakeEthtool:
+    """Keeps the offloads of a device, as ethtool -k and -K see them."""
+
+    def __init__(self, features):
+        self.features = dict(features)
+
+    def run(self, cmd, input=None):
+        if cmd[1] == "-k":
+            lines = ["Features for {}:".format(cmd[2])]
+            for name, value in self.features.items():
+                lines.append("{}: {}".format(name, value))
+            return "\n".join(lines) + "\n"
+        for feature, value in zip(cmd[3::2], cmd[4::2]):
+            self.features[tuning.FEATURE_NAMES.get(feature, feature)] = value
+        return ""
+
+
+@pytest.fixture
+def root(tmp_path):
+    for name, value in SYSCTLS.items():
+        path = tmp_path.joinpath("proc/sys", *name.split("."))
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text(value + "\n")
+    return tmp_path
+
+
+def _read_all(root):
+    return {name: tuning.read_sysctl(name, str(root)) for name in SYSCTLS}
+
+
+def test_neigh_thresholds():
+    assert tuning.neigh_thresholds(0) == (128, 512, 1024)
+    assert tuning.neigh_thresholds(4000, 253) == (8253, 16506, 33012)
+
+
+def test_profile_sysctls():
+    assert tuning.profile_sysctls("default", 255, 253) == {}
+    throughput = tuning.profile_sysctls("throughput", 4000, 253)
+    assert throughput["net.ipv4.conf.all.rp_filter"] == "2"
+    assert throughput["net.ipv6.neigh.default.gc_thresh3"] == "33012"
+    assert throughput["net.core.rmem_max"] == "16777216"
+    assert "net.netfilter.nf_conntrack_max" not in throughput
+    large = tuning.profile_sysctls("large-cluster", 4000, 253)
+    assert large["net.netfilter.nf_conntrack_max"] == "1048576"
+    assert "net.core.rmem_max" not in large
+    with pytest.raises(tuning.TuningConfigError):
+        tuning.profile_sysctls("fastest")
+
+
+def test_sysctl_conf():
+    conf = tuning.sysctl_conf(
+        {"net.netfilter.nf_conntrack_max": "1048576", "net.core.rmem_max": "1"}
+    )
+    assert conf.splitlines()[1:] == [
+        "net.core.rmem_max = 1",
+        "-net.netfilter.nf_conntrack_max = 1048576",
+    ]
+
+
+def test_apply_and_revert_tuning(root, tmp_path):
+    conf = tmp_path / "60-flannel.conf"
+    features = {
+        "generic-segmentation-offload": "off",
+        "generic-receive-offload": "on",
+        "tcp-segmentation-offload": "on",
+    }
+    ethtool = FakeEthtool(features)
+    before = _read_all(root)
+    sysctls = tuning.profile_sysctls("throughput", 4000, 253)
+    offloads = {"flannel.1": tuning.profile_offloads("throughput")}
+    saved, errors = tuning.apply_tuning(
+        sysctls, offloads, None, str(conf), str(root), ethtool.run
+    )
+    assert errors == []
+    assert tuning.read_sysctl("net.ipv4.tcp_rmem", str(root)) == "4096 131072 16777216"
+    assert "net.core.rmem_max = 16777216" in conf.read_text()
+    assert ethtool.features["generic-segmentation-offload"] == "on"
+    assert saved["offloads"] == {"flannel.1": {"gso": "off", "gro": "on"}}
+
+    # Applying again leaves the original values saved.
+    saved, errors = tuning.apply_tuning(
+        sysctls, offloads, saved, str(conf), str(root), ethtool.run
+    )
+    assert saved["sysctls"]["net.core.rmem_max"] == "212992"
+
+    errors = tuning.revert_tuning(saved, str(conf), str(root), ethtool.run)
+    assert errors == []
+    assert _read_all(root) == before
+    assert ethtool.features == features
+    assert not conf.exists()
+
+
+def test_apply_tuning_switch_profile(root, tmp_path):
+    conf = tmp_path / "60-flannel.conf"
+    saved, _ = tuning.apply_tuning(
+        tuning.profile_sysctls("throughput"), {}, None, str(conf), str(root)
+    )
+    saved, errors = tuning.apply_tuning(
+        tuning.profile_sysctls("large-cluster"), {}, saved, str(conf), str(root)
+    )
+    # nf_conntrack is not loaded, which only the drop-in tolerates.
+    assert errors == []
+    assert tuning.read_sysctl("net.core.rmem_max", str(root)) == "212992"
+    assert "net.core.rmem_max" not in saved["sysctls"]
+    assert "-net.netfilter.nf_conntrack_max" in conf.read_text()
+
+
+def test_apply_tuning_missing_sysctl(root, tmp_path):
+    conf = tmp_path / "60-flannel.conf"
+    saved, errors = tuning.apply_tuning(
+        {"net.core.somaxconn": "4096"}, {}, None, str(conf), str(root)
+    )
+    assert errors == ["sysctl net.core.somaxconn does not exist"]
+    assert saved["sysctls"] == {}
+
+
+def test_apply_tuning_keeps_higher_values(root, tmp_path):
+    conf = tmp_path / "60-flannel.conf"
+    tuning.write_sysctl("net.ipv4.neigh.default.gc_thresh3", "32768", str(root))
+    tuning.write_sysctl("net.ipv4.tcp_rmem", "8192 262144 6291456", str(root))
+    sysctls = tuning.profile_sysctls("throughput", 255, 253)
+    saved, errors = tuning.apply_tuning(sysctls, {}, None, str(conf), str(root))
+    assert errors == []
+    assert tuning.read_sysctl("net.ipv4.neigh.default.gc_thresh3", str(root)) == "32768"
+    assert tuning.read_sysctl("net.ipv4.neigh.default.gc_thresh1", str(root)) == "763"
+    assert tuning.read_sysctl("net.ipv4.tcp_rmem", str(root)) == "8192 262144 16777216"
+    assert "net.ipv4.neigh.default.gc_thresh3" not in saved["sysctls"]
+    assert saved["sysctls"]["net.ipv4.neigh.default.gc_thresh1"] == "128"
+    assert "net.ipv4.neigh.default.gc_thresh3" not in conf.read_text()